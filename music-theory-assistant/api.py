@@ -1,10 +1,18 @@
+import json
+import time
 import uuid
-from fastapi import FastAPI, HTTPException, Response
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
 
-from rag import rag # shared RAG flow
-from db import save_conversation, save_feedback
+from rag import arag, arag_stream, warmup_models, models_ready # shared RAG flow (async twins of rag.rag / rag.rag_stream)
+from batch_rag import parse_questions, run_batch, BATCH_MAX_QUESTIONS
+from resilience import LLMUnavailableError
+from metrics import setup_tracing
+from db import asave_conversation, asave_feedback, close_async_pool, close_pool, close_write_behind, WriteBehindFull
 
 from prometheus_client import Counter, Histogram, Gauge, generate_latest, CONTENT_TYPE_LATEST
 
@@ -12,7 +20,15 @@ from prometheus_client import Counter, Histogram, Gauge, generate_latest, CONTEN
 REQUESTS = Counter("rag_requests_total", "Total RAG requests")
 ERRORS = Counter("rag_errors_total", "Total RAG request errors")
 LATENCY = Histogram("rag_latency_seconds", "RAG end-to-end latency (seconds)")
+TTFT = Histogram(
+    "rag_ttft_seconds", "Time to first answer token on /rag/stream (seconds)",
+    buckets=(0.05, 0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10),
+)
 TOKENS = Histogram("rag_total_tokens", "Total tokens per call", buckets=(0, 250, 500, 1000, 2000, 4000, 8000))
+CONTEXT_TOKENS = Histogram(
+    "rag_context_tokens", "CONTEXT tokens per call: packed (sent) vs original (all hits in full)", ["kind"],
+    buckets=(0, 250, 500, 1000, 1500, 2000, 4000, 8000),
+)
 HEALTH = Gauge("app_healthy", "1 if app considers itself healthy")
 
 # feedback + persistence counters
@@ -24,7 +40,18 @@ FEEDBACK_UP.inc(0); FEEDBACK_DOWN.inc(0); CONV_SAVED.inc(0)
 
 load_dotenv()
 
-app = FastAPI(title="Music Theory Assistant API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    setup_tracing("music-theory-api")  # stage spans; no-op unless TRACING_EXPORTER is set
+    # load + warm the embedding model(s) off the event loop; /health reports 503 until it's done
+    warmup = asyncio.create_task(asyncio.to_thread(warmup_models))
+    yield
+    warmup.cancel()
+    await asyncio.to_thread(close_write_behind)  # flush buffered rows before the pool goes away
+    await close_async_pool()
+    close_pool()
+
+app = FastAPI(title="Music Theory Assistant API", lifespan=lifespan)
 
 class Query(BaseModel):
     question: str
@@ -38,32 +65,138 @@ def metrics():
     return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 @app.get("/health")
-def health():
-    HEALTH.set(1.0)
-    return {"ok": True}    
+def health(response: Response):
+    ready = models_ready()
+    HEALTH.set(1.0 if ready else 0.0)
+    if not ready:
+        response.status_code = 503
+    return {"ok": ready, "embedder_ready": ready}
 
 @app.post("/rag")
-@LATENCY.time()
-def rag_endpoint(q: Query):
+async def rag_endpoint(q: Query):
     REQUESTS.inc()
-    try:
-        answer_data, hits = rag(q.question)
-        TOKENS.observe(answer_data["total_tokens"])
-    except Exception as e:
-        ERRORS.inc()
-        raise HTTPException(status_code=500, detail=f"RAG error: {e}")
+    with LATENCY.time():
+        try:
+            answer_data, hits = await arag(q.question)
+            _observe_tokens(answer_data)
+        except LLMUnavailableError as e:  # breaker open or request budget spent: tell clients to back off
+            ERRORS.inc()
+            raise HTTPException(status_code=503, detail=f"LLM unavailable: {e}")
+        except Exception as e:
+            ERRORS.inc()
+            raise HTTPException(status_code=500, detail=f"RAG error: {e}")
 
-    conv_id = str(uuid.uuid4())
-    try:
-        save_conversation(conv_id, q.question, answer_data)
-        CONV_SAVED.inc()  # track successful persistence
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"DB save failed: {e}")
+        conv_id = str(uuid.uuid4())
+        try:
+            await asave_conversation(conv_id, q.question, answer_data)
+            CONV_SAVED.inc()  # track successful persistence
+        except WriteBehindFull as e:
+            raise HTTPException(status_code=503, detail=f"DB save deferred queue full: {e}")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"DB save failed: {e}")
 
     return {
         "conversation_id": conv_id,
         "answer": answer_data["answer"],
+        **_usage_and_cost(answer_data),
+        "sources": [h.payload for h in hits],
+    }
+
+@app.post("/rag/stream")
+async def rag_stream_endpoint(q: Query):
+    """
+    Server-sent events: `sources` first, then one `token` event per answer
+    delta, then `done` with usage, cost and conversation_id (or `error`).
+    """
+    REQUESTS.inc()
+    t0 = time.perf_counter()
+
+    async def events():
+        answer_data = None
+        first_token = True
+        try:
+            async for kind, data in arag_stream(q.question):
+                if kind == "sources":
+                    yield _sse("sources", {"sources": [h.payload for h in data]})
+                elif kind == "token":
+                    if first_token:
+                        TTFT.observe(time.perf_counter() - t0)
+                        first_token = False
+                    yield _sse("token", {"text": data})
+                else:
+                    answer_data = data
+            _observe_tokens(answer_data)
+        except Exception as e:
+            ERRORS.inc()
+            LATENCY.observe(time.perf_counter() - t0)
+            yield _sse("error", {"detail": f"RAG error: {e}"})
+            return
+
+        conv_id = str(uuid.uuid4())
+        try:
+            await asave_conversation(conv_id, q.question, answer_data)
+            CONV_SAVED.inc()
+        except WriteBehindFull as e:
+            yield _sse("error", {"detail": f"DB save deferred queue full: {e}"})
+            return
+        except Exception as e:
+            yield _sse("error", {"detail": f"DB save failed: {e}"})
+            return
+        finally:
+            LATENCY.observe(time.perf_counter() - t0)
+
+        yield _sse("done", {"conversation_id": conv_id, **_usage_and_cost(answer_data)})
+
+    # no-cache / no proxy buffering so tokens reach the client as they're produced
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
+
+@app.post("/rag/batch")
+async def rag_batch_endpoint(request: Request, persist: bool = False):
+    """
+    Body: CSV (Content-Type: text/csv) with a `question` column, or JSONL with
+    a "question" field per line. Streams one JSON line per question, in input
+    order; failed questions carry an "error" field. ?persist=true bulk-saves answers.
+    """
+    fmt = "csv" if "csv" in request.headers.get("content-type", "") else "jsonl"
+    try:
+        rows = parse_questions((await request.body()).decode("utf-8"), fmt)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid batch input: {e}")
+    if not rows:
+        raise HTTPException(status_code=400, detail="No questions in batch")
+    if len(rows) > BATCH_MAX_QUESTIONS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_QUESTIONS} questions per batch")
+
+    REQUESTS.inc(len(rows))
+
+    async def lines():
+        try:
+            # saves are counted per successful bulk insert, not per streamed record
+            async for record in run_batch(rows, persist=persist, on_saved=CONV_SAVED.inc):
+                if "error" in record:
+                    ERRORS.inc()
+                else:
+                    _observe_tokens(record)
+                yield json.dumps(record, ensure_ascii=False) + "\n"
+        except Exception as e:
+            ERRORS.inc()
+            yield json.dumps({"error": f"Batch error: {e}"}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+def _observe_tokens(answer_data: dict):
+    TOKENS.observe(answer_data["total_tokens"])
+    CONTEXT_TOKENS.labels("packed").observe(answer_data.get("context_tokens", 0))
+    CONTEXT_TOKENS.labels("original").observe(answer_data.get("context_tokens_original", 0))
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def _usage_and_cost(answer_data: dict) -> dict:
+    return {
         "model": answer_data["model_used"],
+        "route": answer_data.get("route", "default"),
         "response_time": answer_data["response_time"],
         "usage": {
             "prompt_tokens": answer_data["prompt_tokens"],
@@ -78,20 +211,21 @@ def rag_endpoint(q: Query):
             "explanation": answer_data["relevance_explanation"],
         },
         "openai_cost": answer_data["openai_cost"],
-        "sources": [h.payload for h in hits],
     }
 
 @app.post("/feedback")
-def feedback_endpoint(fb: Feedback):
+async def feedback_endpoint(fb: Feedback):
     if fb.feedback not in (1, -1):
         raise HTTPException(status_code=400, detail="feedback must be 1 or -1")
     try:
-        save_feedback(fb.conversation_id, fb.feedback)
+        await asave_feedback(fb.conversation_id, fb.feedback)
         # increment the right counter
         if fb.feedback > 0:
             FEEDBACK_UP.inc()
         else:
             FEEDBACK_DOWN.inc()
+    except WriteBehindFull as e:
+        raise HTTPException(status_code=503, detail=f"DB save deferred queue full: {e}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"DB save failed: {e}")
     return {"ok": True}
@@ -3,8 +3,13 @@ import os, time, uuid
 import streamlit as st
 from dotenv import load_dotenv
 
-from rag import rag
-from db import save_conversation, save_feedback
+from rag import rag_stream, warmup_models, ROUTER_METRICS
+from fast_path import FAST_PATH_METRICS
+from resilience import RESILIENCE_METRICS
+from metrics import STAGE_METRICS, setup_tracing
+from db import save_conversation, save_feedback, POOL_METRICS, WRITE_BEHIND_METRICS
+from cache import CACHE_METRICS
+from embedder import EMBEDDER_METRICS
 
 # Prometheus (UI-side)
 from prometheus_client import (
@@ -30,7 +35,14 @@ def _init_ui_metrics():
         "UI_FEEDBACK_UP": Counter("ui_feedback_up_total", "Thumbs-up clicked in UI", registry=reg),
         "UI_FEEDBACK_DOWN": Counter("ui_feedback_down_total", "Thumbs-down clicked in UI", registry=reg),
         "UI_LATENCY": Histogram("ui_latency_seconds", "UI-perceived latency (submit→answer)", registry=reg),
+        "UI_TTFT": Histogram("ui_ttft_seconds", "UI-perceived time to first answer token", registry=reg),
     }
+    # process-wide components (db pool, write-behind, caches, embedder, model router, template fast path,
+    # OpenAI resilience, pipeline stages); expose their metrics here too
+    for collector in (POOL_METRICS + WRITE_BEHIND_METRICS + CACHE_METRICS + EMBEDDER_METRICS + ROUTER_METRICS
+                      + FAST_PATH_METRICS + RESILIENCE_METRICS + STAGE_METRICS):
+        reg.register(collector)
+    setup_tracing("music-theory-ui")  # stage spans; no-op unless TRACING_EXPORTER is set
     return reg, metrics
 
 # Initialize once per process/session
@@ -39,11 +51,20 @@ if "ui_prom_registry" not in st.session_state:
     st.session_state["ui_prom_registry"] = reg
     st.session_state["ui_metrics"] = metrics
 
+# Load + warm the embedding model(s) once per process, before the first question
+@st.cache_resource(show_spinner="Loading embedding model...")
+def _warm_models():
+    warmup_models()
+    return True
+
+_warm_models()
+
 # convenient handles
 UI_QUERIES = st.session_state["ui_metrics"]["UI_QUERIES"]
 UI_FEEDBACK_UP = st.session_state["ui_metrics"]["UI_FEEDBACK_UP"]
 UI_FEEDBACK_DOWN = st.session_state["ui_metrics"]["UI_FEEDBACK_DOWN"]
 UI_LATENCY = st.session_state["ui_metrics"]["UI_LATENCY"]
+UI_TTFT = st.session_state["ui_metrics"]["UI_TTFT"]
 
 # ---------- Streamlit UI ----------
 st.set_page_config(page_title="Music Theory Assistant", page_icon="🎵")
@@ -56,13 +77,28 @@ if st.button("Ask") and question.strip():
     t0 = time.time()
     UI_QUERIES.inc()
 
+    # sources arrive first, then answer tokens, then the full answer_data
+    events = rag_stream(question)
     with st.spinner("Thinking…"):
-        answer_data, hits = rag(question)
+        _, hits = next(events)
 
-    UI_LATENCY.observe(time.time() - t0)
+    answer_data = {}
+
+    def answer_tokens():
+        first_token = True
+        for kind, data in events:
+            if kind == "token":
+                if first_token:
+                    UI_TTFT.observe(time.time() - t0)
+                    first_token = False
+                yield data
+            else:
+                answer_data.update(data)
 
     st.subheader("Answer")
-    st.write(answer_data["answer"])
+    st.write_stream(answer_tokens())
+
+    UI_LATENCY.observe(time.time() - t0)
 
     st.subheader("Sources")
     if not hits:
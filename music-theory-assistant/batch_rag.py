@@ -0,0 +1,286 @@
+# batch_rag.py — Offline batch question answering
+#
+# Usage (from music-theory-assistant/):
+#   python -m batch_rag ../data/ground-truth-retrieval.csv -o ../data/batch-answers.jsonl
+#   python -m batch_rag questions.jsonl --concurrency 32 --persist
+#
+# Input is a CSV with a `question` column or JSONL with a "question" field;
+# other columns/fields (e.g. `id`) are copied to the output. Questions are
+# embedded in one pass, retrieved with Qdrant query_batch_points (or one
+# matrix product per batch with RETRIEVER_BACKEND=local|lexical), and answered
+# with at most BATCH_CONCURRENCY LLM calls in flight. Results are written as
+# JSONL in input order as soon as each prefix is done.
+import os
+import io
+import csv
+import sys
+import json
+import time
+import uuid
+import asyncio
+import argparse
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from qdrant_client import models
+
+from embedder import DENSE_VECTOR
+from metrics import stage, start_stages
+from rag import (
+    embedder, sparse_embedder, aqd_client, local_index, lexical_index, build_context, context_tokens,
+    render_prompt, hybrid_query, arerank_hits, atemplate_answer, route_model, observe_route, _aanswer,
+    _query_filter, _candidate_limit, _filtered_limit, _trim_hits,
+    SEARCH_PARAMS, QDRANT_COLLECTION, TOP_K, RETRIEVAL_MODE, RERANK,
+)
+
+load_dotenv()
+
+# ---- Config ----
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "16"))  # LLM calls in flight
+BATCH_QUERY_SIZE = int(os.getenv("BATCH_QUERY_SIZE", "64"))  # searches per query_batch_points request
+BATCH_PERSIST_SIZE = int(os.getenv("BATCH_PERSIST_SIZE", "200"))  # rows per bulk DB insert
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", "5000"))  # per /rag/batch request
+
+
+# --------- Input ---------
+def parse_questions(text: str, fmt: str) -> List[Dict[str, Any]]:
+    """Parses CSV (fmt='csv') or JSONL text into rows that each have a 'question'."""
+    if fmt == "csv":
+        rows = list(csv.DictReader(io.StringIO(text.lstrip("\ufeff"))))
+    else:
+        rows = [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    for n, row in enumerate(rows, start=1):
+        if not str(row.get("question") or "").strip():
+            raise ValueError(f"row {n} has no 'question'")
+    return rows
+
+
+def read_questions(path: str, fmt: Optional[str] = None) -> List[Dict[str, Any]]:
+    if fmt is None:
+        fmt = "csv" if path.lower().endswith(".csv") else "jsonl"
+    with open(path, encoding="utf-8") as f:
+        return parse_questions(f.read(), fmt)
+
+
+# --------- Retrieval ---------
+async def abatch_search(questions: List[str], top_k: int = TOP_K) -> List[List[models.ScoredPoint]]:
+    """
+    One embedding pass for all questions, then query_batch_points in
+    BATCH_QUERY_SIZE chunks (dense or hybrid per RETRIEVAL_MODE, with the same
+    parse_filter() restrictions, empty-result fallback and RERANK stage as
+    rag.search()).
+    """
+    filters = [_query_filter(q) for q in questions]
+    hits = await _abatch_candidates(questions, filters, _candidate_limit(top_k))
+    if RERANK:
+        hits = await asyncio.gather(*(
+            # offline: the pool bounds CPU, no per-question latency budget
+            arerank_hits(q, h, top_k, f, budget_ms=None) for q, h, f in zip(questions, hits, filters)
+        ))
+    return hits
+
+
+async def _abatch_candidates(questions: List[str], filters: List[Optional[models.Filter]],
+                             top_k: int) -> List[List[models.ScoredPoint]]:
+    """Retrieval part of abatch_search(); `filters` entries are reset to None where the fallback ran."""
+    if lexical_index is not None:
+        return await asyncio.to_thread(_local_batch_search, lexical_index, questions, filters, top_k)
+    vectors = await asyncio.to_thread(embedder.embed_many, questions)
+    if local_index is not None:
+        return await asyncio.to_thread(_local_batch_search, local_index, vectors, filters, top_k)
+
+    sparse_vectors = [None] * len(questions)
+    if RETRIEVAL_MODE == "hybrid":
+        sparse_vectors = await asyncio.to_thread(sparse_embedder.embed_queries, questions)
+
+    def request(i, query_filter):
+        if RETRIEVAL_MODE == "hybrid":
+            return models.QueryRequest(**hybrid_query(vectors[i], sparse_vectors[i], top_k, query_filter=query_filter))
+        return models.QueryRequest(
+            query=vectors[i], using=DENSE_VECTOR, filter=query_filter, params=SEARCH_PARAMS,
+            limit=_filtered_limit(query_filter, top_k), with_payload=True,
+        )
+
+    hits = await _query_batch([request(i, f) for i, f in enumerate(filters)])
+    hits = [_trim_hits(h, f, top_k) for h, f in zip(hits, filters)]
+
+    retry = [i for i, (h, f) in enumerate(zip(hits, filters)) if not h and f is not None]
+    if retry:
+        for i, h in zip(retry, await _query_batch([request(i, None) for i in retry])):
+            hits[i] = h
+            filters[i] = None
+    return hits
+
+
+def _local_batch_search(index, queries, filters, top_k: int) -> List[List[models.ScoredPoint]]:
+    """
+    abatch_search() for the in-process backends: `queries` are vectors for a
+    LocalIndex or question texts for a LexicalRetriever.
+    """
+    hits: List[List[models.ScoredPoint]] = []
+    for start in range(0, len(queries), BATCH_QUERY_SIZE):
+        chunk = slice(start, start + BATCH_QUERY_SIZE)
+        limit = max(_filtered_limit(f, top_k) for f in filters[chunk])
+        hits.extend(index.search_batch(queries[chunk], limit, filters[chunk]))
+    hits = [_trim_hits(h[:_filtered_limit(f, top_k)], f, top_k) for h, f in zip(hits, filters)]
+
+    retry = [i for i, (h, f) in enumerate(zip(hits, filters)) if not h and f is not None]
+    if retry:
+        for i, h in zip(retry, index.search_batch([queries[i] for i in retry], top_k)):
+            hits[i] = h
+            filters[i] = None
+    return hits
+
+
+async def _query_batch(requests: List[models.QueryRequest]) -> List[List[models.ScoredPoint]]:
+    hits: List[List[models.ScoredPoint]] = []
+    for start in range(0, len(requests), BATCH_QUERY_SIZE):
+        responses = await aqd_client.query_batch_points(
+            collection_name=QDRANT_COLLECTION,
+            requests=requests[start:start + BATCH_QUERY_SIZE],
+        )
+        hits.extend(response.points for response in responses)
+    return hits
+
+
+# --------- Answering ---------
+async def _answer(question: str, hits, model: Optional[str]) -> Tuple[Dict[str, Any], List[models.ScoredPoint]]:
+    """
+    Steps 2–6 of rag.arag() (routing, cascade) for an already retrieved
+    question; returns (answer_data, hits). Embedding and search ran for the
+    whole batch, so only the prompt / answer / judge stages are timed per
+    question. OpenAI errors are retried by rag.llm_caller (resilience.py) only.
+    """
+    start_stages()
+    t0 = time.time()
+    route, model = route_model(question, model)
+    with stage("prompt"):
+        context = build_context(hits)
+        prompt = render_prompt(question, context)
+    answer_data = await _aanswer(question, prompt, route, model, t0, context_tokens(hits, context))
+    observe_route(answer_data)
+    return answer_data, hits
+
+
+async def arag_batch(questions: List[str], model: Optional[str] = None, top_k: int = TOP_K,
+                     concurrency: int = BATCH_CONCURRENCY):
+    """
+    Answers `questions` and yields (answer_data, hits, error) in input order.
+    Template answers (rag.atemplate_answer) are looked up first and skip
+    retrieval, as in rag.arag(); their hits are the song they came from.
+    A question that still fails after retries yields (None, hits, "error message")
+    instead of aborting the batch.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    templated = await asyncio.gather(*(atemplate_answer(q) for q in questions))
+    retrieve = [q for q, t in zip(questions, templated) if t is None]
+    searched = iter(await abatch_search(retrieve, top_k) if retrieve else [])
+
+    async def one(question, hits):
+        async with semaphore:
+            try:
+                return (*await _answer(question, hits, model), None)
+            except Exception as e:
+                return None, hits, f"{type(e).__name__}: {e}"
+
+    async def ready(answer_data, hits):
+        return answer_data, hits, None
+
+    tasks = [
+        asyncio.create_task(ready(*t) if t is not None else one(q, next(searched)))
+        for q, t in zip(questions, templated)
+    ]
+    try:
+        for task in tasks:
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def run_batch(rows: List[Dict[str, Any]], model: Optional[str] = None, top_k: int = TOP_K,
+                    concurrency: int = BATCH_CONCURRENCY, persist: bool = False,
+                    on_saved: Optional[Callable[[int], Any]] = None):
+    """
+    arag_batch() over input rows; yields one output record (dict) per row, in
+    order. With persist=True, answers are saved in bulk and get a conversation_id;
+    on_saved(n) is called once each bulk insert of n rows has succeeded.
+    """
+    if persist:
+        from db import asave_conversations
+
+    async def save(batch):
+        await asave_conversations(batch)
+        if on_saved is not None:
+            on_saved(len(batch))
+
+    pending = []
+    try:
+        questions = [str(row["question"]) for row in rows]
+        results = arag_batch(questions, model=model, top_k=top_k, concurrency=concurrency)
+        i = 0
+        async for answer_data, hits, error in results:
+            row = rows[i]
+            i += 1
+            record = dict(row)
+            if error is not None:
+                record["error"] = error
+            else:
+                if persist:
+                    record["conversation_id"] = str(uuid.uuid4())
+                    pending.append((record["conversation_id"], row["question"], answer_data))
+                    if len(pending) >= BATCH_PERSIST_SIZE:
+                        await save(pending)
+                        pending = []
+                record.update(answer_data)
+            record["source_ids"] = [h.id for h in hits]
+            yield record
+    finally:
+        if pending:
+            await save(pending)
+
+
+# --------- CLI ---------
+async def _main(args):
+    rows = read_questions(args.input, args.format)
+    if args.limit:
+        rows = rows[: args.limit]
+
+    out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    t0 = time.perf_counter()
+    done = errors = 0
+    try:
+        async for record in run_batch(rows, model=args.model, top_k=args.top_k,
+                                      concurrency=args.concurrency, persist=args.persist):
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            done += 1
+            errors += "error" in record
+    finally:
+        if args.output:
+            out.close()
+        if args.persist:
+            from db import close_async_pool
+            await close_async_pool()
+
+    took = time.perf_counter() - t0
+    print(f"Answered {done} questions ({errors} errors) in {took:.1f}s ({done / took:.1f} q/s)", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer a CSV/JSONL file of questions with the RAG flow.")
+    parser.add_argument("input", help="CSV with a 'question' column, or JSONL with a 'question' field")
+    parser.add_argument("-o", "--output", help="JSONL output path (default: stdout)")
+    parser.add_argument("--format", choices=["csv", "jsonl"], help="input format (default: from extension)")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY)
+    parser.add_argument("--top-k", type=int, default=TOP_K)
+    parser.add_argument("--model", help="answer every question with this model (default: OPENAI_MODEL, or routed "
+                                        "with MODEL_ROUTING=1)")
+    parser.add_argument("--limit", type=int, help="only answer the first N questions")
+    parser.add_argument("--persist", action="store_true", help="bulk-save answers to the conversations table")
+    asyncio.run(_main(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
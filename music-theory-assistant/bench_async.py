@@ -0,0 +1,107 @@
+# bench_async.py — Sync rag() vs async arag() throughput against local stubs
+#
+# Usage (from the project root):
+#   python music-theory-assistant/bench_async.py --requests 200 --concurrency 10 50 100
+#
+# rag() is driven from a thread pool sized like FastAPI's default (40 workers),
+# which is what the old sync /rag route was limited by; arag() runs on a single
+# event loop. Both talk to the stubs in stub_servers.py, so no network,
+# OpenAI key or Qdrant server is needed. The stubs run as separate processes
+# so they don't compete with the client for the GIL.
+import os
+import sys
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub_servers import serve_in_process
+
+GROUND_TRUTH_PATH = os.getenv("GROUND_TRUTH_PATH", "data/ground-truth-retrieval.csv")
+
+
+def summarize(label, concurrency, latencies, wall):
+    lat = np.array(latencies)
+    print(
+        f"{label:<6} conc={concurrency:<4} n={len(lat):<5} "
+        f"qps={len(lat) / wall:7.1f}  "
+        f"p50={np.percentile(lat, 50) * 1000:7.1f}ms  "
+        f"p95={np.percentile(lat, 95) * 1000:7.1f}ms  "
+        f"p99={np.percentile(lat, 99) * 1000:7.1f}ms"
+    )
+
+
+def run_sync(rag, questions, concurrency, threads):
+    def one(q):
+        t0 = time.perf_counter()
+        rag(q)
+        return time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=min(concurrency, threads)) as pool:
+        latencies = list(pool.map(one, questions))
+    return latencies, time.perf_counter() - t0
+
+
+async def run_async(arag, questions, concurrency):
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(q):
+        async with sem:
+            t0 = time.perf_counter()
+            await arag(q)
+            return time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    latencies = await asyncio.gather(*(one(q) for q in questions))
+    return latencies, time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sync rag() vs async arag() against stub servers.")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 50, 100])
+    parser.add_argument("--threads", type=int, default=40, help="thread pool size for the sync path")
+    parser.add_argument("--llm-latency-ms", type=float, default=300.0)
+    parser.add_argument("--qdrant-latency-ms", type=float, default=5.0)
+    parser.add_argument("--openai-port", type=int, default=18081)
+    parser.add_argument("--qdrant-port", type=int, default=16335)
+    args = parser.parse_args()
+
+    openai_srv = serve_in_process("openai", args.openai_port, "--latency-ms", str(args.llm_latency_ms))
+    qdrant_srv = serve_in_process("qdrant", args.qdrant_port, "--latency-ms", str(args.qdrant_latency_ms))
+
+    # rag reads its config at import time, so point it at the stubs first
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{args.openai_port}/v1"
+    os.environ["OPENAI_API_KEY"] = "stub"
+    os.environ["QDRANT_URL"] = f"http://127.0.0.1:{args.qdrant_port}"
+    from rag import rag, arag
+
+    questions = pd.read_csv(GROUND_TRUTH_PATH)["question"].tolist()
+    questions = (questions * (args.requests // len(questions) + 1))[: args.requests]
+
+    # warm-up: loads the embedding model and opens client connections
+    rag(questions[0])
+
+    # the async clients in rag.py bind to one event loop, so every async run shares it
+    async def run_all_async():
+        await arag(questions[0])
+        return [await run_async(arag, questions, c) for c in args.concurrency]
+
+    try:
+        sync_results = [run_sync(rag, questions, c, args.threads) for c in args.concurrency]
+        async_results = asyncio.run(run_all_async())
+        for concurrency, (s, a) in zip(args.concurrency, zip(sync_results, async_results)):
+            summarize("sync", concurrency, *s)
+            summarize("async", concurrency, *a)
+    finally:
+        openai_srv.terminate()
+        qdrant_srv.terminate()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+# bench_quantization.py — Memory / latency / recall trade-offs of Qdrant storage settings
+#
+# Usage (from the project root, after ingest.py has built the collection):
+#   python music-theory-assistant/bench_quantization.py --top-k 5
+#   python music-theory-assistant/bench_quantization.py --configs float32 scalar binary
+#
+# Each configuration gets a scratch copy of the live collection
+# (<QDRANT_COLLECTION>-bench-<config>, vectors copied, nothing re-embedded),
+# built with its quantization / on-disk / HNSW settings. The ground-truth
+# questions are embedded once and replayed against every copy:
+#   recall@k / MRR  - against the ground-truth document ids
+#   ann_recall      - overlap with exact (brute-force, full-precision) search,
+#                     i.e. what the index + quantization lose
+#   p50 / p99       - query_points round trip
+#   memory          - RAM estimate from the collection config (vectors,
+#                     quantized copy, HNSW links, payload); Qdrant does not
+#                     report per-collection memory
+# The copies are dropped afterwards unless --keep is given.
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+from qdrant_client import models
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from embedder import DENSE_VECTOR
+from ingest import EMBED_DIM, INGEST_UPSERT_BATCH_SIZE, collection_tuning, ensure_collection, wait_until_ready
+from rag import embedder, qd_client, search_params, QDRANT_COLLECTION
+
+GROUND_TRUTH_PATH = os.getenv("GROUND_TRUTH_PATH", "data/ground-truth-retrieval.csv")
+
+# name -> (collection tuning overrides, query-time search_params() overrides)
+CONFIGS = {
+    "float32": ({"quantization": "none"}, {}),
+    "scalar": ({"quantization": "scalar"}, {"oversampling": 2.0}),
+    "scalar-ondisk": ({"quantization": "scalar", "on_disk": True, "on_disk_payload": True}, {"oversampling": 2.0}),
+    "binary": ({"quantization": "binary"}, {"oversampling": 3.0}),
+    "hnsw-m32": ({"quantization": "none", "m": 32, "ef_construct": 200}, {"hnsw_ef": 128}),
+}
+
+
+def copy_collection(source: str, target: str) -> int:
+    """Copies every point (vectors + payload) from `source` into `target`."""
+    offset, copied = None, 0
+    while True:
+        points, offset = qd_client.scroll(
+            source, limit=INGEST_UPSERT_BATCH_SIZE, offset=offset, with_vectors=True, with_payload=True,
+        )
+        if points:
+            qd_client.upsert(
+                target,
+                points=[models.PointStruct(id=p.id, vector=p.vector, payload=p.payload) for p in points],
+                wait=True,
+            )
+            copied += len(points)
+        if offset is None:
+            return copied
+
+
+def estimate_memory(points: int, payload_bytes: int, tuning) -> int:
+    """Approximate resident bytes for the dense index of one collection."""
+    total = 0
+    if not tuning["on_disk"]:
+        total += points * EMBED_DIM * 4  # float32 originals
+    if tuning["always_ram"]:
+        if tuning["quantization"] == "scalar":
+            total += points * EMBED_DIM  # int8
+        elif tuning["quantization"] == "binary":
+            total += points * EMBED_DIM // 8  # 1 bit per dimension
+    total += points * tuning["m"] * 2 * 4  # HNSW links, layer 0 holds 2*m neighbours
+    if not tuning["on_disk_payload"]:
+        total += payload_bytes
+    return total
+
+
+def run(name: str, vectors, doc_ids, top_k: int, params: models.SearchParams):
+    exact = search_params(exact=True)
+    latencies, ranks, overlap = [], [], []
+    for vector, doc_id in zip(vectors, doc_ids):
+        t0 = time.perf_counter()
+        hits = qd_client.query_points(
+            name, query=vector, using=DENSE_VECTOR, search_params=params, limit=top_k,
+        ).points
+        latencies.append(time.perf_counter() - t0)
+        truth = qd_client.query_points(
+            name, query=vector, using=DENSE_VECTOR, search_params=exact, limit=top_k,
+        ).points
+
+        ids = [h.id for h in hits]
+        ranks.append(ids.index(doc_id) + 1 if doc_id in ids else None)
+        overlap.append(len(set(ids) & {t.id for t in truth}) / max(len(truth), 1))
+
+    lat = np.array(latencies)
+    return {
+        "recall": sum(r is not None for r in ranks) / len(ranks),
+        "mrr": sum(1 / r for r in ranks if r is not None) / len(ranks),
+        "ann_recall": float(np.mean(overlap)),
+        "p50_ms": np.percentile(lat, 50) * 1000,
+        "p99_ms": np.percentile(lat, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare Qdrant quantization / on-disk / HNSW settings.")
+    parser.add_argument("--configs", nargs="+", choices=list(CONFIGS), default=list(CONFIGS))
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--limit", type=int, default=None, help="only use the first N questions")
+    parser.add_argument("--keep", action="store_true", help="keep the bench collections afterwards")
+    args = parser.parse_args()
+
+    gt = pd.read_csv(GROUND_TRUTH_PATH)
+    if args.limit:
+        gt = gt.head(args.limit)
+    vectors = embedder.embed_many(gt["question"].tolist())
+    doc_ids = gt["id"].astype(int).tolist()
+
+    sample = qd_client.scroll(QDRANT_COLLECTION, limit=100, with_payload=True)[0]
+    payload_per_point = np.mean([len(str(p.payload)) for p in sample]) if sample else 0
+
+    print(f"{len(vectors)} questions, top_k={args.top_k}, source '{QDRANT_COLLECTION}'")
+    results = {}
+    for config in args.configs:
+        overrides, query = CONFIGS[config]
+        tuning = collection_tuning(**overrides)
+        name = f"{QDRANT_COLLECTION}-bench-{config}"
+        if qd_client.collection_exists(name):
+            qd_client.delete_collection(name)
+        try:
+            ensure_collection(qd_client, name, tuning)
+            points = copy_collection(QDRANT_COLLECTION, name)
+            wait_until_ready(qd_client, name)
+
+            params = search_params(**query)
+            run(name, vectors[:1], doc_ids[:1], args.top_k, params)  # warm up
+            results[config] = run(name, vectors, doc_ids, args.top_k, params)
+            results[config]["memory"] = estimate_memory(points, int(points * payload_per_point), tuning)
+        finally:
+            if not args.keep:
+                qd_client.delete_collection(name)
+
+    print(f"{'config':<14} {'memory':>9} {'recall@k':>9} {'MRR':>7} {'ann@k':>7} {'p50':>9} {'p99':>9}")
+    for config, r in results.items():
+        print(
+            f"{config:<14} {r['memory'] / 2**20:>7.1f}MB {r['recall']:>9.3f} {r['mrr']:>7.3f} {r['ann_recall']:>7.3f} "
+            f"{r['p50_ms']:>7.1f}ms {r['p99_ms']:>7.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
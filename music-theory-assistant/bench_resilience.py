@@ -0,0 +1,136 @@
+# bench_resilience.py — rag.allm() under injected OpenAI faults, with and without resilience.py
+#
+# Usage (from the project root):
+#   python music-theory-assistant/bench_resilience.py --requests 400 --concurrency 20 \
+#       --error-rate 0.05 --rate-limit-rate 0.05 --slow-rate 0.03 --slow-ms 3000
+#
+# Starts the fault-injecting OpenAI stub (stub_servers.py) and sends the same
+# ground-truth questions through rag.allm() with three callers swapped in for
+# rag.llm_caller: no retries ("bare"), retries ("retry") and retries plus
+# hedging at the observed p95 ("hedge"). Per policy it prints the success
+# rate, latency percentiles of the successful calls and the retries / hedges
+# counted by the resilience metrics. --outage then points the calls at a stub
+# that fails every request, to show the circuit breaker failing fast.
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+import numpy as np
+import pandas as pd
+from prometheus_client import REGISTRY
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub_servers import serve_in_process
+
+GROUND_TRUTH_PATH = os.getenv("GROUND_TRUTH_PATH", "data/ground-truth-retrieval.csv")
+
+
+def _counter(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def _counters():
+    return {
+        "retries": sum(_counter("llm_retries_total", reason=r)
+                       for r in ("rate_limit", "server_error", "timeout", "connection")),
+        "hedges": _counter("llm_hedges_total", result="fired"),
+        "hedges_won": _counter("llm_hedges_total", result="won"),
+        "rejected": _counter("llm_circuit_breaker_rejections_total"),
+    }
+
+
+async def run(rag, caller, questions, concurrency):
+    rag.llm_caller = caller
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def one(question):
+        nonlocal errors
+        async with semaphore:
+            t0 = time.perf_counter()
+            try:
+                await rag.allm(question)
+            except Exception:
+                errors += 1
+                return
+            latencies.append(time.perf_counter() - t0)
+
+    before = _counters()
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(q) for q in questions))
+    wall = time.perf_counter() - t0
+    after = _counters()
+    return latencies, errors, wall, {k: after[k] - before[k] for k in after}
+
+
+def summarize(label, latencies, errors, wall, counts):
+    lat = np.array(latencies or [0.0]) * 1000
+    total = len(latencies) + errors
+    print(
+        f"{label:<7} ok={len(latencies) / total:6.1%}  wall={wall:5.1f}s  "
+        f"p50={np.percentile(lat, 50):7.1f}ms  p95={np.percentile(lat, 95):7.1f}ms  "
+        f"p99={np.percentile(lat, 99):7.1f}ms  max={lat.max():7.1f}ms  "
+        f"retries={counts['retries']:.0f} hedges={counts['hedges']:.0f} (won {counts['hedges_won']:.0f}) "
+        f"rejected={counts['rejected']:.0f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the OpenAI resilience layer against a faulty stub.")
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=200)
+    parser.add_argument("--error-rate", type=float, default=0.05)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.05)
+    parser.add_argument("--slow-rate", type=float, default=0.03)
+    parser.add_argument("--slow-ms", type=float, default=3000)
+    parser.add_argument("--outage", action="store_true", help="also run against a stub failing every request")
+    parser.add_argument("--port", type=int, default=18083)
+    args = parser.parse_args()
+
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{args.port}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+    import rag  # after OPENAI_BASE_URL, the clients are created at import
+
+    questions = pd.read_csv(GROUND_TRUTH_PATH)["question"].tolist()
+    questions = (questions * (args.requests // len(questions) + 1))[:args.requests]
+    asyncio.run(scenarios(rag, args, questions))  # one loop: AsyncOpenAI's connections are bound to it
+
+
+async def scenarios(rag, args, questions):
+    from resilience import CircuitBreaker, ResilientCaller
+
+    no_breaker = dict(failure_rate=1.1)  # never opens: compare retry / hedge policies only
+    stub = serve_in_process(
+        "openai", args.port, "--latency-ms", str(args.latency_ms),
+        "--error-rate", str(args.error_rate), "--rate-limit-rate", str(args.rate_limit_rate),
+        "--slow-rate", str(args.slow_rate), "--slow-ms", str(args.slow_ms),
+    )
+    try:
+        policies = {
+            "bare": ResilientCaller(CircuitBreaker(**no_breaker), max_retries=0, hedge=False),
+            "retry": ResilientCaller(CircuitBreaker(**no_breaker), hedge=False),
+            "hedge": ResilientCaller(CircuitBreaker(**no_breaker), hedge=True),
+        }
+        for label, caller in policies.items():
+            if caller.hedge:  # learn the p95 first, like a warmed-up process
+                await run(rag, caller, questions[:100], args.concurrency)
+            summarize(label, *await run(rag, caller, questions, args.concurrency))
+    finally:
+        stub.terminate()
+        stub.wait()  # free the port for the outage stub
+
+    if args.outage:
+        stub = serve_in_process("openai", args.port, "--latency-ms", str(args.latency_ms), "--error-rate", "1")
+        try:
+            caller = ResilientCaller(CircuitBreaker(), retry_base=0.05)
+            summarize("outage", *await run(rag, caller, questions, args.concurrency))
+        finally:
+            stub.terminate()
+
+
+if __name__ == "__main__":
+    main()
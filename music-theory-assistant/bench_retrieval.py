@@ -0,0 +1,86 @@
+# bench_retrieval.py — Dense-only vs hybrid (dense + BM25) retrieval quality and latency
+#
+# Usage (from the project root, after ingest.py has built the collection):
+#   python music-theory-assistant/bench_retrieval.py --top-k 5
+#
+# Every ground-truth question is run through rag.vector_search() and
+# rag.hybrid_search() with RRF and DBSF fusion. Dense query vectors are
+# computed once up front and shared by all modes, so latencies compare the
+# Qdrant round trip (plus BM25 query encoding for the hybrid modes).
+#
+# `--modes lexical` adds the boosted TF-IDF index of lexical_index.py
+# (build it first with RETRIEVER_BACKEND=lexical python ingest.py).
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from rag import embedder, sparse_embedder, vector_search, hybrid_search
+from lexical_index import LexicalRetriever
+
+GROUND_TRUTH_PATH = os.getenv("GROUND_TRUTH_PATH", "data/ground-truth-retrieval.csv")
+
+MODES = {
+    "dense": lambda q, k, v: vector_search(q, k, v),
+    "hybrid-rrf": lambda q, k, v: hybrid_search(q, k, v, fusion="rrf"),
+    "hybrid-dbsf": lambda q, k, v: hybrid_search(q, k, v, fusion="dbsf"),
+    "lexical": lambda q, k, v: lexical.search(q, k),
+}
+DEFAULT_MODES = ["dense", "hybrid-rrf", "hybrid-dbsf"]
+
+lexical = LexicalRetriever()
+
+
+def evaluate(search, questions, doc_ids, vectors, top_k):
+    latencies, ranks = [], []
+    for question, doc_id, vector in zip(questions, doc_ids, vectors):
+        t0 = time.perf_counter()
+        hits = search(question, top_k, vector)
+        latencies.append(time.perf_counter() - t0)
+        ids = [h.id for h in hits]
+        ranks.append(ids.index(doc_id) + 1 if doc_id in ids else None)
+
+    lat = np.array(latencies)
+    return {
+        "recall": sum(r is not None for r in ranks) / len(ranks),  # one relevant doc: recall@k == hit rate
+        "mrr": sum(1 / r for r in ranks if r is not None) / len(ranks),
+        "p50_ms": np.percentile(lat, 50) * 1000,
+        "p95_ms": np.percentile(lat, 95) * 1000,
+        "qps": len(lat) / lat.sum(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare dense-only and hybrid retrieval on the ground truth.")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--limit", type=int, default=None, help="only use the first N questions")
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=DEFAULT_MODES)
+    args = parser.parse_args()
+
+    gt = pd.read_csv(GROUND_TRUTH_PATH)
+    if args.limit:
+        gt = gt.head(args.limit)
+    questions = gt["question"].tolist()
+    doc_ids = gt["id"].astype(int).tolist()
+
+    vectors = embedder.embed_many(questions)
+    sparse_embedder.warmup()
+
+    print(f"{len(questions)} questions, top_k={args.top_k}")
+    print(f"{'mode':<12} {'recall@k':>9} {'MRR':>7} {'p50':>9} {'p95':>9} {'qps':>8}")
+    for mode in args.modes:
+        MODES[mode](questions[0], args.top_k, vectors[0])  # warm the connection
+        r = evaluate(MODES[mode], questions, doc_ids, vectors, args.top_k)
+        print(
+            f"{mode:<12} {r['recall']:>9.3f} {r['mrr']:>7.3f} "
+            f"{r['p50_ms']:>7.1f}ms {r['p95_ms']:>7.1f}ms {r['qps']:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
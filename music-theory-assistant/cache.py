@@ -0,0 +1,382 @@
+# cache.py — Caches in front of rag()
+#
+# - SemanticCache: near-identical questions ("Which songs use deceptive
+#   cadences? 3?") reuse an earlier answer instead of paying for retrieval +
+#   two LLM calls. Entries live in a dedicated Qdrant collection, so every
+#   API/UI process shares them.
+# - RetrievalCache: exact (normalised) question + top_k -> hits and rendered
+#   context, in-process LRU with an optional shared Redis tier.
+#
+# Both are keyed on the collection version stamp that ingest.py writes, so a
+# re-ingest invalidates everything.
+import os
+import re
+import json
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from qdrant_client import models
+from prometheus_client import Counter
+
+from metrics import stage_ms
+
+# ---- Config ----
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "0") == "1"
+SEMANTIC_CACHE_COLLECTION = os.getenv(
+    "SEMANTIC_CACHE_COLLECTION",
+    os.getenv("QDRANT_COLLECTION", "zoomcamp-music-theory-assistant") + "-answer-cache",
+)
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.98"))  # min cosine similarity
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", "86400"))  # seconds
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "10000"))
+SEMANTIC_CACHE_EVICT_EVERY = int(os.getenv("SEMANTIC_CACHE_EVICT_EVERY", "100"))  # stores between capacity checks
+EMBED_DIM = int(os.getenv("EMBED_DIM", "512"))
+
+RETRIEVAL_CACHE = os.getenv("RETRIEVAL_CACHE", "1") == "1"
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "1024"))
+RETRIEVAL_CACHE_TTL = float(os.getenv("RETRIEVAL_CACHE_TTL", "3600"))  # seconds
+RETRIEVAL_CACHE_REDIS_URL = os.getenv("RETRIEVAL_CACHE_REDIS_URL", "")  # optional shared tier, e.g. redis://redis:6379/0
+
+VERSION_COLLECTION = os.getenv(
+    "VERSION_COLLECTION",
+    os.getenv("QDRANT_COLLECTION", "zoomcamp-music-theory-assistant") + "-meta",
+)
+VERSION_CHECK_SECONDS = float(os.getenv("CACHE_VERSION_CHECK_SECONDS", "10"))
+
+# ---- Metrics ----
+SEMANTIC_CACHE_LOOKUPS = Counter("semantic_cache_lookups_total", "Semantic answer cache lookups", ["result"])
+SEMANTIC_CACHE_EVICTIONS = Counter("semantic_cache_evictions_total", "Semantic cache entries evicted (LRU or TTL)")
+for _result in ("hit", "miss", "error"):
+    SEMANTIC_CACHE_LOOKUPS.labels(_result)
+
+RETRIEVAL_CACHE_LOOKUPS = Counter(
+    "retrieval_cache_lookups_total", "Retrieval/context cache lookups", ["result", "tier"]
+)
+for _result, _tier in (("hit", "local"), ("hit", "shared"), ("miss", "local")):
+    RETRIEVAL_CACHE_LOOKUPS.labels(_result, _tier)
+
+CACHE_METRICS = (SEMANTIC_CACHE_LOOKUPS, SEMANTIC_CACHE_EVICTIONS, RETRIEVAL_CACHE_LOOKUPS)
+
+
+# --------- Collection version stamp ---------
+def write_collection_version(qd_client, collection: str = VERSION_COLLECTION) -> str:
+    """
+    Stamps a new version after (re-)ingestion. Every cache keyed on it
+    stops serving entries built from the previous data.
+    """
+    version = uuid.uuid4().hex
+    if not qd_client.collection_exists(collection):
+        qd_client.create_collection(
+            collection_name=collection,
+            vectors_config=models.VectorParams(size=1, distance=models.Distance.DOT),
+        )
+    qd_client.upsert(
+        collection_name=collection,
+        points=[models.PointStruct(id=1, vector=[1.0], payload={"version": version, "updated_at": time.time()})],
+    )
+    return version
+
+
+class CollectionVersion:
+    """
+    Reads the stamp written by write_collection_version(), at most once per
+    check_seconds, so caches can embed it in their keys cheaply.
+    """
+
+    def __init__(self, qd_client, collection: str = VERSION_COLLECTION, check_seconds: float = VERSION_CHECK_SECONDS):
+        self.qd = qd_client
+        self.collection = collection
+        self.check_seconds = check_seconds
+        self._version = "0"
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def current(self) -> str:
+        if time.monotonic() - self._checked_at < self.check_seconds:
+            return self._version
+        with self._lock:
+            if time.monotonic() - self._checked_at >= self.check_seconds:
+                try:
+                    points = self.qd.retrieve(self.collection, ids=[1], with_payload=True)
+                    self._version = points[0].payload["version"] if points else "0"
+                except Exception:
+                    self._version = "0"  # not stamped yet (pre-stamp ingest)
+                self._checked_at = time.monotonic()
+        return self._version
+
+# answers with a final verdict only: a PENDING / SKIPPED one would be copied into every hit's
+# conversation row (and re-judged there), and a later NON_RELEVANT verdict never reaches the cache
+CACHEABLE_RELEVANCE = ("RELEVANT", "PARTLY_RELEVANT")
+
+ZERO_COST_FIELDS = (
+    "prompt_tokens", "completion_tokens", "total_tokens",
+    "eval_prompt_tokens", "eval_completion_tokens", "eval_total_tokens",
+    "context_tokens", "context_tokens_original",
+)
+
+
+class SemanticCache:
+    """
+    Maps question embeddings (from the shared embedder, same EMBED_MODEL as
+    retrieval) to previous (answer_data, hits).
+
+    lookup() returns the closest cached answer with cosine >= threshold that is
+    younger than ttl, built from the current collection version and stored
+    under the same `scope`, re-stamped as a cache hit (model_used='cache', zero
+    tokens/cost, response_time = lookup time). The scope partitions questions
+    that embed alike but ask different things ("What key is X in?" vs "What
+    cadence does X use?"); rag.cache_scope() builds it from the fields and
+    songs a question names. store() adds an entry and, every evict_every
+    stores, evicts expired and least recently hit entries beyond max_entries.
+    Cache errors never fail a request: they count as a miss.
+    """
+
+    def __init__(self, qd_client, version: CollectionVersion,
+                 collection: str = SEMANTIC_CACHE_COLLECTION,
+                 threshold: float = SEMANTIC_CACHE_THRESHOLD, ttl: float = SEMANTIC_CACHE_TTL,
+                 max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES, dim: int = EMBED_DIM,
+                 evict_every: int = SEMANTIC_CACHE_EVICT_EVERY):
+        self.qd = qd_client
+        self.version = version
+        self.collection = collection
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.dim = dim
+        self.evict_every = max(1, evict_every)
+        self._ready = False
+        self._stores = 0
+        self._stores_lock = threading.Lock()
+
+    def _ensure_collection(self):
+        if self._ready:
+            return
+        if not self.qd.collection_exists(self.collection):
+            self.qd.create_collection(
+                collection_name=self.collection,
+                vectors_config=models.VectorParams(size=self.dim, distance=models.Distance.COSINE),
+            )
+            for field in ("created_at", "last_hit"):
+                self.qd.create_payload_index(self.collection, field, models.PayloadSchemaType.FLOAT)
+            for field in ("version", "scope"):
+                self.qd.create_payload_index(self.collection, field, models.PayloadSchemaType.KEYWORD)
+        self._ready = True
+
+    def lookup(self, vector: List[float], scope: str = "") -> Optional[Tuple[Dict[str, Any], List[models.ScoredPoint]]]:
+        t0 = time.time()
+        try:
+            self._ensure_collection()
+            result = self.qd.query_points(
+                collection_name=self.collection,
+                query=vector,
+                query_filter=models.Filter(must=[
+                    models.FieldCondition(key="created_at", range=models.Range(gte=t0 - self.ttl)),
+                    models.FieldCondition(key="version", match=models.MatchValue(value=self.version.current())),
+                    models.FieldCondition(key="scope", match=models.MatchValue(value=scope)),
+                    # entries stored before verdicts were required
+                    models.FieldCondition(
+                        key="answer_data.relevance", match=models.MatchAny(any=list(CACHEABLE_RELEVANCE)),
+                    ),
+                ]),
+                score_threshold=self.threshold,
+                limit=1,
+                with_payload=True,
+            ).points
+            if not result:
+                SEMANTIC_CACHE_LOOKUPS.labels("miss").inc()
+                return None
+
+            entry = result[0]
+            answer_data = dict(entry.payload["answer_data"])
+            hits = [
+                models.ScoredPoint(id=src["id"], version=0, score=src["score"], payload=src["payload"])
+                for src in entry.payload["sources"]
+            ]
+        except Exception as e:
+            self._ready = False  # e.g. collection dropped by a re-ingest
+            SEMANTIC_CACHE_LOOKUPS.labels("error").inc()
+            print(f"[semantic cache] Lookup failed: {e}")
+            return None
+
+        SEMANTIC_CACHE_LOOKUPS.labels("hit").inc()
+        try:
+            self.qd.set_payload(self.collection, payload={"last_hit": time.time()}, points=[entry.id], wait=False)
+        except Exception as e:  # the LRU stamp is best effort: the entry just looks older
+            print(f"[semantic cache] Hit stamp failed: {e}")
+        answer_data.update({field: 0 for field in ZERO_COST_FIELDS})
+        answer_data["openai_cost"] = 0.0
+        answer_data["model_used"] = "cache"
+        answer_data["route"] = "cache"
+        answer_data["response_time"] = time.time() - t0
+        answer_data.update(stage_ms())  # this request's embed / lookup, not the original's stages
+        return answer_data, hits
+
+    def store(self, question: str, vector: List[float], answer_data: Dict[str, Any], hits, scope: str = ""):
+        if answer_data.get("relevance") not in CACHEABLE_RELEVANCE:
+            return  # known-bad, or not judged (yet)
+        now = time.time()
+        try:
+            self._ensure_collection()
+            self.qd.upsert(
+                collection_name=self.collection,
+                points=[models.PointStruct(
+                    id=str(uuid.uuid4()),
+                    vector=vector,
+                    payload={
+                        "question": question,
+                        "answer_data": answer_data,
+                        "sources": [{"id": h.id, "score": h.score, "payload": h.payload} for h in hits],
+                        "created_at": now,
+                        "last_hit": now,
+                        "version": self.version.current(),
+                        "scope": scope,
+                    },
+                )],
+                wait=False,
+            )
+            with self._stores_lock:
+                self._stores += 1
+                check = self._stores % self.evict_every == 0
+            if check:
+                self._evict(now)
+        except Exception as e:
+            self._ready = False
+            print(f"[semantic cache] Store failed: {e}")
+
+    def _evict(self, now: float):
+        if self.qd.count(self.collection, exact=False).count <= self.max_entries:
+            return
+        before = self.qd.count(self.collection, exact=True).count
+        # expired / stale-version entries first, then the least recently hit ones
+        self.qd.delete(
+            self.collection,
+            points_selector=models.FilterSelector(filter=models.Filter(should=[
+                models.FieldCondition(key="created_at", range=models.Range(lt=now - self.ttl)),
+                models.Filter(must_not=[
+                    models.FieldCondition(key="version", match=models.MatchValue(value=self.version.current())),
+                ]),
+            ])),
+        )
+        excess = self.qd.count(self.collection, exact=True).count - self.max_entries
+        if excess > 0:
+            oldest, _ = self.qd.scroll(
+                self.collection,
+                limit=excess,
+                order_by=models.OrderBy(key="last_hit", direction=models.Direction.ASC),
+                with_payload=False,
+            )
+            self.qd.delete(self.collection, points_selector=models.PointIdsList(points=[p.id for p in oldest]))
+        SEMANTIC_CACHE_EVICTIONS.inc(before - self.qd.count(self.collection, exact=True).count)
+
+    def clear(self):
+        """Drops every cached answer to free space (the version stamp already hides them)."""
+        if self.qd.collection_exists(self.collection):
+            self.qd.delete_collection(self.collection)
+        self._ready = False
+
+
+# --------- Exact-match retrieval / context cache ---------
+def normalize_question(question: str) -> str:
+    """Case-, whitespace- and trailing-punctuation-insensitive cache key."""
+    return re.sub(r"\s+", " ", question).strip().rstrip("?!. ").lower()
+
+
+class LRUCache:
+    """Small thread-safe LRU with per-entry TTL."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RetrievalCache:
+    """
+    (normalised question, top_k, collection version) -> hit ids, scores,
+    payloads and the rendered CONTEXT block. The local LRU is per process;
+    with RETRIEVAL_CACHE_REDIS_URL set, entries are also shared through Redis
+    (JSON, same TTL) so all uvicorn workers benefit from each other's misses.
+    """
+
+    def __init__(self, version: CollectionVersion, maxsize: int = RETRIEVAL_CACHE_SIZE,
+                 ttl: float = RETRIEVAL_CACHE_TTL, redis_url: str = RETRIEVAL_CACHE_REDIS_URL):
+        self.version = version
+        self.ttl = ttl
+        self.local = LRUCache(maxsize, ttl)
+        self.redis = None
+        if redis_url:
+            import redis  # optional dependency, only needed for the shared tier
+            self.redis = redis.Redis.from_url(redis_url, socket_timeout=0.05)
+
+    @property
+    def shared(self) -> bool:
+        return self.redis is not None
+
+    def _key(self, question: str, top_k: int) -> str:
+        return f"retrieval:{self.version.current()}:{top_k}:{normalize_question(question)}"
+
+    def get(self, question: str, top_k: int) -> Optional[Tuple[List[models.ScoredPoint], str]]:
+        key = self._key(question, top_k)
+        entry = self.local.get(key)
+        tier = "local"
+        if entry is None and self.redis is not None:
+            try:
+                raw = self.redis.get(key)
+            except Exception:
+                raw = None
+            if raw is not None:
+                entry = json.loads(raw)
+                self.local.set(key, entry)
+                tier = "shared"
+        if entry is None:
+            RETRIEVAL_CACHE_LOOKUPS.labels("miss", "local").inc()
+            return None
+
+        RETRIEVAL_CACHE_LOOKUPS.labels("hit", tier).inc()
+        hits = [
+            models.ScoredPoint(id=pid, version=0, score=score, payload=payload)
+            for pid, score, payload in zip(entry["ids"], entry["scores"], entry["payloads"])
+        ]
+        return hits, entry["context"]
+
+    def set(self, question: str, top_k: int, hits, context: str):
+        key = self._key(question, top_k)
+        entry = {
+            "ids": [h.id for h in hits],
+            "scores": [h.score for h in hits],
+            "payloads": [h.payload for h in hits],
+            "context": context,
+        }
+        self.local.set(key, entry)
+        if self.redis is not None:
+            try:
+                self.redis.set(key, json.dumps(entry), ex=int(self.ttl))
+            except Exception as e:
+                print(f"[retrieval cache] Redis write failed: {e}")
@@ -1,11 +1,22 @@
 # music-theory-assistant/db.py
 import os
+import time
+import queue
+import atexit
+import asyncio
+import threading
+from contextlib import contextmanager, asynccontextmanager
 from datetime import datetime
 from zoneinfo import ZoneInfo
-from typing import Optional, List, Any, Dict
+from typing import Optional, List, Any, Dict, Tuple
 
+import asyncpg
 import psycopg2
-from psycopg2.extras import DictCursor
+from psycopg2 import pool as pg_pool
+from psycopg2.extras import DictCursor, execute_values
+from prometheus_client import Counter, Gauge, Histogram
+
+from metrics import STAGE_COLUMNS, stage
 
 # --- Config ---
 RUN_TIMEZONE_CHECK = os.getenv("RUN_TIMEZONE_CHECK", "1") == "1"
@@ -14,21 +25,229 @@ RUN_TIMEZONE_CHECK = os.getenv("RUN_TIMEZONE_CHECK", "1") == "1"
 TZ_INFO = os.getenv("TZ", "Europe/London")
 tz = ZoneInfo(TZ_INFO)
 
+POSTGRES_POOL_MIN = int(os.getenv("POSTGRES_POOL_MIN", "1"))
+POSTGRES_POOL_MAX = int(os.getenv("POSTGRES_POOL_MAX", "10"))
+POSTGRES_POOL_TIMEOUT = float(os.getenv("POSTGRES_POOL_TIMEOUT", "10"))  # max wait for a free connection (s)
+POSTGRES_POOL_PRE_PING = os.getenv("POSTGRES_POOL_PRE_PING", "1") == "1"  # SELECT 1 before handing out
+
+# Write-behind: buffer conversation/feedback rows and insert them in batches off the request path
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "0") == "1"
+WRITE_BEHIND_MAX_QUEUE = int(os.getenv("WRITE_BEHIND_MAX_QUEUE", "10000"))
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "200"))
+WRITE_BEHIND_FLUSH_SECONDS = float(os.getenv("WRITE_BEHIND_FLUSH_SECONDS", "1.0"))
+WRITE_BEHIND_PUT_TIMEOUT = float(os.getenv("WRITE_BEHIND_PUT_TIMEOUT", "2.0"))  # backpressure: max wait when full
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv("WRITE_BEHIND_MAX_ATTEMPTS", "10"))  # per batch while Postgres is unreachable
+
+# Background judge queue (judge.py)
+JUDGE_MAX_ATTEMPTS = int(os.getenv("JUDGE_MAX_ATTEMPTS", "5"))  # failed judge calls before a row is marked UNKNOWN
+JUDGE_CLAIM_TIMEOUT_SECONDS = float(os.getenv("JUDGE_CLAIM_TIMEOUT_SECONDS", "300"))  # JUDGING rows older than this are reclaimed
+
+CONVERSATION_COLUMNS = (
+    "id", "question", "answer", "model_used", "response_time", "relevance",
+    "relevance_explanation", "prompt_tokens", "completion_tokens", "total_tokens",
+    "eval_prompt_tokens", "eval_completion_tokens", "eval_total_tokens", "openai_cost", "timestamp",
+    "context_tokens", "context_tokens_original", "route", *STAGE_COLUMNS,
+)
+
+# --- Pool metrics (label pool="sync" for psycopg2, "async" for asyncpg) ---
+DB_POOL_WAIT = Histogram(
+    "db_pool_wait_seconds", "Time spent waiting for a pooled Postgres connection", ["pool"],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10),
+)
+DB_POOL_IN_USE = Gauge("db_pool_connections_in_use", "Pooled Postgres connections currently checked out", ["pool"])
+DB_POOL_MAX = Gauge("db_pool_connections_max", "Configured max size of the Postgres pool", ["pool"])
+DB_POOL_RECONNECTS = Counter("db_pool_reconnects_total", "Broken pooled Postgres connections replaced", ["pool"])
+
+# --- Write-behind metrics ---
+WB_QUEUE_DEPTH = Gauge("write_behind_queue_depth", "Rows waiting in the write-behind buffer")
+WB_FLUSH_SECONDS = Histogram("write_behind_flush_seconds", "Time to write one write-behind batch")
+WB_ROWS_FLUSHED = Counter("write_behind_rows_flushed_total", "Rows written by the write-behind buffer", ["kind"])
+WB_FLUSH_ERRORS = Counter("write_behind_flush_errors_total", "Failed write-behind flush attempts")
+WB_ROWS_DROPPED = Counter("write_behind_rows_dropped_total", "Rows the write-behind buffer gave up on", ["kind"])
+
+# for processes that serve their own registry (Streamlit UI)
+POOL_METRICS = (DB_POOL_WAIT, DB_POOL_IN_USE, DB_POOL_MAX, DB_POOL_RECONNECTS)
+WRITE_BEHIND_METRICS = (WB_QUEUE_DEPTH, WB_FLUSH_SECONDS, WB_ROWS_FLUSHED, WB_FLUSH_ERRORS, WB_ROWS_DROPPED)
+
+
 # --- Connection ---
+def _connection_params() -> Dict[str, Any]:
+    return dict(
+        host=os.getenv("POSTGRES_HOST", "postgres"),
+        port=int(os.getenv("POSTGRES_PORT", "5432")),
+        database=os.getenv("POSTGRES_DB", "course_assistant"),
+        user=os.getenv("POSTGRES_USER", "your_username"),
+        password=os.getenv("POSTGRES_PASSWORD", "your_password"),
+    )
+
+
 def get_db_connection():
     """
     Returns a new psycopg2 connection using env vars:
       POSTGRES_HOST (default: 'postgres' for Docker; 'localhost' for local)
+      POSTGRES_PORT (default: 5432)
       POSTGRES_DB   (default: 'course_assistant')
       POSTGRES_USER (default: 'your_username')
       POSTGRES_PASSWORD (default: 'your_password')
+    Request-path code should use db_connection() (pooled) instead.
     """
-    return psycopg2.connect(
-        host=os.getenv("POSTGRES_HOST", "postgres"),
-        database=os.getenv("POSTGRES_DB", "course_assistant"),
-        user=os.getenv("POSTGRES_USER", "your_username"),
-        password=os.getenv("POSTGRES_PASSWORD", "your_password"),
-    )
+    return psycopg2.connect(**_connection_params())
+
+
+# --- Sync connection pool (psycopg2) ---
+class ConnectionPool:
+    """
+    Blocking, health-checked wrapper around psycopg2's ThreadedConnectionPool.
+
+    ThreadedConnectionPool raises as soon as it is exhausted; here callers wait
+    up to `timeout` seconds for a free slot instead. Connections are pinged
+    before use (if pre_ping) and discarded when found or left broken, so the
+    pool reconnects transparently after a Postgres restart.
+    """
+
+    def __init__(self, minconn: int, maxconn: int, timeout: float, pre_ping: bool):
+        self._pool = pg_pool.ThreadedConnectionPool(minconn, maxconn, **_connection_params())
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self.timeout = timeout
+        self.pre_ping = pre_ping
+        DB_POOL_MAX.labels("sync").set(maxconn)
+
+    def _checkout(self):
+        conn = self._pool.getconn()
+        if conn.closed or (self.pre_ping and not self._ping(conn)):
+            DB_POOL_RECONNECTS.labels("sync").inc()
+            self._pool.putconn(conn, close=True)
+            conn = self._pool.getconn()
+        return conn
+
+    @staticmethod
+    def _ping(conn) -> bool:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @contextmanager
+    def connection(self):
+        t0 = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            raise pg_pool.PoolError(f"No Postgres connection available after {self.timeout}s")
+        DB_POOL_WAIT.labels("sync").observe(time.perf_counter() - t0)
+
+        try:
+            conn = self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+
+        DB_POOL_IN_USE.labels("sync").inc()
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            try:
+                if broken or conn.closed:
+                    DB_POOL_RECONNECTS.labels("sync").inc()
+                    self._pool.putconn(conn, close=True)
+                else:
+                    if conn.status != psycopg2.extensions.STATUS_READY:
+                        conn.rollback()  # never hand out a connection mid-transaction
+                    self._pool.putconn(conn)
+            finally:
+                DB_POOL_IN_USE.labels("sync").dec()
+                self._slots.release()
+
+    def close(self):
+        self._pool.closeall()
+
+
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """
+    Returns the process-wide psycopg2 pool, creating it on first use
+    (sized by POSTGRES_POOL_MIN / POSTGRES_POOL_MAX). If Postgres is down the
+    error propagates and the next call tries again.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    POSTGRES_POOL_MIN, POSTGRES_POOL_MAX, POSTGRES_POOL_TIMEOUT, POSTGRES_POOL_PRE_PING
+                )
+    return _pool
+
+
+@contextmanager
+def db_connection():
+    """Borrows a connection from the process-wide pool; it is returned on exit."""
+    with get_pool().connection() as conn:
+        yield conn
+
+
+def close_pool():
+    """Closes the psycopg2 pool (call on process shutdown)."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+# --- Async connection pool (asyncpg) ---
+_async_pool: Optional[asyncpg.Pool] = None
+_async_pool_lock = asyncio.Lock()
+
+
+async def get_async_pool() -> asyncpg.Pool:
+    """
+    Returns the process-wide asyncpg pool, creating it on first use.
+    Uses the same POSTGRES_* env vars as get_db_connection(), sized by
+    POSTGRES_POOL_MIN / POSTGRES_POOL_MAX. asyncpg replaces closed
+    connections on acquire by itself.
+    """
+    global _async_pool
+    if _async_pool is None:
+        async with _async_pool_lock:
+            if _async_pool is None:
+                _async_pool = await asyncpg.create_pool(
+                    **_connection_params(),
+                    min_size=POSTGRES_POOL_MIN,
+                    max_size=POSTGRES_POOL_MAX,
+                )
+                DB_POOL_MAX.labels("async").set(POSTGRES_POOL_MAX)
+    return _async_pool
+
+
+@asynccontextmanager
+async def async_db_connection():
+    """Async twin of db_connection() on the asyncpg pool."""
+    pool = await get_async_pool()
+    t0 = time.perf_counter()
+    async with pool.acquire(timeout=POSTGRES_POOL_TIMEOUT) as conn:
+        DB_POOL_WAIT.labels("async").observe(time.perf_counter() - t0)
+        DB_POOL_IN_USE.labels("async").inc()
+        try:
+            yield conn
+        finally:
+            DB_POOL_IN_USE.labels("async").dec()
+
+
+async def close_async_pool():
+    """Closes the asyncpg pool (call on app shutdown)."""
+    global _async_pool
+    if _async_pool is not None:
+        await _async_pool.close()
+        _async_pool = None
 
 
 # --- Schema management ---
@@ -62,10 +281,31 @@ def init_db(drop_existing: bool = True):
                     eval_completion_tokens INTEGER NOT NULL,
                     eval_total_tokens INTEGER NOT NULL,
                     openai_cost FLOAT NOT NULL,
-                    timestamp TIMESTAMP WITH TIME ZONE NOT NULL
+                    timestamp TIMESTAMP WITH TIME ZONE NOT NULL,
+                    context_tokens INTEGER NOT NULL DEFAULT 0,
+                    context_tokens_original INTEGER NOT NULL DEFAULT 0,
+                    route TEXT NOT NULL DEFAULT 'default',
+                    embed_ms FLOAT NOT NULL DEFAULT 0,
+                    search_ms FLOAT NOT NULL DEFAULT 0,
+                    prompt_ms FLOAT NOT NULL DEFAULT 0,
+                    answer_ms FLOAT NOT NULL DEFAULT 0,
+                    judge_ms FLOAT NOT NULL DEFAULT 0,
+                    judge_attempts INTEGER NOT NULL DEFAULT 0,
+                    judge_claimed_at TIMESTAMP WITH TIME ZONE
                 )
                 """
             )
+            # tables created before context packing (drop_existing=False)
+            for column in ("context_tokens", "context_tokens_original"):
+                cur.execute(f"ALTER TABLE conversations ADD COLUMN IF NOT EXISTS {column} INTEGER NOT NULL DEFAULT 0")
+            # ... and before model routing
+            cur.execute("ALTER TABLE conversations ADD COLUMN IF NOT EXISTS route TEXT NOT NULL DEFAULT 'default'")
+            # ... and before per-stage timings
+            for column in STAGE_COLUMNS:
+                cur.execute(f"ALTER TABLE conversations ADD COLUMN IF NOT EXISTS {column} FLOAT NOT NULL DEFAULT 0")
+            # ... and before the judge queue tracked claims
+            cur.execute("ALTER TABLE conversations ADD COLUMN IF NOT EXISTS judge_attempts INTEGER NOT NULL DEFAULT 0")
+            cur.execute("ALTER TABLE conversations ADD COLUMN IF NOT EXISTS judge_claimed_at TIMESTAMP WITH TIME ZONE")
 
             cur.execute(
                 """
@@ -77,66 +317,303 @@ def init_db(drop_existing: bool = True):
                 )
                 """
             )
+
+            # work queue for judge.py: only rows still waiting for (or being given) a relevance verdict
+            cur.execute("DROP INDEX IF EXISTS conversations_pending_idx")
+            cur.execute(
+                """
+                CREATE INDEX IF NOT EXISTS conversations_judge_queue_idx
+                ON conversations (judge_attempts, timestamp) WHERE relevance IN ('PENDING', 'JUDGING')
+                """
+            )
         conn.commit()
     finally:
         conn.close()
 
 
 # --- Writes ---
+def _conversation_values(conversation_id: str, question: str, answer_data: Dict[str, Any], timestamp: datetime) -> tuple:
+    """Row tuple for 'conversations', in CONVERSATION_COLUMNS order."""
+    return (
+        conversation_id,
+        question,
+        answer_data["answer"],
+        answer_data["model_used"],
+        float(answer_data["response_time"]),
+        str(answer_data.get("relevance", "unknown")),
+        str(answer_data.get("relevance_explanation", "")),
+        int(answer_data.get("prompt_tokens", 0)),
+        int(answer_data.get("completion_tokens", 0)),
+        int(answer_data.get("total_tokens", 0)),
+        int(answer_data.get("eval_prompt_tokens", 0)),
+        int(answer_data.get("eval_completion_tokens", 0)),
+        int(answer_data.get("eval_total_tokens", 0)),
+        float(answer_data.get("openai_cost", 0.0)),
+        timestamp,
+        int(answer_data.get("context_tokens", 0)),
+        int(answer_data.get("context_tokens_original", 0)),
+        str(answer_data.get("route", "default")),
+        *(float(answer_data.get(column, 0.0)) for column in STAGE_COLUMNS),
+    )
+
+
+# --- Write-behind buffer ---
+class WriteBehindFull(Exception):
+    """Raised when the write-behind buffer stays full for WRITE_BEHIND_PUT_TIMEOUT."""
+
+
+_INSERT_CONVERSATIONS = f"""
+    INSERT INTO conversations ({", ".join(CONVERSATION_COLUMNS)}) VALUES %s
+    ON CONFLICT (id) DO NOTHING
+"""
+_INSERT_FEEDBACK = "INSERT INTO feedback (conversation_id, feedback, timestamp) VALUES %s"
+_STOP = object()
+
+# errors that say nothing about the rows (Postgres down or restarting, connection lost, pool exhausted);
+# anything else (IntegrityError, DataError, psycopg2's ValueError for a NUL byte, ...) is blamed on a row
+_TRANSIENT_DB_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, pg_pool.PoolError)
+
+
+class WriteBehindBuffer:
+    """
+    Bounded FIFO of ("conversation" | "feedback", row) items, written by a
+    background thread with multi-row execute_values once batch_size rows are
+    waiting or flush_seconds have passed since the first one.
+
+    Ordering: conversations and feedback share one queue, and each batch inserts
+    its conversations before its feedback in a single transaction, so a feedback
+    row is never written before its parent conversation. A batch failing on
+    its data is rewritten row by row, and the rows Postgres rejects are
+    dropped (write_behind_rows_dropped_total). A batch failing on the
+    connection is retried with backoff, up to max_attempts times, while new
+    rows keep queueing; once the queue is full, put() blocks for up to
+    put_timeout and then raises WriteBehindFull.
+    """
+
+    def __init__(self, max_queue: int, batch_size: int, flush_seconds: float, put_timeout: float,
+                 max_attempts: int = WRITE_BEHIND_MAX_ATTEMPTS):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.put_timeout = put_timeout
+        self.max_attempts = max_attempts
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_queue)
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def put(self, kind: str, row: tuple, block: bool = True):
+        try:
+            self._queue.put((kind, row), block=block, timeout=self.put_timeout if block else None)
+        except queue.Full:
+            raise WriteBehindFull(f"write-behind buffer full ({self._queue.maxsize} rows)")
+        WB_QUEUE_DEPTH.set(self._queue.qsize())
+
+    def close(self, timeout: float = 30.0):
+        """Flushes everything queued so far and stops the writer thread."""
+        if not self._thread.is_alive():
+            return
+        self._stopping.set()
+        self._queue.put((_STOP, None))
+        self._thread.join(timeout)
+
+    def _run(self):
+        batch: List[tuple] = []
+        deadline = 0.0
+        while True:
+            wait = self.flush_seconds if not batch else max(0.0, deadline - time.monotonic())
+            try:
+                kind, row = self._queue.get(timeout=wait)
+            except queue.Empty:
+                kind = None
+            if kind is _STOP:
+                if batch:
+                    self._flush(batch)
+                return
+            if kind is not None:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_seconds
+                batch.append((kind, row))
+            WB_QUEUE_DEPTH.set(self._queue.qsize())
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self._flush(batch)
+                batch = []
+
+    def _flush(self, batch: List[tuple]):
+        backoff = 0.5
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                with WB_FLUSH_SECONDS.time():
+                    try:
+                        self._write(batch)
+                    except _TRANSIENT_DB_ERRORS:
+                        raise
+                    except Exception:
+                        # a bad row (feedback for an unknown conversation, a NUL byte, ...) must not block the rest
+                        self._write_one_by_one(batch)
+                return
+            except Exception as e:
+                WB_FLUSH_ERRORS.inc()
+                print(f"[write-behind] Flush of {len(batch)} rows failed (attempt {attempts}): {e}")
+                if attempts >= self.max_attempts or (self._stopping.is_set() and attempts >= 3):
+                    for kind, _ in batch:
+                        WB_ROWS_DROPPED.labels(kind).inc()
+                    print(f"[write-behind] Dropped {len(batch)} rows after {attempts} attempts")
+                    return
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+
+    def _write(self, batch: List[tuple]):
+        conversations = [row for kind, row in batch if kind == "conversation"]
+        feedback = [row for kind, row in batch if kind == "feedback"]
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                if conversations:
+                    execute_values(cur, _INSERT_CONVERSATIONS, conversations, page_size=len(conversations))
+                if feedback:
+                    execute_values(cur, _INSERT_FEEDBACK, feedback, page_size=len(feedback))
+            conn.commit()
+        WB_ROWS_FLUSHED.labels("conversation").inc(len(conversations))
+        WB_ROWS_FLUSHED.labels("feedback").inc(len(feedback))
+
+    def _write_one_by_one(self, batch: List[tuple]):
+        # consumes `batch` in place, so a retry after a connection error resumes where it stopped
+        batch.sort(key=lambda item: item[0] != "conversation")  # stable: conversations first
+        while batch:
+            kind, row = batch[0]
+            try:
+                self._write([(kind, row)])
+            except _TRANSIENT_DB_ERRORS:
+                raise  # the next attempt resumes at this row
+            except Exception as e:
+                WB_ROWS_DROPPED.labels(kind).inc()
+                print(f"[write-behind] Dropped {kind} row: {e}")
+            batch.pop(0)
+
+
+_write_behind: Optional[WriteBehindBuffer] = None
+_write_behind_lock = threading.Lock()
+
+
+def get_write_behind() -> WriteBehindBuffer:
+    """Returns the process-wide write-behind buffer, starting its writer thread on first use."""
+    global _write_behind
+    if _write_behind is None:
+        with _write_behind_lock:
+            if _write_behind is None:
+                _write_behind = WriteBehindBuffer(
+                    WRITE_BEHIND_MAX_QUEUE, WRITE_BEHIND_BATCH_SIZE, WRITE_BEHIND_FLUSH_SECONDS, WRITE_BEHIND_PUT_TIMEOUT
+                )
+                atexit.register(close_write_behind)
+    return _write_behind
+
+
+def close_write_behind():
+    """Flush-on-shutdown hook: writes out everything still buffered."""
+    if _write_behind is not None:
+        _write_behind.close()
+
+
+async def _aput_write_behind(kind: str, row: tuple):
+    buffer = get_write_behind()
+    try:
+        buffer.put(kind, row, block=False)
+    except WriteBehindFull:
+        # full: wait (off the event loop) for the writer to catch up
+        await asyncio.to_thread(buffer.put, kind, row)
+
+
 def save_conversation(conversation_id: str, question: str, answer_data: Dict[str, Any], timestamp: Optional[datetime] = None):
     """
-    Persists a single conversation.
+    Persists a single conversation (queued for a batched insert when WRITE_BEHIND=1).
     'answer_data' must contain keys:
       answer, model_used, response_time, relevance, relevance_explanation,
       prompt_tokens, completion_tokens, total_tokens,
       eval_prompt_tokens, eval_completion_tokens, eval_total_tokens, openai_cost
+    and optionally context_tokens, context_tokens_original (default 0), route
+    (model router route, default 'default') and the metrics.STAGE_COLUMNS
+    timings (embed_ms, search_ms, prompt_ms, answer_ms, judge_ms; default 0).
+    The write itself is timed as the db_write stage (histogram / span only).
     """
     if timestamp is None:
         timestamp = datetime.now(tz)
 
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                INSERT INTO conversations 
-                (id, question, answer, model_used, response_time, relevance, 
-                 relevance_explanation, prompt_tokens, completion_tokens, total_tokens, 
-                 eval_prompt_tokens, eval_completion_tokens, eval_total_tokens, openai_cost, timestamp)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    with stage("db_write"):
+        if WRITE_BEHIND:
+            get_write_behind().put("conversation", _conversation_values(conversation_id, question, answer_data, timestamp))
+            return
+
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"""
+                    INSERT INTO conversations ({", ".join(CONVERSATION_COLUMNS)})
+                    VALUES ({", ".join(["%s"] * len(CONVERSATION_COLUMNS))})
+                    """,
+                    _conversation_values(conversation_id, question, answer_data, timestamp),
+                )
+            conn.commit()
+
+
+async def asave_conversation(conversation_id: str, question: str, answer_data: Dict[str, Any], timestamp: Optional[datetime] = None):
+    """
+    Async twin of save_conversation() using the asyncpg pool.
+    """
+    if timestamp is None:
+        timestamp = datetime.now(tz)
+
+    with stage("db_write"):
+        if WRITE_BEHIND:
+            await _aput_write_behind("conversation", _conversation_values(conversation_id, question, answer_data, timestamp))
+            return
+
+        placeholders = ", ".join(f"${i}" for i in range(1, len(CONVERSATION_COLUMNS) + 1))
+        async with async_db_connection() as conn:
+            await conn.execute(
+                f"""
+                INSERT INTO conversations ({", ".join(CONVERSATION_COLUMNS)})
+                VALUES ({placeholders})
                 """,
-                (
-                    conversation_id,
-                    question,
-                    answer_data["answer"],
-                    answer_data["model_used"],
-                    float(answer_data["response_time"]),
-                    str(answer_data.get("relevance", "unknown")),
-                    str(answer_data.get("relevance_explanation", "")),
-                    int(answer_data.get("prompt_tokens", 0)),
-                    int(answer_data.get("completion_tokens", 0)),
-                    int(answer_data.get("total_tokens", 0)),
-                    int(answer_data.get("eval_prompt_tokens", 0)),
-                    int(answer_data.get("eval_completion_tokens", 0)),
-                    int(answer_data.get("eval_total_tokens", 0)),
-                    float(answer_data.get("openai_cost", 0.0)),
-                    timestamp,
-                ),
+                *_conversation_values(conversation_id, question, answer_data, timestamp),
             )
-        conn.commit()
-    finally:
-        conn.close()
+
+
+async def asave_conversations(rows: List[Tuple[str, str, Dict[str, Any]]], timestamp: Optional[datetime] = None):
+    """
+    Bulk insert of (conversation_id, question, answer_data) rows in one
+    pipelined executemany (batch_rag jobs). Existing ids are skipped.
+    """
+    if not rows:
+        return
+    if timestamp is None:
+        timestamp = datetime.now(tz)
+
+    placeholders = ", ".join(f"${i}" for i in range(1, len(CONVERSATION_COLUMNS) + 1))
+    async with async_db_connection() as conn:
+        await conn.executemany(
+            f"""
+            INSERT INTO conversations ({", ".join(CONVERSATION_COLUMNS)})
+            VALUES ({placeholders})
+            ON CONFLICT (id) DO NOTHING
+            """,
+            [_conversation_values(conv_id, question, answer_data, timestamp) for conv_id, question, answer_data in rows],
+        )
 
 
 def save_feedback(conversation_id: str, feedback: int, timestamp: Optional[datetime] = None):
     """
     Persists feedback for a conversation. feedback: 1 (thumbs up) or -1 (thumbs down).
+    With WRITE_BEHIND=1 it goes through the same buffer as the conversation, after it.
     """
     if timestamp is None:
         timestamp = datetime.now(tz)
 
-    conn = get_db_connection()
-    try:
+    if WRITE_BEHIND:
+        get_write_behind().put("feedback", (conversation_id, int(feedback), timestamp))
+        return
+
+    with db_connection() as conn:
         with conn.cursor() as cur:
             cur.execute(
                 """
@@ -146,8 +623,129 @@ def save_feedback(conversation_id: str, feedback: int, timestamp: Optional[datet
                 (conversation_id, int(feedback), timestamp),
             )
         conn.commit()
-    finally:
-        conn.close()
+
+
+async def asave_feedback(conversation_id: str, feedback: int, timestamp: Optional[datetime] = None):
+    """
+    Async twin of save_feedback() using the asyncpg pool.
+    """
+    if timestamp is None:
+        timestamp = datetime.now(tz)
+
+    if WRITE_BEHIND:
+        await _aput_write_behind("feedback", (conversation_id, int(feedback), timestamp))
+        return
+
+    async with async_db_connection() as conn:
+        await conn.execute(
+            """
+            INSERT INTO feedback (conversation_id, feedback, timestamp)
+            VALUES ($1, $2, $3)
+            """,
+            conversation_id, int(feedback), timestamp,
+        )
+
+
+# --- Background relevance judging ---
+_CLAIM_JUDGEMENT = """
+    UPDATE conversations
+    SET relevance = 'JUDGING', judge_claimed_at = now(), judge_attempts = judge_attempts + 1
+    WHERE id = (
+        SELECT id FROM conversations
+        WHERE relevance = 'PENDING'
+           OR (relevance = 'JUDGING' AND judge_claimed_at < now() - make_interval(secs => %s))
+        ORDER BY judge_attempts, timestamp
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, question, answer, judge_attempts
+"""
+
+
+def judge_next_pending(judge, max_attempts: int = JUDGE_MAX_ATTEMPTS,
+                       claim_timeout: float = JUDGE_CLAIM_TIMEOUT_SECONDS) -> bool:
+    """
+    Claims the conversation with relevance='PENDING' that has the fewest failed
+    judge attempts (oldest first) and fills in the verdict returned by
+    judge(question, answer). The claim is committed on its own
+    (relevance='JUDGING'), so no transaction or pooled connection is held
+    during the LLM call and several judge workers can share the queue. A row
+    left JUDGING for `claim_timeout` seconds (crashed worker) is claimed again.
+
+    If judge raises, the row goes back to PENDING behind the untried ones and
+    the error is re-raised; after `max_attempts` claims it is marked UNKNOWN.
+
+    judge must return a dict with: relevance, relevance_explanation,
+    eval_prompt_tokens, eval_completion_tokens, eval_total_tokens, eval_cost
+    and judge_ms. Returns False when there was nothing to judge.
+    """
+    with db_connection() as conn:
+        with conn.cursor(cursor_factory=DictCursor) as cur:
+            cur.execute(_CLAIM_JUDGEMENT, (claim_timeout,))
+            row = cur.fetchone()
+        conn.commit()
+    if row is None:
+        return False
+
+    try:
+        verdict = judge(row["question"], row["answer"])
+    except Exception as e:
+        _release_judgement(row, max_attempts, e)
+        raise
+
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE conversations
+                SET relevance = %s,
+                    relevance_explanation = %s,
+                    eval_prompt_tokens = %s,
+                    eval_completion_tokens = %s,
+                    eval_total_tokens = %s,
+                    openai_cost = openai_cost + %s,
+                    judge_ms = %s,
+                    judge_claimed_at = NULL
+                WHERE id = %s AND relevance = 'JUDGING'
+                """,
+                (
+                    str(verdict["relevance"]),
+                    str(verdict["relevance_explanation"]),
+                    int(verdict["eval_prompt_tokens"]),
+                    int(verdict["eval_completion_tokens"]),
+                    int(verdict["eval_total_tokens"]),
+                    float(verdict["eval_cost"]),
+                    float(verdict["judge_ms"]),
+                    row["id"],
+                ),
+            )
+        conn.commit()
+    return True
+
+
+def _release_judgement(row, max_attempts: int, error: Exception):
+    """Puts a claimed row back in the queue after a failed judge call, or gives up on it."""
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            if row["judge_attempts"] >= max_attempts:
+                cur.execute(
+                    """
+                    UPDATE conversations
+                    SET relevance = 'UNKNOWN', relevance_explanation = %s, judge_claimed_at = NULL
+                    WHERE id = %s AND relevance = 'JUDGING'
+                    """,
+                    (f"Judge failed {row['judge_attempts']} times: {type(error).__name__}: {error}"[:500], row["id"]),
+                )
+            else:
+                cur.execute(
+                    """
+                    UPDATE conversations
+                    SET relevance = 'PENDING', judge_claimed_at = NULL
+                    WHERE id = %s AND relevance = 'JUDGING'
+                    """,
+                    (row["id"],),
+                )
+        conn.commit()
 
 
 # --- Reads ---
@@ -156,8 +754,7 @@ def get_recent_conversations(limit: int = 5, relevance: Optional[str] = None):
     Returns the most recent conversations (optionally filtered by relevance).
     Includes a joined 'feedback' value if available (may be NULL).
     """
-    conn = get_db_connection()
-    try:
+    with db_connection() as conn:
         with conn.cursor(cursor_factory=DictCursor) as cur:
             base = """
                 SELECT c.*, f.feedback
@@ -173,16 +770,13 @@ def get_recent_conversations(limit: int = 5, relevance: Optional[str] = None):
 
             cur.execute(base, params)
             return cur.fetchall()
-    finally:
-        conn.close()
 
 
 def get_feedback_stats():
     """
     Returns a dict-like row with 'thumbs_up' and 'thumbs_down' counts.
     """
-    conn = get_db_connection()
-    try:
+    with db_connection() as conn:
         with conn.cursor(cursor_factory=DictCursor) as cur:
             cur.execute(
                 """
@@ -193,8 +787,6 @@ def get_feedback_stats():
                 """
             )
             return cur.fetchone()
-    finally:
-        conn.close()
 
 
 # --- Optional debugging: timezone sanity check ---
@@ -0,0 +1,348 @@
+# embedder.py — Shared in-process query embedder
+#
+# One fastembed model per process, loaded and warmed up at startup instead of
+# on the first user query. Concurrent embed() calls are micro-batched: a
+# single worker thread drains the queue and runs one ONNX inference for
+# everything that arrived within EMBED_BATCH_WAIT_MS.
+#
+# SparseEmbedder provides the BM25 (or SPLADE) side for hybrid retrieval.
+# Reranker scores (question, document) pairs with a small ONNX cross-encoder
+# on a bounded thread pool, so reranking never takes more than
+# RERANK_WORKERS cores.
+#
+# EMBED_MODEL=stub / SPARSE_MODEL=stub swap in HashingEmbedding, a hashed
+# bag-of-words model that needs no download: ingest and retrieval then run
+# fully offline (evaluate.py in CI), with lexical-overlap quality.
+import os
+import re
+import time
+import queue
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+from fastembed import SparseEmbedding, SparseTextEmbedding, TextEmbedding
+from fastembed.rerank.cross_encoder import TextCrossEncoder
+from prometheus_client import Counter, Gauge, Histogram
+from qdrant_client import models
+
+# ---- Config ----
+EMBEDDING_MODEL = os.getenv("EMBED_MODEL", "jinaai/jina-embeddings-v2-small-en")
+EMBED_CACHE_DIR = os.getenv("EMBED_CACHE_DIR") or None  # shared model download dir (e.g. a Docker volume)
+EMBED_THREADS = int(os.getenv("EMBED_THREADS", "0")) or None  # ONNX intra-op threads (None = runtime default)
+EMBED_BATCH_MAX = int(os.getenv("EMBED_BATCH_MAX", "32"))
+EMBED_BATCH_WAIT_MS = float(os.getenv("EMBED_BATCH_WAIT_MS", "2"))
+SPARSE_MODEL = os.getenv("SPARSE_MODEL", "Qdrant/bm25")
+EMBED_DIM = int(os.getenv("EMBED_DIM", "512"))  # only used by the stub model; real models have a fixed size
+RERANK_MODEL = os.getenv("RERANK_MODEL", "Xenova/ms-marco-MiniLM-L-6-v2")
+RERANK_WORKERS = int(os.getenv("RERANK_WORKERS", "1"))  # concurrent rerank passes (threads)
+RERANK_THREADS = int(os.getenv("RERANK_THREADS", "0")) or None  # ONNX intra-op threads per pass
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", "32"))  # (question, document) pairs per inference
+
+# named vectors of the collection ingest.py builds
+DENSE_VECTOR = "dense"
+SPARSE_VECTOR = "bm25"
+
+# ---- Metrics ----
+EMBED_BATCH_SECONDS = Histogram(
+    "embedding_batch_seconds", "Query embedding inference time per micro-batch",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+EMBED_BATCH_SIZE = Histogram(
+    "embedding_batch_size", "Queries embedded per micro-batch", buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+EMBEDDER_READY = Gauge("embedder_ready", "1 once the embedding model is loaded and warmed up")
+RERANK_SECONDS = Histogram(
+    "rerank_seconds", "Cross-encoder inference time per reranked question (including over-budget runs)",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.15, 0.25, 0.5, 1, 2.5),
+)
+RERANKS = Counter("rerank_total", "Rerank attempts by outcome", ["result"])
+for _result in ("ok", "timeout", "error"):
+    RERANKS.labels(_result)
+
+EMBEDDER_METRICS = (EMBED_BATCH_SECONDS, EMBED_BATCH_SIZE, EMBEDDER_READY, RERANK_SECONDS, RERANKS)
+
+
+STUB_MODEL = "stub"
+
+
+class HashingEmbedding:
+    """
+    Stand-in for fastembed's TextEmbedding / SparseTextEmbedding (model name
+    "stub"). Lowercased word tokens are hashed (blake2b, stable across
+    processes) into `dim` signed buckets for dense vectors, or used as sparse
+    indices with term-frequency values (Qdrant applies the IDF modifier).
+    """
+
+    _TOKEN_RE = re.compile(r"\w+")
+
+    def __init__(self, dim: int = EMBED_DIM):
+        self.dim = dim
+
+    @classmethod
+    def _hashes(cls, text: str) -> List[int]:
+        return [
+            int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+            for token in cls._TOKEN_RE.findall(text.lower())
+        ]
+
+    def embed(self, texts, batch_size: int = 64, parallel: Optional[int] = None):
+        for text in ([texts] if isinstance(texts, str) else texts):
+            vector = np.zeros(self.dim, dtype=np.float32)
+            for h in self._hashes(text):
+                vector[h % self.dim] += 1.0 if h >> 63 else -1.0
+            norm = np.linalg.norm(vector)
+            yield vector / norm if norm else vector
+
+    def sparse_embed(self, texts):
+        for text in ([texts] if isinstance(texts, str) else texts):
+            counts: Dict[int, float] = {}
+            for h in self._hashes(text):
+                index = h & 0x7FFFFFFF
+                counts[index] = counts.get(index, 0.0) + 1.0
+            yield SparseEmbedding(values=np.array(list(counts.values()), dtype=np.float32),
+                                  indices=np.array(list(counts.keys()), dtype=np.int64))
+
+
+class _HashingSparseEmbedding(HashingEmbedding):
+    """SparseTextEmbedding interface (embed / query_embed) over HashingEmbedding.sparse_embed."""
+
+    def embed(self, texts, batch_size: int = 64, parallel: Optional[int] = None):
+        return self.sparse_embed(texts)
+
+    def query_embed(self, texts):
+        return self.sparse_embed(texts)
+
+
+class Embedder:
+    """
+    Process-wide text embedder.
+
+    warmup() loads the model and runs one inference; embed()/aembed() queue a
+    query for the micro-batching worker, embed_many() runs a direct batched
+    pass (ingestion, offline batches). Methods warm up lazily if needed.
+    """
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL, batch_max: int = EMBED_BATCH_MAX,
+                 batch_wait_ms: float = EMBED_BATCH_WAIT_MS, cache_dir: Optional[str] = EMBED_CACHE_DIR,
+                 threads: Optional[int] = EMBED_THREADS):
+        self.model_name = model_name
+        self.batch_max = batch_max
+        self.batch_wait = batch_wait_ms / 1000
+        self.cache_dir = cache_dir
+        self.threads = threads
+        self._model: Optional[TextEmbedding] = None
+        self._queue: "queue.Queue" = queue.Queue()
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self._model is not None
+
+    def warmup(self):
+        if self._model is not None:
+            return
+        with self._lock:
+            if self._model is not None:
+                return
+            t0 = time.perf_counter()
+            if self.model_name == STUB_MODEL:
+                model = HashingEmbedding()
+            else:
+                model = TextEmbedding(model_name=self.model_name, cache_dir=self.cache_dir, threads=self.threads)
+            list(model.embed(["warm up"]))  # first inference initialises the ONNX session
+            self._model = model
+            threading.Thread(target=self._run, name="embedder", daemon=True).start()
+            EMBEDDER_READY.set(1)
+            print(f"Embedder '{self.model_name}' ready in {time.perf_counter() - t0:.1f}s")
+
+    def submit(self, text: str) -> Future:
+        self.warmup()
+        future: Future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def embed(self, text: str) -> List[float]:
+        return self.submit(text).result()
+
+    async def aembed(self, text: str) -> List[float]:
+        return await asyncio.wrap_future(self.submit(text))
+
+    def embed_many(self, texts: List[str], batch_size: int = 64, parallel: Optional[int] = None) -> List[List[float]]:
+        self.warmup()
+        return [v.tolist() for v in self._model.embed(texts, batch_size=batch_size, parallel=parallel)]
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_max:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            # claim the futures: callers that gave up meanwhile (a cancelled aembed()) are dropped,
+            # and the claimed ones can no longer be cancelled under us
+            batch = [(text, future) for text, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                self._embed_batch(batch)
+            except Exception as e:  # this is the only worker thread: fail the batch, never the loop
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _embed_batch(self, batch):
+        texts = [text for text, _ in batch]
+        t0 = time.perf_counter()
+        vectors = [v.tolist() for v in self._model.embed(texts, batch_size=len(texts))]
+        EMBED_BATCH_SECONDS.observe(time.perf_counter() - t0)
+        EMBED_BATCH_SIZE.observe(len(batch))
+        for (_, future), vector in zip(batch, vectors):
+            future.set_result(vector)
+
+
+class SparseEmbedder:
+    """
+    Process-wide sparse embedder (SPARSE_MODEL) for the hybrid retrieval side.
+    BM25 query embedding is tokenisation only, so queries are embedded
+    inline rather than micro-batched.
+    """
+
+    def __init__(self, model_name: str = SPARSE_MODEL, cache_dir: Optional[str] = EMBED_CACHE_DIR,
+                 threads: Optional[int] = EMBED_THREADS):
+        self.model_name = model_name
+        self.cache_dir = cache_dir
+        self.threads = threads
+        self._model: Optional[SparseTextEmbedding] = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self._model is not None
+
+    def warmup(self):
+        if self._model is not None:
+            return
+        with self._lock:
+            if self._model is not None:
+                return
+            if self.model_name == STUB_MODEL:
+                model = _HashingSparseEmbedding()
+            else:
+                model = SparseTextEmbedding(model_name=self.model_name, cache_dir=self.cache_dir, threads=self.threads)
+            list(model.query_embed("warm up"))
+            self._model = model
+
+    def embed(self, text: str) -> models.SparseVector:
+        self.warmup()
+        return _sparse_vector(next(iter(self._model.query_embed(text))))
+
+    async def aembed(self, text: str) -> models.SparseVector:
+        if self.ready:
+            return self.embed(text)
+        return await asyncio.to_thread(self.embed, text)
+
+    def embed_many(self, texts: List[str], batch_size: int = 64, parallel: Optional[int] = None) -> List[models.SparseVector]:
+        """Document-side embeddings (ingestion)."""
+        self.warmup()
+        return [_sparse_vector(e) for e in self._model.embed(texts, batch_size=batch_size, parallel=parallel)]
+
+    def embed_queries(self, texts: List[str]) -> List[models.SparseVector]:
+        """Query-side embeddings for many questions at once (batch_rag)."""
+        self.warmup()
+        return [_sparse_vector(e) for e in self._model.query_embed(texts)]
+
+
+class Reranker:
+    """
+    Process-wide cross-encoder (RERANK_MODEL). submit() queues one question
+    with its candidate documents on a pool of `workers` threads and returns
+    a Future of one relevance score per document; callers enforce their own
+    latency budget and may cancel() a pass that has not started yet.
+    """
+
+    def __init__(self, model_name: str = RERANK_MODEL, workers: int = RERANK_WORKERS,
+                 batch_size: int = RERANK_BATCH_SIZE, cache_dir: Optional[str] = EMBED_CACHE_DIR,
+                 threads: Optional[int] = RERANK_THREADS):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.cache_dir = cache_dir
+        self.threads = threads
+        self._model: Optional[TextCrossEncoder] = None
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="reranker")
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self._model is not None
+
+    def warmup(self):
+        if self._model is not None:
+            return
+        with self._lock:
+            if self._model is not None:
+                return
+            t0 = time.perf_counter()
+            model = TextCrossEncoder(model_name=self.model_name, cache_dir=self.cache_dir, threads=self.threads)
+            list(model.rerank("warm up", ["warm up"]))
+            self._model = model
+            print(f"Reranker '{self.model_name}' ready in {time.perf_counter() - t0:.1f}s")
+
+    def submit(self, query: str, documents: List[str]) -> Future:
+        return self._pool.submit(self.score, query, documents)
+
+    def score(self, query: str, documents: List[str]) -> List[float]:
+        self.warmup()
+        t0 = time.perf_counter()
+        scores = [float(s) for s in self._model.rerank(query, documents, batch_size=self.batch_size)]
+        RERANK_SECONDS.observe(time.perf_counter() - t0)
+        return scores
+
+
+def _sparse_vector(embedding) -> models.SparseVector:
+    return models.SparseVector(indices=embedding.indices.tolist(), values=embedding.values.tolist())
+
+
+_embedder: Optional[Embedder] = None
+_sparse_embedder: Optional[SparseEmbedder] = None
+_reranker: Optional[Reranker] = None
+_embedder_lock = threading.Lock()
+
+
+def get_embedder() -> Embedder:
+    """Returns the process-wide Embedder (not loaded until warmup()/first use)."""
+    global _embedder
+    if _embedder is None:
+        with _embedder_lock:
+            if _embedder is None:
+                _embedder = Embedder()
+    return _embedder
+
+
+def get_sparse_embedder() -> SparseEmbedder:
+    """Returns the process-wide SparseEmbedder (not loaded until warmup()/first use)."""
+    global _sparse_embedder
+    if _sparse_embedder is None:
+        with _embedder_lock:
+            if _sparse_embedder is None:
+                _sparse_embedder = SparseEmbedder()
+    return _sparse_embedder
+
+
+def get_reranker() -> Reranker:
+    """Returns the process-wide Reranker (not loaded until warmup()/first use)."""
+    global _reranker
+    if _reranker is None:
+        with _embedder_lock:
+            if _reranker is None:
+                _reranker = Reranker()
+    return _reranker
@@ -0,0 +1,312 @@
+# eval_rag.py — Parallel, resumable RAG answer-quality evaluation (LLM-as-a-Judge)
+#
+# Usage (from the project root):
+#   python music-theory-assistant/eval_rag.py --models gpt-4o-mini gpt-4o --limit 200
+#   python music-theory-assistant/eval_rag.py --stub --limit 50     # CI: local OpenAI + Qdrant stubs
+#
+# The notebook version ran rag() and evaluate_relevance() one row at a time.
+# Here every (question, model) pair is answered with at most --concurrency
+# LLM calls in flight (and at most --rpm requests per minute), then the
+# answers are judged --judge-batch at a time with one judge call per batch
+# (rag.aevaluate_relevance_batch). A 429 pauses every worker for the
+# Retry-After the API sent (or an exponential backoff with jitter). call()
+# is the only retry layer: rag's OpenAI caller is swapped for one that makes
+# a single attempt per call (single_attempt_caller).
+#
+# Progress is appended to <output-dir>/checkpoint.jsonl as each answer and
+# each verdict lands; rerunning with the same --output-dir skips finished
+# work. The run writes <output-dir>/rag-eval-<model>.csv (the columns of
+# data/rag-eval-gpt-4o*.csv plus tokens, cost and latency) and
+# <output-dir>/summary.json with, per model, the relevance distribution,
+# tokens, cost and answer latency percentiles.
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from typing import Any, Dict, List
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+GROUND_TRUTH_PATH = os.getenv("GROUND_TRUTH_PATH", "data/ground-truth-retrieval.csv")
+EVAL_OUTPUT_DIR = os.getenv("EVAL_OUTPUT_DIR", "data/rag-eval-runs/latest")
+EVAL_MAX_RETRIES = int(os.getenv("EVAL_MAX_RETRIES", "6"))
+EVAL_RETRY_BASE_SECONDS = float(os.getenv("EVAL_RETRY_BASE_SECONDS", "1.0"))
+
+RELEVANCE_LABELS = ("RELEVANT", "PARTLY_RELEVANT", "NON_RELEVANT", "UNKNOWN")
+CSV_COLUMNS = [
+    "answer", "id", "question", "relevance", "explanation", "model", "response_time",
+    "prompt_tokens", "completion_tokens", "eval_prompt_tokens", "eval_completion_tokens", "openai_cost",
+]
+
+
+# --------- Rate limiting ---------
+class RateLimiter:
+    """
+    Shared by all workers: spaces requests to at most `rpm` per minute
+    (0 = no limit) and holds every worker back after a 429 until the
+    Retry-After has passed.
+    """
+
+    def __init__(self, rpm: float = 0):
+        self.interval = 60 / rpm if rpm else 0.0
+        self._next_slot = 0.0
+        self._resume_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_slot, self._resume_at)
+            self._next_slot = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    def pause(self, seconds: float):
+        self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+
+def single_attempt_caller():
+    """
+    A ResilientCaller without retries, hedging or a breaker that opens, for
+    rag.llm_caller during a run: 429s reach call() with their Retry-After,
+    and an evaluation waits out an outage instead of failing fast.
+    """
+    from resilience import CircuitBreaker, ResilientCaller
+    return ResilientCaller(CircuitBreaker(failure_rate=1.1), max_retries=0, hedge=False)
+
+
+async def call(limiter: RateLimiter, semaphore: asyncio.Semaphore, fn, *args, **kwargs):
+    """fn(*args, **kwargs) under the concurrency + rate limits, retried on 429 / 5xx / timeouts."""
+    import openai
+    from resilience import RETRYABLE_ERRORS, retry_after
+
+    for attempt in range(EVAL_MAX_RETRIES + 1):
+        await limiter.acquire()
+        try:
+            async with semaphore:
+                return await fn(*args, **kwargs)
+        except RETRYABLE_ERRORS as e:
+            if attempt == EVAL_MAX_RETRIES:
+                raise
+            delay = EVAL_RETRY_BASE_SECONDS * 2 ** attempt
+            delay = delay / 2 + random.random() * delay / 2
+            if isinstance(e, openai.RateLimitError):
+                limiter.pause(retry_after(e) or delay)
+            else:
+                await asyncio.sleep(delay)
+
+
+# --------- Checkpoint ---------
+def load_checkpoint(path: str) -> Dict[str, Dict[str, Any]]:
+    """key -> latest record state (answered, then judged) from the JSONL checkpoint."""
+    records: Dict[str, Dict[str, Any]] = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # torn last line of an interrupted run
+                records[record["key"]] = record
+    return records
+
+
+class Checkpoint:
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(path, "a", encoding="utf-8")
+
+    def write(self, record: Dict[str, Any]):
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+# --------- Run ---------
+async def answer_all(todo, records, checkpoint, limiter, semaphore, top_k: int):
+    from rag import aretrieve, allm, render_prompt, calculate_openai_cost
+
+    retrievals: Dict[int, asyncio.Task] = {}
+
+    async def one(row, model):
+        if row["row"] not in retrievals:  # one retrieval per question, shared by every model
+            retrievals[row["row"]] = asyncio.ensure_future(aretrieve(row["question"], top_k))
+        t0 = time.perf_counter()
+        _, context = await retrievals[row["row"]]
+        answer, tokens = await call(limiter, semaphore, allm, render_prompt(row["question"], context), model=model)
+        record = {
+            "key": f"{row['row']}:{model}", "row": row["row"], "id": row["id"], "question": row["question"],
+            "model": model, "answer": answer, "response_time": time.perf_counter() - t0,
+            "prompt_tokens": tokens["prompt_tokens"], "completion_tokens": tokens["completion_tokens"],
+            "answer_cost": calculate_openai_cost(model, tokens), "relevance": None,
+        }
+        records[record["key"]] = record
+        checkpoint.write(record)
+
+    results = await asyncio.gather(*(one(row, model) for row, model in todo), return_exceptions=True)
+    return [r for r in results if isinstance(r, Exception)]
+
+
+async def judge_all(keys, records, checkpoint, limiter, semaphore, judge_model: str, batch_size: int):
+    from rag import aevaluate_relevance, aevaluate_relevance_batch, calculate_openai_cost
+
+    def done(record, relevance, tokens):
+        record.update({
+            "relevance": relevance.get("Relevance", "UNKNOWN"),
+            "explanation": relevance.get("Explanation", "Failed to parse evaluation"),
+            "eval_prompt_tokens": record.get("eval_prompt_tokens", 0) + tokens["prompt_tokens"],
+            "eval_completion_tokens": record.get("eval_completion_tokens", 0) + tokens["completion_tokens"],
+            "eval_cost": record.get("eval_cost", 0.0) + calculate_openai_cost(judge_model, tokens),
+        })
+        checkpoint.write(record)
+
+    async def one_batch(batch):
+        pairs = [(records[k]["question"], records[k]["answer"]) for k in batch]
+        if len(batch) == 1:
+            verdicts = [await call(limiter, semaphore, aevaluate_relevance, *pairs[0], model=judge_model)]
+        else:
+            verdicts = await call(limiter, semaphore, aevaluate_relevance_batch, pairs, model=judge_model)
+        for key, (relevance, tokens) in zip(batch, verdicts):
+            if relevance.get("Relevance") == "UNKNOWN" and len(batch) > 1:
+                # not in the batched reply: judge this one on its own
+                relevance, single_tokens = await call(limiter, semaphore, aevaluate_relevance,
+                                                      *pairs[batch.index(key)], model=judge_model)
+                tokens = {f: tokens[f] + single_tokens[f] for f in tokens}
+            done(records[key], relevance, tokens)
+
+    batches = [keys[i:i + batch_size] for i in range(0, len(keys), batch_size)]
+    results = await asyncio.gather(*(one_batch(b) for b in batches), return_exceptions=True)
+    return [r for r in results if isinstance(r, Exception)]
+
+
+def summarize(records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Per model: relevance distribution, tokens, cost and answer latency percentiles."""
+    summary = {}
+    for model in sorted({r["model"] for r in records}):
+        rows = [r for r in records if r["model"] == model]
+        judged = [r for r in rows if r.get("relevance")]
+        lat = np.array([r["response_time"] for r in rows]) * 1000
+        counts = {label: sum(r["relevance"] == label for r in judged) for label in RELEVANCE_LABELS}
+        cost = sum(r["answer_cost"] + r.get("eval_cost", 0.0) for r in rows)
+        summary[model] = {
+            "answered": len(rows),
+            "judged": len(judged),
+            "relevance": counts,
+            "relevance_share": {label: n / len(judged) if judged else 0.0 for label, n in counts.items()},
+            "prompt_tokens": sum(r["prompt_tokens"] for r in rows),
+            "completion_tokens": sum(r["completion_tokens"] for r in rows),
+            "eval_prompt_tokens": sum(r.get("eval_prompt_tokens", 0) for r in rows),
+            "eval_completion_tokens": sum(r.get("eval_completion_tokens", 0) for r in rows),
+            "openai_cost": cost,
+            "cost_per_question": cost / len(rows),
+            "p50_ms": float(np.percentile(lat, 50)),
+            "p95_ms": float(np.percentile(lat, 95)),
+            "p99_ms": float(np.percentile(lat, 99)),
+        }
+    return summary
+
+
+def write_outputs(records: List[Dict[str, Any]], output_dir: str) -> Dict[str, Any]:
+    for model in sorted({r["model"] for r in records}):
+        rows = sorted((r for r in records if r["model"] == model), key=lambda r: r["row"])
+        df = pd.DataFrame([
+            {**r, "openai_cost": r["answer_cost"] + r.get("eval_cost", 0.0)} for r in rows
+        ]).reindex(columns=CSV_COLUMNS)
+        df.to_csv(os.path.join(output_dir, f"rag-eval-{model}.csv"), index=False)
+
+    summary = summarize(records)
+    with open(os.path.join(output_dir, "summary.json"), "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+async def run(args):
+    import rag
+    from rag import OPENAI_MODEL
+
+    rag.llm_caller = single_attempt_caller()
+    judge_model = args.judge_model or OPENAI_MODEL
+    models = args.models or [OPENAI_MODEL]
+    gt = pd.read_csv(GROUND_TRUTH_PATH)
+    if args.limit:
+        gt = gt.head(args.limit)
+    # `row` (ground-truth line) keys the checkpoint; `id` is the expected song, as in data/rag-eval-*.csv
+    rows = [{"row": i, "question": q, "id": int(d)} for i, (q, d) in enumerate(zip(gt["question"], gt["id"]))]
+
+    checkpoint_path = os.path.join(args.output_dir, "checkpoint.jsonl")
+    records = load_checkpoint(checkpoint_path)
+    wanted = {f"{row['row']}:{model}" for row in rows for model in models}
+    todo = [(row, model) for row in rows for model in models if f"{row['row']}:{model}" not in records]
+    print(f"{len(wanted)} (question, model) pairs, {len(wanted) - len(todo)} already answered "
+          f"in {checkpoint_path}", file=sys.stderr)
+
+    limiter = RateLimiter(args.rpm)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    checkpoint = Checkpoint(checkpoint_path)
+    t0 = time.perf_counter()
+    try:
+        errors = await answer_all(todo, records, checkpoint, limiter, semaphore, args.top_k)
+        t_answer = time.perf_counter() - t0
+        unjudged = [k for k in sorted(wanted) if k in records and records[k].get("relevance") is None]
+        errors += await judge_all(unjudged, records, checkpoint, limiter, semaphore, judge_model, args.judge_batch)
+    finally:
+        checkpoint.close()
+    took = time.perf_counter() - t0
+
+    for e in errors[:5]:
+        print(f"[eval] {type(e).__name__}: {e}", file=sys.stderr)
+    summary = write_outputs([records[k] for k in sorted(wanted) if k in records], args.output_dir)
+    print(json.dumps(summary, indent=2))
+    print(f"Answered {len(todo)} in {t_answer:.1f}s, judged {len(unjudged)} in {took - t_answer:.1f}s "
+          f"({len(errors)} errors); results in {args.output_dir}", file=sys.stderr)
+    return 1 if errors else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer + judge the ground truth per model, in parallel.")
+    parser.add_argument("--models", nargs="+", help="answering models (default: OPENAI_MODEL)")
+    parser.add_argument("--judge-model", help="judge model (default: OPENAI_MODEL)")
+    parser.add_argument("--limit", type=int, default=None, help="only use the first N questions")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=16, help="LLM calls in flight")
+    parser.add_argument("--rpm", type=float, default=0, help="max LLM requests per minute (0 = no limit)")
+    parser.add_argument("--judge-batch", type=int, default=8, help="answers judged per judge call")
+    parser.add_argument("--output-dir", default=EVAL_OUTPUT_DIR, help="checkpoint + results; reuse it to resume")
+    parser.add_argument("--stub", action="store_true", help="run against local OpenAI + Qdrant stubs (no network)")
+    parser.add_argument("--stub-latency-ms", type=float, default=50.0)
+    args = parser.parse_args()
+
+    servers = []
+    if args.stub:
+        from stub_servers import serve_in_process
+        servers = [
+            serve_in_process("openai", 18082, "--latency-ms", str(args.stub_latency_ms)),
+            serve_in_process("qdrant", 16336, "--latency-ms", "5"),
+        ]
+        # rag reads its config at import time, so point it at the stubs first
+        os.environ["OPENAI_BASE_URL"] = "http://127.0.0.1:18082/v1"
+        os.environ["OPENAI_API_KEY"] = "stub"
+        os.environ["QDRANT_URL"] = "http://127.0.0.1:16336"
+        os.environ.setdefault("EMBED_MODEL", "stub")
+        os.environ["RETRIEVER_BACKEND"] = "qdrant"
+        os.environ["RETRIEVAL_MODE"] = "dense"
+        os.environ["RETRIEVAL_CACHE"] = "0"
+        os.environ["QUERY_FILTERS"] = "0"
+    try:
+        status = asyncio.run(run(args))
+    finally:
+        for server in servers:
+            server.terminate()
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+# evaluate.py — Retrieval quality (hit rate / MRR / recall@k) and latency on the ground truth
+#
+# Usage (from the project root):
+#   python music-theory-assistant/evaluate.py --retrievers dense hybrid minsearch -o data/retrieval-report.json
+#   python music-theory-assistant/evaluate.py --retrievers minsearch local --baseline data/retrieval-baseline.json
+#
+# Every question in data/ground-truth-retrieval.csv is sent through each
+# retriever from a pool of --concurrency threads. Per retriever the JSON
+# report has hit rate and MRR at --top-k, recall@k for every --ks, latency
+# percentiles (per query, embedding included) and QPS (questions / wall time).
+#
+# With --baseline, the run is compared with a stored report and exits with
+# status 1 when any retriever loses more than --max-quality-drop (absolute)
+# on a quality metric, or gets more than --max-latency-increase (relative)
+# slower at p95/p99. Write the baseline with `-o` from a known good run.
+#
+# Offline / CI: `EMBED_MODEL=stub SPARSE_MODEL=stub` use the hashing model in
+# embedder.py (no downloads); ingest with the same settings into a local
+# Qdrant (dense, hybrid) or RETRIEVER_BACKEND=local (local). `minsearch`
+# needs no index at all: it fits lexical_index.LexicalIndex (the service
+# port of notebooks/minsearch.py, same boosts) on the dataset CSV.
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from lexical_index import LexicalIndex, LEXICAL_BOOST
+
+GROUND_TRUTH_PATH = os.getenv("GROUND_TRUTH_PATH", "data/ground-truth-retrieval.csv")
+CSV_PATH = os.getenv("CSV_PATH", "data/music-theory-dataset-100.csv")
+
+QUALITY_METRICS = ("hit_rate", "mrr")
+LATENCY_METRICS = ("p95_ms", "p99_ms")
+
+
+# --------- Retrievers ---------
+# each factory returns search(question, k) -> ranked point ids; rag is only
+# imported by the retrievers that need it (it opens the Qdrant / OpenAI clients)
+def _dense() -> Callable[[str, int], List[int]]:
+    from rag import vector_search
+    return lambda question, k: [h.id for h in vector_search(question, k)]
+
+
+def _hybrid(fusion: str) -> Callable[[str, int], List[int]]:
+    def factory():
+        from rag import hybrid_search
+        return lambda question, k: [h.id for h in hybrid_search(question, k, fusion=fusion)]
+    return factory
+
+
+def _local() -> Callable[[str, int], List[int]]:
+    from rag import embedder
+    from local_index import LocalIndex
+    index = LocalIndex()
+    return lambda question, k: [h.id for h in index.search(embedder.embed(question), k)]
+
+
+def _minsearch() -> Callable[[str, int], List[int]]:
+    docs = pd.read_csv(CSV_PATH, encoding="utf-8-sig").to_dict(orient="records")
+    index = LexicalIndex().fit(docs)
+    return lambda question, k: [int(docs[row]["id"]) for row, _ in index.search(question, None, LEXICAL_BOOST, k)]
+
+
+def _pipeline() -> Callable[[str, int], List[int]]:
+    from rag import search
+    return lambda question, k: [h.id for h in search(question, k)]
+
+
+RETRIEVERS: Dict[str, Callable[[], Callable[[str, int], List[int]]]] = {
+    "dense": _dense,  # rag.vector_search() on Qdrant
+    "hybrid": _hybrid("rrf"),  # dense + BM25, RRF fusion
+    "hybrid-dbsf": _hybrid("dbsf"),
+    "local": _local,  # embedded dense index (RETRIEVER_BACKEND=local ingest)
+    "minsearch": _minsearch,  # boosted TF-IDF, fitted in memory
+    "pipeline": _pipeline,  # rag.search() as configured: backend, filters, rerank
+}
+
+
+# --------- Evaluation ---------
+def evaluate(search: Callable[[str, int], List[int]], questions: List[str], doc_ids: List[int],
+             top_k: int, ks: List[int], concurrency: int) -> Dict[str, Any]:
+    depth = max([top_k, *ks])
+
+    def one(i: int):
+        t0 = time.perf_counter()
+        ids = search(questions[i], depth)
+        return ids, time.perf_counter() - t0
+
+    search(questions[0], depth)  # warm up (model load, connections)
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(len(questions))))
+    wall = time.perf_counter() - t0
+
+    ranks = []
+    for (ids, _), doc_id in zip(results, doc_ids):
+        ranks.append(ids.index(doc_id) + 1 if doc_id in ids else None)
+    lat = np.array([latency for _, latency in results]) * 1000
+
+    def hit(k: int) -> float:
+        return sum(r is not None and r <= k for r in ranks) / len(ranks)
+
+    return {
+        "hit_rate": hit(top_k),
+        "mrr": sum(1 / r for r in ranks if r is not None and r <= top_k) / len(ranks),
+        # one relevant song per question, so recall@k is the hit rate at k
+        **{f"recall@{k}": hit(k) for k in ks},
+        "p50_ms": float(np.percentile(lat, 50)),
+        "p95_ms": float(np.percentile(lat, 95)),
+        "p99_ms": float(np.percentile(lat, 99)),
+        "mean_ms": float(lat.mean()),
+        "qps": len(lat) / wall,
+    }
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], max_quality_drop: float,
+            max_latency_increase: float) -> List[str]:
+    """Regressions of `report` against `baseline`, as readable lines (empty = pass)."""
+    failures = []
+    for name, current in report["retrievers"].items():
+        base = baseline.get("retrievers", {}).get(name)
+        if base is None:
+            continue
+        quality = [m for m in base if m in QUALITY_METRICS or m.startswith("recall@")]
+        for metric in quality:
+            if metric in current and current[metric] < base[metric] - max_quality_drop:
+                failures.append(f"{name}: {metric} {current[metric]:.3f} < baseline {base[metric]:.3f}")
+        for metric in LATENCY_METRICS:
+            if metric in base and current[metric] > base[metric] * (1 + max_latency_increase):
+                failures.append(f"{name}: {metric} {current[metric]:.1f}ms > baseline {base[metric]:.1f}ms "
+                                f"(+{max_latency_increase:.0%} allowed)")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate retrievers on the ground truth (quality + latency).")
+    parser.add_argument("--retrievers", nargs="+", choices=list(RETRIEVERS), default=["dense", "hybrid", "minsearch"])
+    parser.add_argument("--top-k", type=int, default=5, help="cut-off for hit rate and MRR")
+    parser.add_argument("--ks", type=int, nargs="+", default=[1, 3, 5, 10], help="recall@k cut-offs")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--limit", type=int, default=None, help="only use the first N questions")
+    parser.add_argument("-o", "--output", help="write the JSON report here (default: stdout)")
+    parser.add_argument("--baseline", help="stored report to compare with; exit 1 on regressions")
+    parser.add_argument("--max-quality-drop", type=float, default=0.01, help="allowed absolute drop")
+    parser.add_argument("--max-latency-increase", type=float, default=0.25, help="allowed relative p95/p99 increase")
+    args = parser.parse_args()
+
+    gt = pd.read_csv(GROUND_TRUTH_PATH)
+    if args.limit:
+        gt = gt.head(args.limit)
+    questions = gt["question"].tolist()
+    doc_ids = gt["id"].astype(int).tolist()
+
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "questions": len(questions),
+        "top_k": args.top_k,
+        "concurrency": args.concurrency,
+        "config": {
+            "embed_model": os.getenv("EMBED_MODEL", "jinaai/jina-embeddings-v2-small-en"),
+            "sparse_model": os.getenv("SPARSE_MODEL", "Qdrant/bm25"),
+            "retriever_backend": os.getenv("RETRIEVER_BACKEND", "qdrant"),
+            "retrieval_mode": os.getenv("RETRIEVAL_MODE", "dense"),
+            "rerank": os.getenv("RERANK", "0"),
+            "host": platform.node(),
+        },
+        "retrievers": {},
+    }
+    for name in args.retrievers:
+        result = evaluate(RETRIEVERS[name](), questions, doc_ids, args.top_k, args.ks, args.concurrency)
+        report["retrievers"][name] = result
+        print(
+            f"{name:<12} hit_rate={result['hit_rate']:.3f} mrr={result['mrr']:.3f} "
+            f"p50={result['p50_ms']:.1f}ms p95={result['p95_ms']:.1f}ms p99={result['p99_ms']:.1f}ms "
+            f"qps={result['qps']:.1f}",
+            file=sys.stderr,
+        )
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            failures = compare(report, json.load(f), args.max_quality_drop, args.max_latency_increase)
+        for line in failures:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if failures:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+# fast_path.py — Template answers for single-field song lookups
+#
+# "What is the key of 'Let It Be'?" is answered by one payload field, so the
+# LLM adds nothing but latency and cost. SongCatalog keeps every song payload
+# in memory (Qdrant scroll, or payloads() of the local / lexical index),
+# indexed by title words and re-read when the collection version changes.
+# answer() returns a templated answer when the question asks for exactly one
+# field of exactly one song, resolved by title (and artist, if the title is
+# not unique), and None for everything else, which then takes the normal RAG
+# path.
+import re
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from prometheus_client import Counter
+from qdrant_client import models
+
+TEMPLATE_LOOKUPS = Counter(
+    "rag_template_lookups_total", "Template fast-path checks: hit (answered without the LLM) vs miss", ["result"]
+)
+FAST_PATH_METRICS = (TEMPLATE_LOOKUPS,)
+
+# asked field -> phrases that ask for it
+_FIELD_PATTERNS = {
+    "key": r"\bkey\b(?!\s+changes?)",
+    "tempo_bpm": r"\b(?:tempo|bpm|beats per minute|how fast)\b",
+    "time_signature": r"\b(?:time signature|meter|metre)\b",
+    "chord_progression": r"\b(?:chord progression|chords)\b",
+    "roman_numerals": r"\broman numerals?\b",
+    "cadence": r"\bcadences?\b",
+    "genre": r"\b(?:genre|style of music)\b",
+    "artist": r"\b(?:who (?:wrote|composed|performed|performs|sang|sings|recorded)|artist|composer|performer)\b",
+}
+_FIELD_RES = {field: re.compile(pattern, re.IGNORECASE) for field, pattern in _FIELD_PATTERNS.items()}
+# plain "what / which / who / tell me" questions only; anything asking for an explanation takes the RAG path
+_LOOKUP_START_RE = re.compile(
+    r"^\s*(?:what(?:'s| is| are)?|which|who|in what|in which|can you (?:tell|give|provide)|could you (?:tell|give|provide)"
+    r"|tell me|give me)\b",
+    re.IGNORECASE,
+)
+_EXPLAIN_RE = re.compile(
+    r"\b(?:why|how (?:does|do|is|are|did)|explain\w*|describe|analy[sz]\w*|compar\w*|differen\w*|function\w*"
+    r"|effect\w*|relat\w*|similar\w*|change\w*|modulat\w*|borrow\w*|theory|concepts?|elements?|songs|other)\b",
+    re.IGNORECASE,
+)
+_QUOTES = "'\"‘’“”"
+_WORD_RE = re.compile(r"\w+")
+
+TEMPLATES = {
+    "key": "'{title}' by {artist} is in {key}.",
+    "tempo_bpm": "'{title}' by {artist} has a tempo of {tempo_bpm} BPM.",
+    "time_signature": "'{title}' by {artist} is in {time_signature} time.",
+    "chord_progression": "The chord progression of '{title}' by {artist} is {chord_progression} ({roman_numerals}).",
+    "roman_numerals": "In Roman numerals, '{title}' by {artist} follows {roman_numerals} ({chord_progression}).",
+    "cadence": "Cadence in '{title}' by {artist}: {cadence}.",
+    "genre": "'{title}' by {artist} belongs to the {genre} genre.",
+    "artist": "'{title}' is by {artist}.",
+}
+
+
+def _normalise(text: str) -> str:
+    return re.sub(r"\s+", " ", text.replace("’", "'").replace("‘", "'")).strip()
+
+
+def _format(value: Any) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def mentioned_fields(question: str) -> List[str]:
+    """Every payload field the question mentions, lookup or not."""
+    return [field for field, pattern in _FIELD_RES.items() if pattern.search(question)]
+
+
+def asked_field(question: str) -> Optional[str]:
+    """The one payload field a plain lookup question asks for, or None."""
+    if not _LOOKUP_START_RE.search(question) or _EXPLAIN_RE.search(question):
+        return None
+    fields = mentioned_fields(question)
+    return fields[0] if len(fields) == 1 else None
+
+
+class SongCatalog:
+    """
+    Song payloads indexed by title words (lowercased word tuple -> title and
+    its songs), built once per collection version (same contract as
+    rag.FilterVocabulary). A lookup lists the question's word n-grams up to
+    the longest title and checks each against the index, so it costs
+    O(question words x longest title) however many songs there are.
+    """
+
+    def __init__(self, qd, version, collection: str, local=None):
+        self.qd = qd
+        self.version = version
+        self.collection = collection
+        self.local = local
+        self._titles: Dict[Tuple[str, ...], Tuple[str, List[Dict[str, Any]]]] = {}
+        self._max_words = 0
+        self._loaded_for: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def get(self) -> Dict[Tuple[str, ...], Tuple[str, List[Dict[str, Any]]]]:
+        current = self.version.current()
+        if self._loaded_for != current:
+            with self._lock:
+                if self._loaded_for != current:
+                    self._titles = self._index(self._load())
+                    self._max_words = max(map(len, self._titles), default=0)
+                    self._loaded_for = current
+        return self._titles
+
+    def _load(self) -> List[Dict[str, Any]]:
+        if self.local is not None:
+            return self.local.payloads()
+        payloads: List[Dict[str, Any]] = []
+        offset = None
+        try:
+            while True:
+                points, offset = self.qd.scroll(
+                    collection_name=self.collection, limit=10_000, offset=offset,
+                    with_payload=True, with_vectors=False,
+                )
+                payloads.extend(p.payload for p in points if p.payload)
+                if offset is None:
+                    return payloads
+        except Exception as e:
+            print(f"[fast path] Could not load song payloads: {e}")
+            return []
+
+    @staticmethod
+    def _index(payloads: List[Dict[str, Any]]) -> Dict[Tuple[str, ...], Tuple[str, List[Dict[str, Any]]]]:
+        titles: Dict[Tuple[str, ...], Tuple[str, List[Dict[str, Any]]]] = {}
+        for payload in payloads:
+            title = _normalise(str(payload.get("title") or ""))
+            words = tuple(w.lower() for w in _WORD_RE.findall(title))
+            if words:
+                titles.setdefault(words, (title, []))[1].append(payload)
+        return titles
+
+    def _match(self, question: str) -> Tuple[List[Tuple[str, List[Dict[str, Any]]]], str]:
+        """(title, songs) for every title the question names, and the question without them."""
+        titles = self.get()
+        text = _normalise(question)
+        words = list(_WORD_RE.finditer(text))
+        lowered = [w.group().lower() for w in words]
+        taken = [False] * len(words)
+        matched: Dict[str, List[Dict[str, Any]]] = {}
+        spans = []
+        for n in range(min(self._max_words, len(words)), 0, -1):  # longest title first
+            for i in range(len(words) - n + 1):
+                entry = titles.get(tuple(lowered[i:i + n]))
+                if entry is None or any(taken[i:i + n]):
+                    continue
+                title, songs = entry
+                start, end = words[i].start(), words[i + n - 1].end()
+                quoted = start > 0 and text[start - 1] in _QUOTES and end < len(text) and text[end] in _QUOTES
+                # a quoted title matches in any case; an unquoted one-word title ("Black", "Hurt")
+                # only with its capitalisation, so ordinary words don't resolve to songs
+                if not quoted and " " not in title and [w.group() for w in words[i:i + n]] != _WORD_RE.findall(title):
+                    continue
+                taken[i:i + n] = [True] * n
+                matched.setdefault(title, songs)
+                spans.append((start, end))
+        for start, end in sorted(spans, reverse=True):
+            text = text[:start] + " " + text[end:]
+        return list(matched.items()), text
+
+    def named_titles(self, question: str) -> List[str]:
+        """Normalised titles of the songs the question names."""
+        return [title for title, _ in self._match(question)[0]]
+
+    def resolve(self, question: str) -> Optional[Dict[str, Any]]:
+        """The payload of the one song the question names, or None (no match / ambiguous)."""
+        matched, text = self._match(question)
+        if len(matched) != 1:
+            return None
+        songs = matched[0][1]
+        if len(songs) > 1:  # same title, different songs: the artist must disambiguate
+            songs = [s for s in songs if str(s.get("artist") or "").lower() in text.lower()]
+        return songs[0] if len(songs) == 1 else None
+
+    def answer(self, question: str) -> Optional[Tuple[str, models.ScoredPoint]]:
+        """(templated answer, the song as a source hit) for a single-field lookup, or None."""
+        result = None
+        field = asked_field(question)
+        song = self.resolve(question) if field is not None else None
+        if song is not None and song.get(field) not in (None, ""):
+            values = {name: _format(song.get(name, "")) for name in ("title", "artist", field)}
+            values.setdefault("roman_numerals", _format(song.get("roman_numerals", "")))
+            values.setdefault("chord_progression", _format(song.get("chord_progression", "")))
+            answer = TEMPLATES[field].format(**values)
+            result = answer, models.ScoredPoint(id=int(song["id"]), version=0, score=1.0, payload=song)
+        TEMPLATE_LOOKUPS.labels("hit" if result is not None else "miss").inc()
+        return result
@@ -1,9 +1,41 @@
 # ingest.py — Automated ingestion into Qdrant
+#
+# QDRANT_COLLECTION is an alias. Each run (INGEST_STRATEGY=bluegreen) builds a
+# new versioned collection `<QDRANT_COLLECTION>-v<timestamp>` next to the live
+# one, copies vectors of unchanged rows from it, embeds only new or changed
+# rows (every point carries a `content_hash`) into named dense + BM25 sparse
+# vectors, sanity-checks the result and
+# then swaps the alias atomically, so queries never see a missing or
+# half-filled collection. The newest INGEST_KEEP_VERSIONS collections are
+# kept for rollback (`python ingest.py --rollback`).
+#
+# INGEST_STRATEGY=inplace updates a plain collection in place instead:
+# unchanged rows are skipped and ids that disappeared are deleted.
+#
+# The CSV is streamed in chunks and progress is checkpointed per chunk, so an
+# interrupted run resumes where it stopped.
+#
+# RETRIEVER_BACKEND=local writes the embedded index of local_index.py instead
+# (no Qdrant server): a memory-mapped .npy of dense vectors plus columnar
+# payloads, reusing the vectors of unchanged rows from the previous version.
+# RETRIEVER_BACKEND=lexical fits and pickles the TF-IDF index of lexical_index.py.
 import os
+import re
+import json
+import time
+import hashlib
+import argparse
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
 import pandas as pd
 from qdrant_client import QdrantClient, models
 from dotenv import load_dotenv
 
+from cache import SemanticCache, CollectionVersion, write_collection_version
+from embedder import Embedder, SparseEmbedder, DENSE_VECTOR, SPARSE_VECTOR, SPARSE_MODEL
+from local_index import LocalIndex, LocalIndexWriter, LOCAL_INDEX_DIR
+from lexical_index import LexicalIndex, build_lexical_index, LEXICAL_INDEX_PATH
+
 # Load env vars from .envrc/.env if available
 load_dotenv()
 
@@ -14,6 +46,41 @@ COLLECTION = os.getenv("QDRANT_COLLECTION", "zoomcamp-music-theory-assistant")
 EMBED_MODEL = os.getenv("EMBED_MODEL", "jinaai/jina-embeddings-v2-small-en")
 EMBED_DIM = int(os.getenv("EMBED_DIM", "512"))
 
+INGEST_CHUNK_SIZE = int(os.getenv("INGEST_CHUNK_SIZE", "2000"))  # CSV rows read per chunk
+INGEST_EMBED_BATCH_SIZE = int(os.getenv("INGEST_EMBED_BATCH_SIZE", "64"))
+INGEST_EMBED_PARALLEL = os.getenv("INGEST_EMBED_PARALLEL")  # fastembed worker processes ("0" = all cores, unset = in-process)
+INGEST_UPSERT_BATCH_SIZE = int(os.getenv("INGEST_UPSERT_BATCH_SIZE", "256"))
+INGEST_UPSERT_PARALLEL = int(os.getenv("INGEST_UPSERT_PARALLEL", "1"))
+INGEST_CHECKPOINT_PATH = os.getenv("INGEST_CHECKPOINT_PATH", ".ingest-checkpoint.json")
+INGEST_STRATEGY = os.getenv("INGEST_STRATEGY", "bluegreen")  # "bluegreen" | "inplace"
+INGEST_KEEP_VERSIONS = int(os.getenv("INGEST_KEEP_VERSIONS", "2"))  # versioned collections kept (live + rollback)
+INGEST_READY_TIMEOUT = float(os.getenv("INGEST_READY_TIMEOUT", "300"))  # max wait for the new collection (s)
+RETRIEVER_BACKEND = os.getenv("RETRIEVER_BACKEND", "qdrant")  # "qdrant" | "local" | "lexical" (no Qdrant)
+
+# Collection tuning, applied when a collection is created (blue/green rebuilds when it changes)
+QDRANT_QUANTIZATION = os.getenv("QDRANT_QUANTIZATION", "none")  # none | scalar | binary
+QDRANT_QUANTIZATION_ALWAYS_RAM = os.getenv("QDRANT_QUANTIZATION_ALWAYS_RAM", "1") == "1"  # keep quantized vectors in RAM
+QDRANT_ON_DISK = os.getenv("QDRANT_ON_DISK", "0") == "1"  # memory-map original dense vectors from disk
+QDRANT_ON_DISK_PAYLOAD = os.getenv("QDRANT_ON_DISK_PAYLOAD", "0") == "1"
+QDRANT_HNSW_M = int(os.getenv("QDRANT_HNSW_M", "16"))
+QDRANT_HNSW_EF_CONSTRUCT = int(os.getenv("QDRANT_HNSW_EF_CONSTRUCT", "100"))
+
+HASH_FIELD = "content_hash"
+
+# payload indexes backing rag.parse_filter(): exact-match keywords, full-text
+# cadence ("Deceptive (V–vi)" matches "deceptive") and a range index on tempo
+PAYLOAD_INDEXES = {
+    "key": models.PayloadSchemaType.KEYWORD,
+    "genre": models.PayloadSchemaType.KEYWORD,
+    "artist": models.PayloadSchemaType.KEYWORD,
+    "time_signature": models.PayloadSchemaType.KEYWORD,
+    "cadence": models.TextIndexParams(
+        type=models.TextIndexType.TEXT, tokenizer=models.TokenizerType.WORD, lowercase=True,
+    ),
+    "tempo_bpm": models.IntegerIndexParams(type=models.IntegerIndexType.INTEGER, lookup=False, range=True),
+}
+
+
 def build_text(row):
     return " | ".join([
         str(row["title"]),
@@ -28,34 +95,517 @@ def build_text(row):
         f"Notes: {row['theory_notes']}",
     ])
 
-def main():
-    df = pd.read_csv(CSV_PATH, encoding="utf-8-sig")
-    docs = df.to_dict(orient="records")
 
-    qd = QdrantClient(QD_URL)
+def content_hash(row) -> str:
+    """Stable hash of the whole row (payload + embedded text) and the embedding models."""
+    blob = json.dumps(row, sort_keys=True, default=str) + EMBED_MODEL + SPARSE_MODEL
+    return hashlib.sha1(blob.encode("utf-8")).hexdigest()
+
+
+# --------- Qdrant helpers ---------
+def collection_tuning(**overrides) -> Dict[str, Any]:
+    """Storage/index settings for new collections: the QDRANT_* config above, with overrides."""
+    tuning = {
+        "quantization": QDRANT_QUANTIZATION,
+        "always_ram": QDRANT_QUANTIZATION_ALWAYS_RAM,
+        "on_disk": QDRANT_ON_DISK,
+        "on_disk_payload": QDRANT_ON_DISK_PAYLOAD,
+        "m": QDRANT_HNSW_M,
+        "ef_construct": QDRANT_HNSW_EF_CONSTRUCT,
+    }
+    tuning.update(overrides)
+    return tuning
+
+
+def _quantization_config(tuning: Dict[str, Any]):
+    if tuning["quantization"] == "scalar":
+        return models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(
+                type=models.ScalarType.INT8, quantile=0.99, always_ram=tuning["always_ram"],
+            )
+        )
+    if tuning["quantization"] == "binary":
+        return models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=tuning["always_ram"]))
+    return None
+
+
+def tuning_of(qd: QdrantClient, name: str) -> Dict[str, Any]:
+    """collection_tuning()-shaped settings of an existing collection."""
+    config = qd.get_collection(name).config
+    quantization = config.quantization_config
+    dense = config.params.vectors.get(DENSE_VECTOR) if isinstance(config.params.vectors, dict) else None
+    kind = "none"
+    always_ram = QDRANT_QUANTIZATION_ALWAYS_RAM
+    if isinstance(quantization, models.ScalarQuantization):
+        kind, always_ram = "scalar", bool(quantization.scalar.always_ram)
+    elif isinstance(quantization, models.BinaryQuantization):
+        kind, always_ram = "binary", bool(quantization.binary.always_ram)
+    return {
+        "quantization": kind,
+        "always_ram": always_ram,
+        "on_disk": bool(dense and dense.on_disk),
+        "on_disk_payload": bool(config.params.on_disk_payload),
+        "m": config.hnsw_config.m,
+        "ef_construct": config.hnsw_config.ef_construct,
+    }
+
+
+def ensure_collection(qd: QdrantClient, name: str = COLLECTION, tuning: Optional[Dict[str, Any]] = None):
+    """
+    Creates `name` with named dense + sparse (IDF-weighted BM25) vectors and
+    the given (default: configured) quantization / on-disk / HNSW tuning if it
+    doesn't exist, and makes sure the payload indexes are in place.
+    """
+    if not qd.collection_exists(name):
+        tuning = tuning or collection_tuning()
+        qd.create_collection(
+            collection_name=name,
+            vectors_config={
+                DENSE_VECTOR: models.VectorParams(
+                    size=EMBED_DIM, distance=models.Distance.COSINE, on_disk=tuning["on_disk"],
+                ),
+            },
+            sparse_vectors_config={
+                SPARSE_VECTOR: models.SparseVectorParams(modifier=models.Modifier.IDF),
+            },
+            hnsw_config=models.HnswConfigDiff(m=tuning["m"], ef_construct=tuning["ef_construct"]),
+            quantization_config=_quantization_config(tuning),
+            on_disk_payload=tuning["on_disk_payload"],
+        )
+        print(f"Created collection '{name}' ({tuning['quantization']} quantization, m={tuning['m']}, "
+              f"ef_construct={tuning['ef_construct']}, on_disk={tuning['on_disk']})")
+    else:
+        info = qd.get_collection(name)
+        vectors = info.config.params.vectors
+        if not isinstance(vectors, dict) or DENSE_VECTOR not in vectors:
+            raise RuntimeError(
+                f"Collection '{name}' predates named dense/sparse vectors; "
+                f"re-ingest with INGEST_STRATEGY=bluegreen to rebuild it"
+            )
+        if set(PAYLOAD_INDEXES) <= set(info.payload_schema or {}):
+            return
+
+    # created before the upload, so Qdrant indexes points as they arrive
+    for field, schema in PAYLOAD_INDEXES.items():
+        qd.create_payload_index(collection_name=name, field_name=field, field_schema=schema, wait=True)
+
+
+def existing_hashes(qd: QdrantClient, name: str = COLLECTION) -> Dict[int, Optional[str]]:
+    """id -> content_hash for every point already in the collection (payload field only)."""
+    hashes: Dict[int, Optional[str]] = {}
+    offset = None
+    while True:
+        points, offset = qd.scroll(
+            collection_name=name,
+            limit=10_000,
+            offset=offset,
+            with_payload=[HASH_FIELD],
+            with_vectors=False,
+        )
+        for p in points:
+            hashes[p.id] = (p.payload or {}).get(HASH_FIELD)
+        if offset is None:
+            return hashes
+
+
+def delete_points(qd: QdrantClient, ids: List[int], name: str = COLLECTION, batch_size: int = 10_000):
+    for start in range(0, len(ids), batch_size):
+        qd.delete(
+            collection_name=name,
+            points_selector=models.PointIdsList(points=ids[start:start + batch_size]),
+        )
+
 
-    # recreate collection
+# --------- Checkpoint ---------
+def _source_fingerprint(csv_path: str) -> Dict[str, object]:
+    stat = os.stat(csv_path)
+    return {"csv_path": os.path.abspath(csv_path), "size": stat.st_size, "mtime": stat.st_mtime,
+            "collection": COLLECTION, "embed_model": EMBED_MODEL}
+
+
+def load_checkpoint(csv_path: str) -> Tuple[int, Optional[str]]:
+    """(rows already ingested, target collection) of an interrupted run over the same CSV."""
     try:
-        qd.delete_collection(collection_name=COLLECTION)
-    except Exception:
+        with open(INGEST_CHECKPOINT_PATH) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return 0, None
+    if checkpoint.get("source") != _source_fingerprint(csv_path):
+        return 0, None
+    return int(checkpoint.get("rows_done", 0)), checkpoint.get("target")
+
+
+def save_checkpoint(csv_path: str, rows_done: int, target: str):
+    tmp = INGEST_CHECKPOINT_PATH + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"source": _source_fingerprint(csv_path), "rows_done": rows_done, "target": target}, f)
+    os.replace(tmp, INGEST_CHECKPOINT_PATH)
+
+
+def clear_checkpoint():
+    try:
+        os.remove(INGEST_CHECKPOINT_PATH)
+    except FileNotFoundError:
         pass
 
-    qd.create_collection(
-        collection_name=COLLECTION,
-        vectors_config=models.VectorParams(size=EMBED_DIM, distance=models.Distance.COSINE),
-    )
 
-    vectors = [models.Document(text=build_text(d), model=EMBED_MODEL) for d in docs]
+# --------- Pipeline ---------
+def iter_chunks(csv_path: str, chunk_size: int = INGEST_CHUNK_SIZE) -> Iterator[List[dict]]:
+    for chunk in pd.read_csv(csv_path, encoding="utf-8-sig", chunksize=chunk_size):
+        yield chunk.to_dict(orient="records")
+
+
+def copy_points(qd: QdrantClient, source: str, target: str, docs: List[dict]):
+    """Upserts `docs` into `target` reusing their (unchanged) vectors from `source`."""
     ids = [int(d["id"]) for d in docs]
+    vectors = {}
+    for start in range(0, len(ids), INGEST_UPSERT_BATCH_SIZE):
+        for p in qd.retrieve(source, ids=ids[start:start + INGEST_UPSERT_BATCH_SIZE],
+                             with_vectors=True, with_payload=False):
+            vectors[p.id] = p.vector
+    qd.upload_points(
+        collection_name=target,
+        points=[models.PointStruct(id=int(d["id"]), vector=vectors[int(d["id"])], payload=d) for d in docs],
+        batch_size=INGEST_UPSERT_BATCH_SIZE,
+        parallel=INGEST_UPSERT_PARALLEL,
+        wait=True,
+    )
+
+
+def ingest(qd: QdrantClient, csv_path: str = CSV_PATH, name: str = COLLECTION, source: Optional[str] = None,
+           known: Optional[Dict[int, Optional[str]]] = None) -> Dict[str, int]:
+    """
+    Syncs collection `name` with the CSV against the content hashes in `source`
+    (default: `name` itself, i.e. in place). Unchanged rows are skipped in
+    place, or copied over with their vectors when building from another
+    collection. Returns counts of rows seen, upserted (new or changed),
+    skipped (unchanged) and deleted (gone from the CSV).
+    """
+    ensure_collection(qd, name)
+    if known is None:
+        known = existing_hashes(qd, source or name) if source is None or qd.collection_exists(source) else {}
+    resume_from, target = load_checkpoint(csv_path)
+    if target != name:
+        resume_from = 0
+    if resume_from:
+        print(f"Resuming from checkpoint: {resume_from} rows already ingested into '{name}'")
+
+    embedder = Embedder(model_name=EMBED_MODEL)
+    sparse_embedder = SparseEmbedder(model_name=SPARSE_MODEL)
+    parallel = int(INGEST_EMBED_PARALLEL) if INGEST_EMBED_PARALLEL is not None else None
+
+    stats = {"rows": 0, "upserted": 0, "skipped": 0, "deleted": 0}
+    seen = set()
+    t0 = time.perf_counter()
+
+    for docs in iter_chunks(csv_path):
+        chunk_start = stats["rows"]
+        stats["rows"] += len(docs)
+        seen.update(int(d["id"]) for d in docs)
+        if stats["rows"] <= resume_from:
+            continue  # done by the interrupted run; only its ids are needed (for deletions)
+
+        changed, unchanged = [], []
+        for d in docs[max(0, resume_from - chunk_start):]:
+            d[HASH_FIELD] = content_hash(d)
+            if known.get(int(d["id"])) == d[HASH_FIELD]:
+                unchanged.append(d)
+            else:
+                changed.append(d)
+
+        stats["skipped"] += len(unchanged)
+        if unchanged and source is not None:
+            copy_points(qd, source, name, unchanged)
+
+        if changed:
+            texts = [build_text(d) for d in changed]
+            vectors = embedder.embed_many(texts, batch_size=INGEST_EMBED_BATCH_SIZE, parallel=parallel)
+            sparse_vectors = sparse_embedder.embed_many(texts, batch_size=INGEST_EMBED_BATCH_SIZE, parallel=parallel)
+            qd.upload_points(
+                collection_name=name,
+                points=[
+                    models.PointStruct(id=int(d["id"]), vector={DENSE_VECTOR: v, SPARSE_VECTOR: sv}, payload=d)
+                    for d, v, sv in zip(changed, vectors, sparse_vectors)
+                ],
+                batch_size=INGEST_UPSERT_BATCH_SIZE,
+                parallel=INGEST_UPSERT_PARALLEL,
+                wait=True,
+            )
+            stats["upserted"] += len(changed)
+
+        save_checkpoint(csv_path, stats["rows"], name)
+        elapsed = time.perf_counter() - t0
+        print(
+            f"  {stats['rows']} rows ({stats['rows'] / elapsed:.0f} rows/s): "
+            f"{stats['upserted']} upserted, {stats['skipped']} unchanged"
+        )
+
+    stale = [point_id for point_id in known if point_id not in seen]
+    if source is None:
+        delete_points(qd, stale, name)  # a fresh blue/green collection never had them
+    stats["deleted"] = len(stale)
+    return stats
+
 
-    qd.upload_collection(
-        collection_name=COLLECTION,
-        vectors=vectors,
-        payload=docs,
-        ids=ids
+# --------- Blue/green ---------
+def _version_pattern(alias: str = COLLECTION):
+    return re.compile(re.escape(alias) + r"-v\d{14}$")
+
+
+def list_versions(qd: QdrantClient, alias: str = COLLECTION) -> List[str]:
+    """Versioned collections behind `alias`, oldest first."""
+    pattern = _version_pattern(alias)
+    return sorted(c.name for c in qd.get_collections().collections if pattern.match(c.name))
+
+
+def live_collection(qd: QdrantClient, alias: str = COLLECTION) -> Optional[str]:
+    """Collection currently serving `alias`: its alias target, a legacy plain collection of that name, or None."""
+    for a in qd.get_aliases().aliases:
+        if a.alias_name == alias:
+            return a.collection_name
+    return alias if qd.collection_exists(alias) else None
+
+
+def has_changes(csv_path: str, known: Dict[int, Optional[str]]) -> bool:
+    """Cheap pre-pass (hashing only): does the CSV differ from the live collection?"""
+    seen = 0
+    for docs in iter_chunks(csv_path):
+        for d in docs:
+            if known.get(int(d["id"])) != content_hash(d):
+                return True
+        seen += len(docs)
+    return seen != len(known)
+
+
+def wait_until_ready(qd: QdrantClient, name: str, timeout: float = INGEST_READY_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while qd.get_collection(name).status != models.CollectionStatus.GREEN:
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Collection '{name}' not ready after {timeout:.0f}s")
+        time.sleep(1)
+
+
+def sanity_check(qd: QdrantClient, name: str, expected_rows: int):
+    """Row count matches the CSV, a stored dense vector finds its own point and BM25 returns hits."""
+    count = qd.count(name, exact=True).count
+    if count != expected_rows:
+        raise RuntimeError(f"Collection '{name}' has {count} points, expected {expected_rows}")
+    if not count:
+        return
+    probe = qd.scroll(name, limit=1, with_vectors=True)[0][0]
+    hits = qd.query_points(name, query=probe.vector[DENSE_VECTOR], using=DENSE_VECTOR, limit=1).points
+    if not hits or hits[0].id != probe.id:
+        raise RuntimeError(f"Dense sanity query on '{name}' did not return point {probe.id}")
+    if not qd.query_points(name, query=probe.vector[SPARSE_VECTOR], using=SPARSE_VECTOR, limit=1).points:
+        raise RuntimeError(f"Sparse sanity query on '{name}' returned no hits")
+
+
+def swap_alias(qd: QdrantClient, target: str, live: Optional[str], alias: str = COLLECTION):
+    """Points `alias` at `target` in one atomic alias update."""
+    if live == alias:
+        # one-off migration: a plain collection still holds the alias name
+        print(f"Replacing legacy collection '{alias}' with an alias (brief gap while it's deleted)")
+        qd.delete_collection(alias)
+        live = None
+
+    operations = []
+    if live is not None:
+        operations.append(models.DeleteAliasOperation(delete_alias=models.DeleteAlias(alias_name=alias)))
+    operations.append(
+        models.CreateAliasOperation(create_alias=models.CreateAlias(collection_name=target, alias_name=alias))
     )
+    qd.update_collection_aliases(change_aliases_operations=operations)
+
+
+def cleanup_versions(qd: QdrantClient, keep: int = INGEST_KEEP_VERSIONS, alias: str = COLLECTION):
+    """Deletes all but the newest `keep` versions (never the live one)."""
+    live = live_collection(qd, alias)
+    versions = list_versions(qd, alias)
+    for name in versions[:-keep] if keep > 0 else versions:
+        if name != live:
+            qd.delete_collection(name)
+            print(f"Deleted old version '{name}'")
+
+
+def ingest_blue_green(qd: QdrantClient, csv_path: str = CSV_PATH, alias: str = COLLECTION) -> Optional[Dict[str, int]]:
+    """
+    Builds a new version of `alias` and swaps it in. Returns ingest() stats,
+    or None when both the CSV and the collection tuning match the live
+    collection and nothing was built.
+    """
+    live = live_collection(qd, alias)
+    known = existing_hashes(qd, live) if live else {}
+
+    _, target = load_checkpoint(csv_path)
+    if target is None or not _version_pattern(alias).match(target) or not qd.collection_exists(target):
+        if live not in (None, alias) and tuning_of(qd, live) == collection_tuning() \
+                and not has_changes(csv_path, known):
+            return None
+        target = f"{alias}-v{time.strftime('%Y%m%d%H%M%S', time.gmtime())}"
+    print(f"Building '{target}' (live: {live or 'none'})")
+
+    stats = ingest(qd, csv_path, name=target, source=live, known=known)
+
+    wait_until_ready(qd, target)
+    sanity_check(qd, target, stats["rows"])
+    swap_alias(qd, target, live, alias)
+    print(f"Alias '{alias}' -> '{target}'")
+
+    cleanup_versions(qd, alias=alias)
+    return stats
+
+
+def rollback(qd: QdrantClient, alias: str = COLLECTION) -> str:
+    """Points `alias` back at the newest version older than the live one."""
+    live = live_collection(qd, alias)
+    older = [name for name in list_versions(qd, alias) if live is None or name < live]
+    if not older:
+        raise SystemExit(f"No older version of '{alias}' to roll back to")
+    swap_alias(qd, older[-1], live, alias)
+    return older[-1]
+
+
+# --------- Local index ---------
+def ingest_local(csv_path: str = CSV_PATH, path: str = LOCAL_INDEX_DIR) -> Optional[Dict[str, int]]:
+    """
+    Writes a new version of the embedded index under `path`. Rows whose
+    content hash matches the current version keep its vector; only new or
+    changed rows are embedded. Returns ingest()-shaped stats, or None when
+    the CSV matches the current version and nothing was written.
+    """
+    current = LocalIndex(path, check_seconds=0)
+    known = current.hashes(HASH_FIELD)
+    if not has_changes(csv_path, {pid: h for pid, (h, _) in known.items()}):
+        return None
+    snapshot = current.snapshot()
+    total = sum(len(docs) for docs in iter_chunks(csv_path))
+
+    embedder = Embedder(model_name=EMBED_MODEL)
+    parallel = int(INGEST_EMBED_PARALLEL) if INGEST_EMBED_PARALLEL is not None else None
+    writer = LocalIndexWriter(total, EMBED_DIM, path)
+    stats = {"rows": 0, "upserted": 0, "skipped": 0, "deleted": 0}
+    seen = set()
+    t0 = time.perf_counter()
+
+    try:
+        for docs in iter_chunks(csv_path):
+            stats["rows"] += len(docs)
+            vectors: List[Any] = [None] * len(docs)
+            changed = []
+            for i, d in enumerate(docs):
+                d[HASH_FIELD] = content_hash(d)
+                seen.add(int(d["id"]))
+                previous = known.get(int(d["id"]))
+                if previous is not None and previous[0] == d[HASH_FIELD]:
+                    vectors[i] = snapshot.vectors[previous[1]]
+                else:
+                    changed.append(i)
+
+            if changed:
+                embedded = embedder.embed_many([build_text(docs[i]) for i in changed],
+                                               batch_size=INGEST_EMBED_BATCH_SIZE, parallel=parallel)
+                for i, v in zip(changed, embedded):
+                    vectors[i] = v
+            writer.add(docs, vectors)
+            stats["upserted"] += len(changed)
+            stats["skipped"] += len(docs) - len(changed)
+
+            elapsed = time.perf_counter() - t0
+            print(
+                f"  {stats['rows']} rows ({stats['rows'] / elapsed:.0f} rows/s): "
+                f"{stats['upserted']} embedded, {stats['skipped']} unchanged"
+            )
+    except BaseException:
+        writer.abort()
+        raise
+    version = writer.commit()
+
+    stats["deleted"] = len([pid for pid in known if pid not in seen])
+    print(f"Local index version {version} written to '{path}'")
+    return stats
+
+
+# --------- Lexical index ---------
+def ingest_lexical(csv_path: str = CSV_PATH, path: str = LEXICAL_INDEX_PATH) -> Optional[Dict[str, int]]:
+    """
+    Refits the lexical index over the whole CSV (TF-IDF needs every document)
+    and saves it. Returns ingest()-shaped stats, or None when the CSV matches
+    the saved index and nothing was written.
+    """
+    known: Dict[int, Optional[str]] = {}
+    if os.path.exists(path):
+        known = {int(d["id"]): d.get(HASH_FIELD) for d in LexicalIndex.load(path).docs}
+    if not has_changes(csv_path, known):
+        return None
+
+    docs = []
+    for chunk in iter_chunks(csv_path):
+        for d in chunk:
+            d[HASH_FIELD] = content_hash(d)
+        docs.extend(chunk)
+    build_lexical_index(docs, path)
+
+    ids = {int(d["id"]) for d in docs}
+    changed = sum(known.get(int(d["id"])) != d[HASH_FIELD] for d in docs)
+    return {"rows": len(docs), "upserted": changed, "skipped": len(docs) - changed,
+            "deleted": len([pid for pid in known if pid not in ids])}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest the song CSV into Qdrant.")
+    parser.add_argument("--rollback", action="store_true", help="point the alias back at the previous version")
+    args = parser.parse_args()
+
+    if RETRIEVER_BACKEND in ("local", "lexical"):
+        if args.rollback:
+            raise SystemExit("--rollback is only supported for the Qdrant backend")
+        t0 = time.perf_counter()
+        target = LOCAL_INDEX_DIR if RETRIEVER_BACKEND == "local" else LEXICAL_INDEX_PATH
+        stats = ingest_local() if RETRIEVER_BACKEND == "local" else ingest_lexical()
+        if stats is None:
+            print(f"'{target}' already matches {CSV_PATH}")
+            return
+        elapsed = time.perf_counter() - t0
+        # the new index version is also the cache version stamp (see local_index.py / lexical_index.py)
+        print(
+            f"Ingested {stats['rows']} rows into '{target}' in {elapsed:.1f}s: "
+            f"{stats['upserted']} embedded, {stats['skipped']} unchanged, {stats['deleted']} deleted"
+        )
+        return
+
+    qd = QdrantClient(QD_URL)
+
+    if args.rollback:
+        target = rollback(qd)
+        print(f"Alias '{COLLECTION}' rolled back to '{target}'")
+    else:
+        t0 = time.perf_counter()
+        if INGEST_STRATEGY == "inplace":
+            stats = ingest(qd)
+        else:
+            stats = ingest_blue_green(qd)
+        clear_checkpoint()
+        elapsed = time.perf_counter() - t0
+
+        if stats is None:
+            print(f"'{COLLECTION}' already matches {CSV_PATH}; keeping the current version stamp")
+            return
+        print(
+            f"Ingested {stats['rows']} rows into '{COLLECTION}' at {QD_URL} in {elapsed:.1f}s "
+            f"({stats['rows'] / elapsed:.0f} rows/s): {stats['upserted']} upserted, "
+            f"{stats['skipped']} unchanged, {stats['deleted']} deleted"
+        )
+        if not (stats["upserted"] or stats["deleted"]):
+            # same documents (e.g. a rebuild for new collection tuning): cached answers stay valid
+            print("Content unchanged; keeping the current version stamp")
+            return
+
+    # every cache (answers, retrieval, rendered context) is keyed on this stamp
+    version = write_collection_version(qd)
+    print(f"Stamped collection version {version}")
 
-    print(f"Ingested {len(ids)} items into '{COLLECTION}' at {QD_URL}")
+    # old answers are already invisible under the new stamp; drop them to free space
+    SemanticCache(qd, CollectionVersion(qd)).clear()
 
 if __name__ == "__main__":
     main()
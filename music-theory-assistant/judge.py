@@ -0,0 +1,59 @@
+# judge.py — Background relevance judge
+#
+# Pairs with RELEVANCE_MODE=background: the API/UI save conversations with
+# relevance='PENDING' and this worker fills in the LLM-as-a-Judge verdict,
+# eval_* tokens and the extra OpenAI cost afterwards.
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+# Skip the optional timezone probe on import
+os.environ.setdefault("RUN_TIMEZONE_CHECK", "0")
+
+from rag import evaluate_relevance, calculate_openai_cost, OPENAI_MODEL
+from db import judge_next_pending
+from metrics import setup_tracing, stage, timer
+
+load_dotenv()
+
+# ---- Config ----
+JUDGE_CONCURRENCY = int(os.getenv("JUDGE_CONCURRENCY", "4"))
+JUDGE_POLL_SECONDS = float(os.getenv("JUDGE_POLL_SECONDS", "2"))
+
+
+def judge(question: str, answer: str):
+    with timer() as elapsed, stage("judge"):
+        relevance, tokens = evaluate_relevance(question, answer)
+    return {
+        "relevance": relevance.get("Relevance", "UNKNOWN"),
+        "relevance_explanation": relevance.get("Explanation", "Failed to parse evaluation"),
+        "eval_prompt_tokens": tokens["prompt_tokens"],
+        "eval_completion_tokens": tokens["completion_tokens"],
+        "eval_total_tokens": tokens["total_tokens"],
+        "eval_cost": calculate_openai_cost(OPENAI_MODEL, tokens),
+        "judge_ms": elapsed() * 1000,
+    }
+
+
+def worker(n: int):
+    while True:
+        try:
+            if judge_next_pending(judge):
+                continue
+        except Exception as e:
+            print(f"[judge {n}] Error: {e}")
+        time.sleep(JUDGE_POLL_SECONDS)
+
+
+def main():
+    setup_tracing("music-theory-judge")
+    print(f"Judging PENDING conversations with {JUDGE_CONCURRENCY} worker(s)...")
+    with ThreadPoolExecutor(max_workers=JUDGE_CONCURRENCY) as pool:
+        for n in range(JUDGE_CONCURRENCY):
+            pool.submit(worker, n)
+
+
+if __name__ == "__main__":
+    main()
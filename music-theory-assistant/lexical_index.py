@@ -0,0 +1,240 @@
+# lexical_index.py — Persisted TF-IDF retriever (RETRIEVER_BACKEND=lexical)
+#
+# The service version of notebooks/minsearch.Index with the boosts tuned in
+# rag-test.ipynb. Instead of refitting 10 vectorizers on startup and running
+# one cosine_similarity per field, fit() stacks the per-field (L2-normalised)
+# TF-IDF matrices into one CSR matrix, so a query is a single sparse matvec
+# against a query row carrying the boosts, and a batch of queries is a single
+# sparse matmul. Keyword filters use per-value inverted posting lists
+# computed at fit time. ingest.py fits the index and pickles it to
+# LEXICAL_INDEX_PATH; the service only loads it.
+import os
+import json
+import time
+import uuid
+import pickle
+import threading
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import TfidfVectorizer
+from qdrant_client import models
+
+# ---- Config ----
+LEXICAL_INDEX_PATH = os.getenv("LEXICAL_INDEX_PATH", "data/lexical-index.pkl")
+VERSION_CHECK_SECONDS = float(os.getenv("CACHE_VERSION_CHECK_SECONDS", "10"))
+
+TEXT_FIELDS = [
+    "title", "artist", "genre", "key", "tempo_bpm", "time_signature",
+    "chord_progression", "roman_numerals", "cadence", "theory_notes",
+]
+KEYWORD_FIELDS = ["key", "genre", "artist", "time_signature"]
+
+# best boosts from the minsearch tuning run (see README, "minsearch boosted")
+DEFAULT_BOOST = {
+    "title": 2.86, "artist": 0.20, "genre": 0.15, "key": 2.69, "tempo_bpm": 2.03,
+    "time_signature": 2.16, "chord_progression": 0.09, "roman_numerals": 1.39,
+    "cadence": 0.05, "theory_notes": 0.51,
+}
+LEXICAL_BOOST = {**DEFAULT_BOOST, **json.loads(os.getenv("LEXICAL_BOOST", "{}"))}
+
+
+class LexicalIndex:
+    """
+    TF-IDF search over text fields with exact-match keyword filters.
+
+    search()/search_batch() take the same filter_dict / boost_dict arguments
+    as minsearch.Index.search(), except that a filter value may also be a
+    list (match any). Results are (row, score) pairs, best first; without a
+    filter, rows with a zero score are dropped.
+    """
+
+    def __init__(self, text_fields: List[str] = TEXT_FIELDS, keyword_fields: List[str] = KEYWORD_FIELDS,
+                 vectorizer_params: Optional[Dict[str, Any]] = None):
+        self.text_fields = text_fields
+        self.keyword_fields = keyword_fields
+        self.vectorizers = {field: TfidfVectorizer(**(vectorizer_params or {})) for field in text_fields}
+        self.matrix: Optional[sp.csr_matrix] = None  # (docs, sum of field vocabularies)
+        self.offsets: Dict[str, slice] = {}  # column range of each field in `matrix`
+        self.postings: Dict[str, Dict[Any, np.ndarray]] = {}  # field -> value -> sorted doc rows
+        self.docs: List[dict] = []
+        self.version = ""
+
+    def fit(self, docs: List[dict]) -> "LexicalIndex":
+        self.docs = docs
+        blocks, start = [], 0
+        for field in self.text_fields:
+            block = self.vectorizers[field].fit_transform([str(doc.get(field, "")) for doc in docs])
+            blocks.append(block)
+            self.offsets[field] = slice(start, start + block.shape[1])
+            start += block.shape[1]
+        self.matrix = sp.hstack(blocks, format="csr", dtype=np.float32)
+
+        for field in self.keyword_fields:
+            rows: Dict[Any, List[int]] = {}
+            for row, doc in enumerate(docs):
+                rows.setdefault(doc.get(field), []).append(row)
+            self.postings[field] = {value: np.array(r, dtype=np.int64) for value, r in rows.items()}
+
+        self.version = f"{time.strftime('%Y%m%d%H%M%S', time.gmtime())}-{uuid.uuid4().hex[:8]}"
+        return self
+
+    def query_matrix(self, queries: List[str], boost_dict: Optional[Dict[str, float]] = None) -> sp.csr_matrix:
+        """One boosted, field-stacked TF-IDF row per query."""
+        boost_dict = boost_dict or {}
+        blocks = [
+            self.vectorizers[field].transform(queries) * boost_dict.get(field, 1)
+            for field in self.text_fields
+        ]
+        return sp.hstack(blocks, format="csr", dtype=np.float32)
+
+    def candidates(self, filter_dict: Dict[str, Any]) -> Optional[np.ndarray]:
+        """Rows matching every keyword filter (None = no filter)."""
+        rows = None
+        for field, value in filter_dict.items():
+            if field not in self.postings:
+                continue
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            postings = [self.postings[field].get(v) for v in values]
+            matched = np.unique(np.concatenate([p for p in postings if p is not None] or [np.empty(0, np.int64)]))
+            rows = matched if rows is None else np.intersect1d(rows, matched, assume_unique=True)
+        return rows
+
+    def search(self, query: str, filter_dict: Optional[Dict[str, Any]] = None,
+               boost_dict: Optional[Dict[str, float]] = None, num_results: int = 10):
+        return self.search_batch([query], [filter_dict], boost_dict, num_results)[0]
+
+    def search_batch(self, queries: List[str], filter_dicts: Optional[List[Optional[Dict[str, Any]]]] = None,
+                     boost_dict: Optional[Dict[str, float]] = None, num_results: int = 10):
+        if not self.docs or not queries:
+            return [[] for _ in queries]
+        scores = (self.matrix @ self.query_matrix(queries, boost_dict).T).toarray().T  # (queries, docs)
+        filter_dicts = filter_dicts or [None] * len(queries)
+
+        results = []
+        for row_scores, filter_dict in zip(scores, filter_dicts):
+            rows = self.candidates(filter_dict) if filter_dict else None
+            if rows is not None:
+                row_scores = row_scores[rows]
+            k = min(num_results, len(row_scores))
+            if k == 0:
+                results.append([])
+                continue
+            top = np.argpartition(-row_scores, k - 1)[:k]
+            top = top[np.argsort(-row_scores[top])]
+            if rows is None:  # filtered rows match even without term overlap ("3/4" has no tokens)
+                top = top[row_scores[top] > 0]
+            results.append([
+                (int(rows[t]) if rows is not None else int(t), float(row_scores[t])) for t in top
+            ])
+        return results
+
+    def save(self, path: str = LEXICAL_INDEX_PATH):
+        """Pickles the fitted index atomically (readers never see a partial file)."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def load(path: str = LEXICAL_INDEX_PATH) -> "LexicalIndex":
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+
+class LexicalRetriever:
+    """
+    Serving wrapper: loads the pickled LexicalIndex, reloads it when
+    ingest.py replaces the file (checked at most once per check_seconds),
+    applies LEXICAL_BOOST and returns ScoredPoints like the other backends.
+    current() is the cache version stamp, like cache.CollectionVersion.
+    """
+
+    def __init__(self, path: str = LEXICAL_INDEX_PATH, boost: Optional[Dict[str, float]] = None,
+                 check_seconds: float = VERSION_CHECK_SECONDS):
+        self.path = path
+        self.boost = boost or LEXICAL_BOOST
+        self.check_seconds = check_seconds
+        self._index: Optional[LexicalIndex] = None
+        self._mtime: Optional[float] = None
+        self._checked_at = float("-inf")
+        self._lock = threading.Lock()
+
+    def index(self) -> Optional[LexicalIndex]:
+        if time.monotonic() - self._checked_at < self.check_seconds:
+            return self._index
+        with self._lock:
+            if time.monotonic() - self._checked_at >= self.check_seconds:
+                try:
+                    mtime = os.stat(self.path).st_mtime
+                except OSError:
+                    mtime = None
+                if mtime is None:
+                    self._index = None
+                elif mtime != self._mtime:
+                    t0 = time.perf_counter()
+                    self._index = LexicalIndex.load(self.path)
+                    print(f"Lexical index {self._index.version} loaded ({len(self._index.docs)} docs) "
+                          f"in {(time.perf_counter() - t0) * 1000:.0f}ms")
+                self._mtime = mtime
+                self._checked_at = time.monotonic()
+        return self._index
+
+    def current(self) -> str:
+        index = self.index()
+        return index.version if index is not None else "0"
+
+    def search(self, question: str, limit: int, query_filter: Optional[models.Filter] = None) -> List[models.ScoredPoint]:
+        return self.search_batch([question], limit, [query_filter])[0]
+
+    def search_batch(self, questions: List[str], limit: int,
+                     filters: Optional[List[Optional[models.Filter]]] = None) -> List[List[models.ScoredPoint]]:
+        index = self.index()
+        if index is None:
+            return [[] for _ in questions]
+        filter_dicts = [filter_dict(f) for f in (filters or [None] * len(questions))]
+        results = index.search_batch(questions, filter_dicts, self.boost, limit)
+        return [
+            [models.ScoredPoint(id=int(index.docs[row]["id"]), version=0, score=score, payload=index.docs[row])
+             for row, score in hits]
+            for hits in results
+        ]
+
+    def facet(self, field: str) -> List[str]:
+        index = self.index()
+        if index is None:
+            return []
+        return sorted(str(v) for v in index.postings.get(field, {}) if v is not None)
+
+    def payloads(self) -> List[dict]:
+        index = self.index()
+        return list(index.docs) if index is not None else []
+
+
+def filter_dict(query_filter: Optional[models.Filter]) -> Optional[Dict[str, Any]]:
+    """
+    The keyword part of a rag.parse_filter() result as a filter_dict. Range
+    and full-text conditions (tempo, cadence) are left to the TF-IDF scores.
+    """
+    if query_filter is None:
+        return None
+    result: Dict[str, Any] = {}
+    for condition in query_filter.must or []:
+        if not isinstance(condition, models.FieldCondition) or condition.key not in KEYWORD_FIELDS:
+            continue
+        if isinstance(condition.match, models.MatchAny):
+            result[condition.key] = list(condition.match.any)
+        elif isinstance(condition.match, models.MatchValue):
+            result[condition.key] = condition.match.value
+    return result or None
+
+
+def build_lexical_index(docs: List[dict], path: str = LEXICAL_INDEX_PATH) -> LexicalIndex:
+    """Fits the index over `docs` and saves it to `path` (ingest.py)."""
+    t0 = time.perf_counter()
+    index = LexicalIndex().fit(docs)
+    index.save(path)
+    print(f"Lexical index {index.version} ({len(docs)} docs, {index.matrix.shape[1]} terms) "
+          f"written to '{path}' in {time.perf_counter() - t0:.1f}s")
+    return index
@@ -0,0 +1,324 @@
+# loadtest.py — Open-loop load test of api.py: latency vs. offered QPS and the saturation point
+#
+# Usage (from the project root):
+#   python music-theory-assistant/loadtest.py --stack --rates 5 10 20 40 80 --duration 30 -o data/loadtest.json
+#   python music-theory-assistant/loadtest.py --url http://localhost:8000 --rates 2 5 10 --baseline data/loadtest-baseline.json
+#
+# Questions from data/ground-truth-retrieval.csv are POSTed to /rag at each
+# of --rates (requests per second) for --duration seconds. Arrivals are
+# open-loop (Poisson, or evenly spaced with --arrivals uniform): a request is
+# sent on schedule whether or not earlier ones have finished, so queueing in
+# the server shows up as latency instead of silently lowering the load. A
+# --feedback-share of the answered questions is followed by a /feedback call.
+# Requests beyond --max-in-flight are not sent and counted as `dropped`.
+#
+# Per rate the report has the sent and answered rates, error / drop rates
+# and p50/p95/p99 latency of /rag and /feedback. An open-loop step the service
+# cannot keep up with builds a queue, so /rag latency keeps growing while the
+# step runs: `drift` is the median latency of the last quarter of arrivals
+# over that of the first quarter. The highest rate with drift <= --max-drift,
+# error and drop rates <= --max-error-rate and /rag p99 <= --slo-ms is
+# `max_sustainable_qps`; the next step is where the service saturates.
+#
+# --stack starts api.py (uvicorn, --api-workers) against local stand-ins from
+# stub_servers.py: the OpenAI stub (--llm-latency-ms, --completion-tokens),
+# the Qdrant stub and the Postgres wire-protocol stub, with the hashing
+# embedder (EMBED_MODEL=stub). No network, OpenAI key or database is needed,
+# so runs on one box are comparable across releases; keep one report as the
+# --baseline and the run exits with status 1 on a capacity / latency regression.
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import subprocess
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+import httpx
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub_servers import serve_in_process
+
+GROUND_TRUTH_PATH = os.getenv("GROUND_TRUTH_PATH", "data/ground-truth-retrieval.csv")
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# --------- Local stack ---------
+def start_stack(args) -> List[subprocess.Popen]:
+    """OpenAI / Qdrant / Postgres stubs plus api.py under uvicorn; returns the processes."""
+    procs = [
+        serve_in_process("openai", args.openai_port, "--latency-ms", str(args.llm_latency_ms),
+                         "--completion-tokens", str(args.completion_tokens)),
+        serve_in_process("qdrant", args.qdrant_port, "--latency-ms", str(args.qdrant_latency_ms)),
+        serve_in_process("postgres", args.postgres_port, "--latency-ms", str(args.db_latency_ms)),
+    ]
+    env = {
+        **os.environ,
+        "OPENAI_API_KEY": "stub",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{args.openai_port}/v1",
+        "QDRANT_URL": f"http://127.0.0.1:{args.qdrant_port}",
+        "POSTGRES_HOST": "127.0.0.1",
+        "POSTGRES_PORT": str(args.postgres_port),
+        "RUN_TIMEZONE_CHECK": "0",
+        "EMBED_MODEL": "stub",
+        "SPARSE_MODEL": "stub",
+    }
+    procs.append(subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api:app", "--host", "127.0.0.1", "--port", str(args.api_port),
+         "--workers", str(args.api_workers), "--log-level", "warning"],
+        cwd=APP_DIR, env=env,
+    ))
+    url = f"http://127.0.0.1:{args.api_port}"
+    deadline = time.time() + 120
+    while time.time() < deadline:  # /health is 503 until the embedder is warmed up
+        try:
+            if httpx.get(f"{url}/health", timeout=1).status_code == 200:
+                return procs
+        except httpx.HTTPError:
+            pass
+        if procs[-1].poll() is not None:
+            break
+        time.sleep(0.5)
+    stop_stack(procs)
+    raise RuntimeError("api.py did not become healthy")
+
+
+def stop_stack(procs: List[subprocess.Popen]):
+    for proc in reversed(procs):  # the API first: it flushes to the Postgres stub on shutdown
+        proc.terminate()
+        proc.wait()
+
+
+# --------- Load ---------
+async def run_step(client: httpx.AsyncClient, questions: List[str], rate: float, args,
+                   rng: random.Random) -> Dict[str, Any]:
+    """One open-loop step at `rate` requests/s; waits for the stragglers before returning."""
+    results: Dict[str, List] = {"rag": [], "feedback": []}  # (sent at, latency, ok)
+    in_flight = 0
+    dropped = 0
+
+    async def call(kind: str, path: str, payload: Dict[str, Any]) -> Optional[httpx.Response]:
+        t0 = time.perf_counter()
+        try:
+            response = await client.post(path, json=payload)
+            ok = response.status_code == 200
+        except httpx.HTTPError:
+            response, ok = None, False
+        results[kind].append((t0 - start, time.perf_counter() - t0, ok))
+        return response if ok else None
+
+    async def one(question: str):
+        nonlocal in_flight
+        in_flight += 1
+        try:
+            response = await call("rag", "/rag", {"question": question})
+            if response is not None and rng.random() < args.feedback_share:
+                conversation_id = response.json()["conversation_id"]
+                await call("feedback", "/feedback",
+                           {"conversation_id": conversation_id, "feedback": rng.choice((1, -1))})
+        finally:
+            in_flight -= 1
+
+    tasks = []
+    start = time.perf_counter()
+    next_at = 0.0
+    while next_at < args.duration:
+        delay = start + next_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if in_flight >= args.max_in_flight:
+            dropped += 1
+        else:
+            tasks.append(asyncio.create_task(one(rng.choice(questions))))
+        next_at += rng.expovariate(rate) if args.arrivals == "poisson" else 1 / rate
+    sent = time.perf_counter() - start
+    await asyncio.gather(*tasks)
+    wall = time.perf_counter() - start
+
+    step: Dict[str, Any] = {
+        "offered_qps": rate,
+        "sent_qps": len(tasks) / sent,
+        "dropped": dropped,
+        "drop_rate": dropped / max(1, len(tasks) + dropped),
+        "wall_s": wall,
+    }
+    for kind, calls in results.items():
+        lat = np.array([latency for _, latency, ok in calls if ok]) * 1000
+        errors = sum(not ok for _, _, ok in calls)
+        step[kind] = {
+            "requests": len(calls),
+            "throughput_qps": len(lat) / wall,  # includes draining the last requests
+            "error_rate": errors / len(calls) if calls else 0.0,
+            **({
+                "p50_ms": float(np.percentile(lat, 50)),
+                "p95_ms": float(np.percentile(lat, 95)),
+                "p99_ms": float(np.percentile(lat, 99)),
+                "mean_ms": float(lat.mean()),
+            } if len(lat) else {}),
+        }
+    step["drift"] = _drift(results["rag"])
+    return step
+
+
+def _drift(calls: List[tuple]) -> float:
+    """Median latency of the last quarter of arrivals / that of the first quarter (1 = no queue build-up)."""
+    calls = sorted(calls)
+    quarter = len(calls) // 4
+    if quarter == 0:
+        return 1.0
+    first = np.median([latency for _, latency, _ in calls[:quarter]])
+    last = np.median([latency for _, latency, _ in calls[-quarter:]])
+    return float(last / first)
+
+
+def sustainable(step: Dict[str, Any], args) -> bool:
+    """Whether the service kept up with this step's offered rate."""
+    rag = step["rag"]
+    return (
+        step["drift"] <= args.max_drift
+        and rag["error_rate"] <= args.max_error_rate
+        and step["drop_rate"] <= args.max_error_rate
+        and rag.get("p99_ms", float("inf")) <= args.slo_ms
+    )
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], max_capacity_drop: float,
+            max_latency_increase: float) -> List[str]:
+    """Regressions of `report` against `baseline`, as readable lines (empty = pass)."""
+    failures = []
+    base_qps, qps = baseline.get("max_sustainable_qps") or 0, report["max_sustainable_qps"] or 0
+    if base_qps and qps < base_qps * (1 - max_capacity_drop):
+        failures.append(f"max sustainable QPS {qps} < baseline {base_qps} (-{max_capacity_drop:.0%} allowed)")
+    base_steps = {step["offered_qps"]: step for step in baseline.get("steps", [])}
+    for step in report["steps"]:
+        base = base_steps.get(step["offered_qps"])
+        if base is None or "p95_ms" not in base["rag"] or "p95_ms" not in step["rag"]:
+            continue
+        if step["rag"]["p95_ms"] > base["rag"]["p95_ms"] * (1 + max_latency_increase):
+            failures.append(f"{step['offered_qps']} qps: /rag p95 {step['rag']['p95_ms']:.0f}ms > baseline "
+                            f"{base['rag']['p95_ms']:.0f}ms (+{max_latency_increase:.0%} allowed)")
+    return failures
+
+
+async def run_all(url: str, questions: List[str], args) -> List[Dict[str, Any]]:
+    rng = random.Random(args.seed)
+    limits = httpx.Limits(max_connections=args.max_in_flight, max_keepalive_connections=args.max_in_flight)
+    steps = []
+    async with httpx.AsyncClient(base_url=url, timeout=args.timeout, limits=limits) as client:
+        for rate in args.rates:
+            step = await run_step(client, questions, rate, args, rng)
+            step["sustainable"] = sustainable(step, args)
+            steps.append(step)
+            rag = step["rag"]
+            print(
+                f"offered={rate:7.1f}/s  sent={step['sent_qps']:7.1f}/s  drift={step['drift']:5.2f}  "
+                f"p50={rag.get('p50_ms', float('nan')):7.0f}ms  p95={rag.get('p95_ms', float('nan')):7.0f}ms  "
+                f"p99={rag.get('p99_ms', float('nan')):7.0f}ms  errors={rag['error_rate']:.1%}  "
+                f"dropped={step['drop_rate']:.1%}  {'ok' if step['sustainable'] else 'SATURATED'}",
+                file=sys.stderr,
+            )
+            if not step["sustainable"] and args.stop_at_saturation:
+                break
+            await asyncio.sleep(args.cooldown)
+    return steps
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Open-loop load test of the RAG API (/rag + /feedback).")
+    parser.add_argument("--url", default="http://localhost:8000", help="API to test (ignored with --stack)")
+    parser.add_argument("--rates", type=float, nargs="+", default=[2, 5, 10, 20, 40], help="offered requests/s")
+    parser.add_argument("--duration", type=float, default=30, help="seconds per rate")
+    parser.add_argument("--arrivals", choices=["poisson", "uniform"], default="poisson")
+    parser.add_argument("--feedback-share", type=float, default=0.3, help="share of answers followed by /feedback")
+    parser.add_argument("--max-in-flight", type=int, default=1000, help="client-side cap; arrivals beyond it drop")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--cooldown", type=float, default=2, help="pause between rates (s)")
+    parser.add_argument("--limit", type=int, default=None, help="only use the first N questions")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--max-drift", type=float, default=1.5, help="allowed latency growth within a step")
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--slo-ms", type=float, default=10_000, help="/rag p99 above this counts as saturated")
+    parser.add_argument("--stop-at-saturation", action="store_true")
+    parser.add_argument("-o", "--output", help="write the JSON report here (default: stdout)")
+    parser.add_argument("--baseline", help="stored report to compare with; exit 1 on regressions")
+    parser.add_argument("--max-capacity-drop", type=float, default=0.1, help="allowed relative drop")
+    parser.add_argument("--max-latency-increase", type=float, default=0.25, help="allowed relative p95 increase")
+    stack = parser.add_argument_group("--stack: local API + stubs")
+    stack.add_argument("--stack", action="store_true")
+    stack.add_argument("--api-workers", type=int, default=1)
+    stack.add_argument("--llm-latency-ms", type=float, default=300)
+    stack.add_argument("--completion-tokens", type=int, default=60)
+    stack.add_argument("--qdrant-latency-ms", type=float, default=5)
+    stack.add_argument("--db-latency-ms", type=float, default=2)
+    stack.add_argument("--api-port", type=int, default=18000)
+    stack.add_argument("--openai-port", type=int, default=18081)
+    stack.add_argument("--qdrant-port", type=int, default=16335)
+    stack.add_argument("--postgres-port", type=int, default=15432)
+    args = parser.parse_args()
+
+    gt = pd.read_csv(GROUND_TRUTH_PATH)
+    if args.limit:
+        gt = gt.head(args.limit)
+    questions = gt["question"].tolist()
+
+    procs = start_stack(args) if args.stack else []
+    url = f"http://127.0.0.1:{args.api_port}" if args.stack else args.url
+    try:
+        steps = asyncio.run(run_all(url, questions, args))
+    finally:
+        stop_stack(procs)
+
+    ok = [step["offered_qps"] for step in steps if step["sustainable"]]
+    saturated = [step["offered_qps"] for step in steps if not step["sustainable"]]
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "url": url,
+        "duration_s": args.duration,
+        "arrivals": args.arrivals,
+        "feedback_share": args.feedback_share,
+        "config": {
+            "stack": args.stack,
+            **({
+                "api_workers": args.api_workers,
+                "llm_latency_ms": args.llm_latency_ms,
+                "completion_tokens": args.completion_tokens,
+                "qdrant_latency_ms": args.qdrant_latency_ms,
+                "db_latency_ms": args.db_latency_ms,
+            } if args.stack else {}),
+            "host": platform.node(),
+            "cpus": os.cpu_count(),
+        },
+        "max_sustainable_qps": max(ok) if ok else None,
+        "saturation_qps": min(saturated) if saturated else None,
+        "steps": steps,
+    }
+    print(f"max sustainable: {report['max_sustainable_qps']} qps, saturated at: {report['saturation_qps']} qps",
+          file=sys.stderr)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            failures = compare(report, json.load(f), args.max_capacity_drop, args.max_latency_increase)
+        for line in failures:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if failures:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+# local_index.py — Embedded dense index (RETRIEVER_BACKEND=local)
+#
+# Runs retrieval in-process, without a Qdrant server (edge deployments, CI).
+# ingest.py writes, under LOCAL_INDEX_DIR:
+#   vectors-<version>.npy   float32 (rows, dim), L2-normalised
+#   ids-<version>.npy       int64 point ids, same row order
+#   payloads-<version>.json payloads stored column-wise ({"field": [values...]})
+#   manifest.json           the current <version>, replaced atomically last
+# Startup is a memory-map of the vector file, not a rebuild. Queries are one
+# matrix-vector product plus argpartition top-k; rag.parse_filter() filters
+# are evaluated as boolean masks over the payload columns.
+#
+# The manifest version doubles as the cache version stamp: LocalIndex.current()
+# has the same contract as cache.CollectionVersion.current().
+import os
+import re
+import json
+import time
+import uuid
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from qdrant_client import models
+
+# ---- Config ----
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", "data/local-index")
+LOCAL_INDEX_KEEP_VERSIONS = int(os.getenv("LOCAL_INDEX_KEEP_VERSIONS", "2"))
+VERSION_CHECK_SECONDS = float(os.getenv("CACHE_VERSION_CHECK_SECONDS", "10"))
+
+MANIFEST = "manifest.json"
+_WORD_RE = re.compile(r"\w+")
+
+
+def _normalise(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+def _files(version: str) -> Dict[str, str]:
+    return {
+        "vectors": f"vectors-{version}.npy",
+        "ids": f"ids-{version}.npy",
+        "payloads": f"payloads-{version}.json",
+    }
+
+
+class _Snapshot:
+    """One loaded version: memory-mapped vectors, ids and payload columns."""
+
+    def __init__(self, path: str, manifest: Dict[str, Any]):
+        files = manifest["files"]
+        self.version = manifest["version"]
+        self.vectors = np.load(os.path.join(path, files["vectors"]), mmap_mode="r")
+        self.ids = np.load(os.path.join(path, files["ids"]))
+        with open(os.path.join(path, files["payloads"]), encoding="utf-8") as f:
+            self.columns: Dict[str, List[Any]] = json.load(f)
+        self._arrays: Dict[str, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def payload(self, row: int) -> Dict[str, Any]:
+        return {field: values[row] for field, values in self.columns.items()}
+
+    def column(self, field: str) -> np.ndarray:
+        """Payload column as an ndarray (built on first use, for filter masks)."""
+        array = self._arrays.get(field)
+        if array is None:
+            values = self.columns.get(field, [None] * len(self))
+            array = np.asarray(values, dtype=object)
+            self._arrays[field] = array
+        return array
+
+
+class LocalIndex:
+    """
+    Read side of the embedded index. Re-reads the manifest at most once per
+    check_seconds and swaps in a new snapshot when ingest.py has written one;
+    until the first ingest, searches return no hits.
+    """
+
+    def __init__(self, path: str = LOCAL_INDEX_DIR, check_seconds: float = VERSION_CHECK_SECONDS):
+        self.path = path
+        self.check_seconds = check_seconds
+        self._snapshot: Optional[_Snapshot] = None
+        self._checked_at = float("-inf")
+        self._lock = threading.Lock()
+
+    def _read_manifest(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(os.path.join(self.path, MANIFEST), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def snapshot(self) -> Optional[_Snapshot]:
+        if time.monotonic() - self._checked_at < self.check_seconds:
+            return self._snapshot
+        with self._lock:
+            if time.monotonic() - self._checked_at >= self.check_seconds:
+                manifest = self._read_manifest()
+                if manifest is None:
+                    self._snapshot = None
+                elif self._snapshot is None or self._snapshot.version != manifest["version"]:
+                    t0 = time.perf_counter()
+                    self._snapshot = _Snapshot(self.path, manifest)
+                    print(f"Local index {manifest['version']} mapped ({len(self._snapshot)} rows) "
+                          f"in {(time.perf_counter() - t0) * 1000:.0f}ms")
+                self._checked_at = time.monotonic()
+        return self._snapshot
+
+    def current(self) -> str:
+        """Version stamp for the caches ("0" before the first ingest)."""
+        snapshot = self.snapshot()
+        return snapshot.version if snapshot is not None else "0"
+
+    def search(self, vector, limit: int, query_filter: Optional[models.Filter] = None) -> List[models.ScoredPoint]:
+        return self.search_batch([vector], limit, [query_filter])[0]
+
+    def search_batch(self, vectors, limit: int,
+                     filters: Optional[List[Optional[models.Filter]]] = None) -> List[List[models.ScoredPoint]]:
+        """Cosine top-`limit` for many query vectors with one matrix product."""
+        snapshot = self.snapshot()
+        if snapshot is None or not len(snapshot):
+            return [[] for _ in vectors]
+        queries = _normalise(np.asarray(vectors, dtype=np.float32))
+        scores = queries @ snapshot.vectors.T  # (queries, rows)
+        filters = filters or [None] * len(queries)
+
+        results = []
+        for row_scores, query_filter in zip(scores, filters):
+            candidates = None
+            if query_filter is not None:
+                candidates = np.flatnonzero(_mask(snapshot, query_filter))
+                row_scores = row_scores[candidates]
+            k = min(limit, len(row_scores))
+            if k == 0:
+                results.append([])
+                continue
+            top = np.argpartition(-row_scores, k - 1)[:k]
+            top = top[np.argsort(-row_scores[top])]
+            rows = candidates[top] if candidates is not None else top
+            results.append([
+                models.ScoredPoint(id=int(snapshot.ids[r]), version=0, score=float(s), payload=snapshot.payload(r))
+                for r, s in zip(rows, row_scores[top])
+            ])
+        return results
+
+    def facet(self, field: str) -> List[str]:
+        """Distinct values of a payload field (the local stand-in for Qdrant facets)."""
+        snapshot = self.snapshot()
+        if snapshot is None:
+            return []
+        return sorted({str(v) for v in snapshot.columns.get(field, []) if v is not None})
+
+    def payloads(self) -> List[Dict[str, Any]]:
+        """Every payload of the current snapshot (for rag.py's song catalog)."""
+        snapshot = self.snapshot()
+        if snapshot is None:
+            return []
+        return [snapshot.payload(row) for row in range(len(snapshot))]
+
+    def hashes(self, hash_field: str) -> Dict[int, Tuple[Optional[str], int]]:
+        """id -> (content hash, row) of the current snapshot, for incremental rebuilds."""
+        snapshot = self.snapshot()
+        if snapshot is None:
+            return {}
+        column = snapshot.columns.get(hash_field, [None] * len(snapshot))
+        return {int(pid): (h, row) for row, (pid, h) in enumerate(zip(snapshot.ids, column))}
+
+
+# --------- Filters ---------
+def _condition_mask(snapshot: _Snapshot, condition) -> np.ndarray:
+    if isinstance(condition, models.Filter):
+        return _mask(snapshot, condition)
+    column = snapshot.column(condition.key)
+    match = condition.match
+    if isinstance(match, models.MatchValue):
+        return column == match.value
+    if isinstance(match, models.MatchAny):
+        return np.isin(column, match.any)
+    if isinstance(match, models.MatchText):
+        # like Qdrant's word-tokenised, lowercased text index: every query word must occur
+        words = set(_WORD_RE.findall(match.text.lower()))
+        return np.fromiter(
+            (v is not None and words <= set(_WORD_RE.findall(str(v).lower())) for v in column),
+            dtype=bool, count=len(column),
+        )
+    if condition.range is not None:
+        values = np.array([np.nan if v is None else float(v) for v in column])
+        mask = ~np.isnan(values)
+        bounds = condition.range
+        if bounds.gt is not None:
+            mask &= values > bounds.gt
+        if bounds.gte is not None:
+            mask &= values >= bounds.gte
+        if bounds.lt is not None:
+            mask &= values < bounds.lt
+        if bounds.lte is not None:
+            mask &= values <= bounds.lte
+        return mask
+    raise ValueError(f"Unsupported filter condition on '{condition.key}' for the local index")
+
+
+def _mask(snapshot: _Snapshot, query_filter: models.Filter) -> np.ndarray:
+    """Boolean row mask for the must / should / must_not clauses of a models.Filter."""
+    mask = np.ones(len(snapshot), dtype=bool)
+    for condition in query_filter.must or []:
+        mask &= _condition_mask(snapshot, condition)
+    if query_filter.should:
+        mask &= np.logical_or.reduce([_condition_mask(snapshot, c) for c in query_filter.should])
+    for condition in query_filter.must_not or []:
+        mask &= ~_condition_mask(snapshot, condition)
+    return mask
+
+
+# --------- Write side (ingest.py) ---------
+class LocalIndexWriter:
+    """
+    Builds a new version next to the live one: vectors are written straight
+    into a memory-mapped .npy of the final size, payloads are collected per
+    column, and commit() publishes the version by replacing the manifest.
+    """
+
+    def __init__(self, rows: int, dim: int, path: str = LOCAL_INDEX_DIR):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.rows = rows
+        self.version = f"{time.strftime('%Y%m%d%H%M%S', time.gmtime())}-{uuid.uuid4().hex[:8]}"
+        self.files = _files(self.version)
+        self.vectors = np.lib.format.open_memmap(
+            os.path.join(path, self.files["vectors"]), mode="w+", dtype=np.float32, shape=(rows, dim),
+        )
+        self.ids = np.zeros(rows, dtype=np.int64)
+        self.columns: Dict[str, List[Any]] = {}
+        self.count = 0
+        self.committed = False
+
+    def add(self, docs: List[dict], vectors):
+        """Appends rows in order; `vectors` may come from the embedder or an older snapshot."""
+        end = self.count + len(docs)
+        if end > self.rows:
+            raise RuntimeError(f"Local index writer sized for {self.rows} rows, got {end}")
+        self.vectors[self.count:end] = _normalise(np.asarray(vectors, dtype=np.float32))
+        self.ids[self.count:end] = [int(d["id"]) for d in docs]
+        for i, d in enumerate(docs):
+            for field, value in d.items():
+                column = self.columns.setdefault(field, [None] * self.rows)
+                column[self.count + i] = None if isinstance(value, float) and np.isnan(value) else value
+        self.count = end
+
+    def commit(self, keep: int = LOCAL_INDEX_KEEP_VERSIONS) -> str:
+        if self.count != self.rows:
+            raise RuntimeError(f"Local index writer expected {self.rows} rows, got {self.count}")
+        manifest = os.path.join(self.path, MANIFEST)
+        try:
+            self.vectors.flush()
+            self.vectors = None
+            np.save(os.path.join(self.path, self.files["ids"]), self.ids)
+            with open(os.path.join(self.path, self.files["payloads"]), "w", encoding="utf-8") as f:
+                json.dump(self.columns, f, default=str)
+            with open(manifest + ".tmp", "w", encoding="utf-8") as f:
+                json.dump({"version": self.version, "files": self.files, "rows": self.rows}, f)
+            os.replace(manifest + ".tmp", manifest)
+        except BaseException:
+            self.abort()
+            raise
+        self.committed = True
+        cleanup_versions(self.path, keep)
+        return self.version
+
+    def abort(self):
+        """Deletes the files of an unpublished version; a no-op once commit() has published it."""
+        if self.committed:
+            return
+        self.vectors = None
+        for name in self.files.values():
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+
+
+def cleanup_versions(path: str = LOCAL_INDEX_DIR, keep: int = LOCAL_INDEX_KEEP_VERSIONS):
+    """Deletes the files of all but the newest `keep` versions (readers may still map the previous one)."""
+    versions = sorted({
+        name[len("ids-"):-len(".npy")] for name in os.listdir(path) if name.startswith("ids-") and name.endswith(".npy")
+    })
+    for version in versions[:-max(keep, 1)]:  # never the one just published
+        for name in _files(version).values():
+            try:
+                os.remove(os.path.join(path, name))
+            except FileNotFoundError:
+                pass
@@ -1,5 +1,45 @@
+# metrics.py — Per-stage latency of the RAG pipeline (Prometheus histograms + OpenTelemetry spans)
+#
+#   stages = start_stages()          # once per question, at the top of rag() & co.
+#   with stage("search"):
+#       hits = ...
+#
+# Every stage() block is observed in rag_stage_seconds{stage}, runs inside an
+# OpenTelemetry span "rag.<stage>" and adds its seconds to the dict of the
+# current question (a context variable, so it follows the question into
+# asyncio tasks and to_thread() calls). The pipeline persists that dict as
+# the *_ms columns of `conversations` (stage_ms()).
+#
+# Spans are no-ops unless a tracer provider is installed: TRACING_EXPORTER=console
+# or otlp makes setup_tracing() install the OpenTelemetry SDK with that exporter
+# (opentelemetry-sdk / opentelemetry-exporter-otlp, only needed then).
+import os
 import time
+import contextvars
 from contextlib import contextmanager
+from typing import Dict, Optional
+
+from opentelemetry import trace
+from prometheus_client import Histogram
+
+TRACING_EXPORTER = os.getenv("TRACING_EXPORTER", "none")  # none | console | otlp
+
+STAGES = ("embed", "search", "prompt", "answer", "judge", "db_write")
+# stages timed per question and stored with it; the DB write happens after the row is built
+PERSISTED_STAGES = ("embed", "search", "prompt", "answer", "judge")
+STAGE_COLUMNS = tuple(f"{name}_ms" for name in PERSISTED_STAGES)
+
+STAGE_SECONDS = Histogram(
+    "rag_stage_seconds", "Latency of one RAG pipeline stage (seconds)", ["stage"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20),
+)
+for _stage in STAGES:
+    STAGE_SECONDS.labels(_stage)
+STAGE_METRICS = (STAGE_SECONDS,)
+
+tracer = trace.get_tracer("music-theory-assistant")
+_stages: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar("rag_stages", default=None)
+
 
 @contextmanager
 def timer():
@@ -9,6 +49,52 @@ def timer():
     finally:
         pass
 
+
+def start_stages() -> Dict[str, float]:
+    """Starts the stage timings of one question in the current context."""
+    timings: Dict[str, float] = {}
+    _stages.set(timings)
+    return timings
+
+
+@contextmanager
+def stage(name: str):
+    """Times the block as pipeline stage `name` (histogram, span, per-question total)."""
+    with tracer.start_as_current_span(f"rag.{name}"), timer() as elapsed:
+        try:
+            yield
+        finally:
+            seconds = elapsed()
+            STAGE_SECONDS.labels(name).observe(seconds)
+            timings = _stages.get()
+            if timings is not None:
+                timings[name] = timings.get(name, 0.0) + seconds  # e.g. answer + escalated answer
+
+
+def stage_ms() -> Dict[str, float]:
+    """The current question's persisted stage timings as {"<stage>_ms": ms} (0 for stages that did not run)."""
+    timings = _stages.get() or {}
+    return {f"{name}_ms": round(timings.get(name, 0.0) * 1000, 3) for name in PERSISTED_STAGES}
+
+
+def setup_tracing(service_name: str):
+    """Installs an SDK tracer provider for TRACING_EXPORTER (no-op spans with the default 'none')."""
+    if TRACING_EXPORTER == "none":
+        return
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+
+    if TRACING_EXPORTER == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        exporter = OTLPSpanExporter()  # endpoint from OTEL_EXPORTER_OTLP_ENDPOINT
+    else:
+        exporter = ConsoleSpanExporter()
+    provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+
+
 def empty_token_usage():
     # Replace with real counts from your LLM client if available
     return dict(
@@ -18,4 +104,4 @@ def empty_token_usage():
         eval_prompt_tokens=0,
         eval_completion_tokens=0,
         eval_total_tokens=0,
-    )
\ No newline at end of file
+    )
@@ -1,26 +1,127 @@
 import os
+import re
 import json
+import random
+import asyncio
+import itertools
+import threading
 from time import time
-from typing import Dict, Tuple, List, Any
+from concurrent.futures import TimeoutError as FutureTimeout
+from typing import Dict, Tuple, List, Any, Optional
 
+import tiktoken
 from dotenv import load_dotenv
-from openai import OpenAI
-from qdrant_client import QdrantClient, models
+from openai import OpenAI, AsyncOpenAI
+from qdrant_client import QdrantClient, AsyncQdrantClient, models
+from prometheus_client import Counter, Histogram
+
+from cache import (
+    CollectionVersion, SemanticCache, RetrievalCache, SEMANTIC_CACHE, RETRIEVAL_CACHE,
+)
+from embedder import get_embedder, get_sparse_embedder, get_reranker, DENSE_VECTOR, SPARSE_VECTOR, RERANKS
+from local_index import LocalIndex
+from lexical_index import LexicalRetriever
+from fast_path import SongCatalog, mentioned_fields
+from resilience import get_llm_caller, set_request_deadline
+from metrics import stage, start_stages, stage_ms
 
 load_dotenv()
 
 # --------- Config (env-overridable) ----------
 QDRANT_URL = os.getenv("QDRANT_URL", "http://localhost:6333")
-QDRANT_COLLECTION = os.getenv("QDRANT_COLLECTION", "zoomcamp-music-theory-assistant")
+QDRANT_COLLECTION = os.getenv("QDRANT_COLLECTION", "zoomcamp-music-theory-assistant")  # alias swapped by ingest.py
 EMBEDDING_MODEL = os.getenv("EMBED_MODEL", "jinaai/jina-embeddings-v2-small-en")
 TOP_K = int(os.getenv("TOP_K", "5"))
 
+# Where retrieval runs: "qdrant" (server), "local" (embedded dense index, see local_index.py)
+# or "lexical" (persisted TF-IDF index, see lexical_index.py); ingest.py writes the local ones
+RETRIEVER_BACKEND = os.getenv("RETRIEVER_BACKEND", "qdrant")
+
+# Retrieval: "dense" (vector_search) or "hybrid" (dense + BM25, fused server-side)
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "dense")
+HYBRID_FUSION = os.getenv("HYBRID_FUSION", "rrf")  # "rrf" | "dbsf"
+HYBRID_PREFETCH_FACTOR = int(os.getenv("HYBRID_PREFETCH_FACTOR", "5"))  # candidates per side = factor * top_k
+
+# Structured filters parsed from the question (key, genre, artist, time signature, tempo, cadence)
+QUERY_FILTERS = os.getenv("QUERY_FILTERS", "1") == "1"
+FILTER_MAX_RESULTS = int(os.getenv("FILTER_MAX_RESULTS", "20"))  # filtered searches return every match up to this many
+
+# Cross-encoder rerank of the top RERANK_CANDIDATES hits (see embedder.Reranker); a pass
+# slower than RERANK_BUDGET_MS keeps the retrieval order
+RERANK = os.getenv("RERANK", "0") == "1"
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "30"))
+RERANK_BUDGET_MS = float(os.getenv("RERANK_BUDGET_MS", "250"))
+
+# Query-time ANN knobs (the index-side ones live in ingest.py: QDRANT_QUANTIZATION, QDRANT_HNSW_M, ...)
+QDRANT_HNSW_EF = int(os.getenv("QDRANT_HNSW_EF", "0")) or None  # HNSW beam width at query time (None = server default)
+QDRANT_QUANT_RESCORE = os.getenv("QDRANT_QUANT_RESCORE", "1") == "1"  # re-rank quantized candidates with full vectors
+QDRANT_QUANT_OVERSAMPLING = float(os.getenv("QDRANT_QUANT_OVERSAMPLING", "2.0"))  # candidates fetched = oversampling * limit
+
+# Context packing: token budget of the CONTEXT block (0 = no limit); over budget, the
+# lowest-ranked hits lose their verbose fields first and are then dropped
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+CONTEXT_TRUNCATE_FIELDS = ("theory_notes",)
+
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")  # used for both answer + eval
 
+# Model routing (MODEL_ROUTING=1): simple lookups (one song, key, tempo...) are answered by
+# ROUTER_FAST_MODEL, explanatory questions by ROUTER_STRONG_MODEL. With ROUTER_ESCALATE=1 a
+# fast answer the judge marks NON_RELEVANT is regenerated by the strong model (cascade).
+# The judge itself always runs on OPENAI_MODEL.
+MODEL_ROUTING = os.getenv("MODEL_ROUTING", "0") == "1"
+ROUTER_FAST_MODEL = os.getenv("ROUTER_FAST_MODEL", "gpt-4o-mini")
+ROUTER_STRONG_MODEL = os.getenv("ROUTER_STRONG_MODEL", "gpt-4o")
+ROUTER_ESCALATE = os.getenv("ROUTER_ESCALATE", "1") == "1"
+ROUTER_MAX_LOOKUP_WORDS = int(os.getenv("ROUTER_MAX_LOOKUP_WORDS", "20"))  # longer questions go to the strong model
+
+# Template fast path: "What is the key of 'Let It Be'?" is answered from the song's payload,
+# without retrieval or LLM calls (model_used='template', zero cost); see fast_path.py
+TEMPLATE_ANSWERS = os.getenv("TEMPLATE_ANSWERS", "1") == "1"
+
+# USD per 1K (prompt, completion) tokens; MODEL_PRICES='{"model": [in, out]}' adds or overrides entries
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.00015, 0.0006),
+    "gpt-4o": (0.0025, 0.01),
+    "gpt-4.1-nano": (0.0001, 0.0004),
+    "gpt-4.1-mini": (0.0004, 0.0016),
+    "gpt-4.1": (0.002, 0.008),
+    "gpt-3.5-turbo": (0.0005, 0.0015),
+    **{model: tuple(price) for model, price in json.loads(os.getenv("MODEL_PRICES", "{}")).items()},
+}
+
+# Relevance judging: "inline" runs the judge before returning; "background"
+# saves the conversation as PENDING and leaves it to judge.py.
+RELEVANCE_MODE = os.getenv("RELEVANCE_MODE", "inline")
+JUDGE_SAMPLE_RATE = float(os.getenv("JUDGE_SAMPLE_RATE", "1.0"))  # share of traffic judged at all
+
 # --------- Clients ----------
+embedder = get_embedder()  # shared, micro-batched query embedder (warmed up by api.py / app.py)
+sparse_embedder = get_sparse_embedder()  # BM25 side of hybrid retrieval
+reranker = get_reranker()  # cross-encoder for RERANK=1
 qd_client = QdrantClient(QDRANT_URL)
-client = OpenAI(api_key=OPENAI_API_KEY)
+# retries, timeouts and hedging are done by resilience.ResilientCaller, not the SDK
+client = OpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+llm_caller = get_llm_caller()
+
+# async twins used by arag() / the async API route
+aqd_client = AsyncQdrantClient(QDRANT_URL)
+aclient = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+
+# in-process dense index replacing Qdrant search (RETRIEVER_BACKEND=local)
+local_index = LocalIndex() if RETRIEVER_BACKEND == "local" else None
+# boosted TF-IDF retriever (RETRIEVER_BACKEND=lexical)
+lexical_index = LexicalRetriever() if RETRIEVER_BACKEND == "lexical" else None
+if local_index is not None and RETRIEVAL_MODE == "hybrid":
+    print("[retrieval] The local backend is dense-only; ignoring RETRIEVAL_MODE=hybrid")
+
+# caches are keyed on the version stamp ingest.py writes after each (re-)ingest
+# (for the local / lexical backends: the version of their index files)
+collection_version = local_index or lexical_index or CollectionVersion(qd_client)
+# near-duplicate questions reuse earlier answers (SEMANTIC_CACHE=1)
+semantic_cache = SemanticCache(qd_client, collection_version)
+# exact repeats reuse hits + rendered context (RETRIEVAL_CACHE=1)
+retrieval_cache = RetrievalCache(collection_version)
 
 # ---------- Prompt templates ----------
 prompt_template = """
@@ -47,56 +148,811 @@ theory_notes: {theory_notes}
 """.strip()
 
 
-def build_prompt(query, search_results):
-    context = ""
+def _payload(doc) -> Dict[str, Any]:
+    # Qdrant returns ScoredPoint with .payload; allow dicts too (tests)
+    return doc.payload if hasattr(doc, "payload") else doc
+
+
+def _entry(payload) -> str:
+    return entry_template.format(**payload) + "\n\n"
+
+
+# --------- Context packing ---------
+class _CharTokenizer:
+    """~4 characters per token; stands in when the tiktoken encoding can't be loaded (offline)."""
+
+    def encode(self, text: str) -> List[str]:
+        return [text[i:i + 4] for i in range(0, len(text), 4)]
 
+    def decode(self, tokens: List[str]) -> str:
+        return "".join(tokens)
+
+
+_tokenizer = None
+
+
+def tokenizer():
+    """tiktoken encoding of OPENAI_MODEL (o200k_base for unknown models), loaded once."""
+    global _tokenizer
+    if _tokenizer is None:
+        try:
+            try:
+                _tokenizer = tiktoken.encoding_for_model(OPENAI_MODEL)
+            except KeyError:
+                _tokenizer = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            print(f"[context] tiktoken encoding unavailable, estimating tokens from length: {e}")
+            _tokenizer = _CharTokenizer()
+    return _tokenizer
+
+
+def count_tokens(text: str) -> int:
+    return len(tokenizer().encode(text))
+
+
+def _truncated_entry(payload, max_tokens: int, force: bool = False) -> Optional[str]:
+    """
+    The entry with CONTEXT_TRUNCATE_FIELDS cut down so it fits `max_tokens`,
+    or None if it can't fit even with them empty (unless `force`).
+    """
+    bare = _entry({**payload, **{f: "…" for f in CONTEXT_TRUNCATE_FIELDS if f in payload}})
+    room = max_tokens - count_tokens(bare)
+    if room < 0:
+        return bare if force else None
+
+    enc = tokenizer()
+    shortened = dict(payload)
+    for field in CONTEXT_TRUNCATE_FIELDS:
+        if field not in payload:
+            continue
+        tokens = enc.encode(str(payload[field]))
+        keep = min(len(tokens), room)
+        shortened[field] = enc.decode(tokens[:keep]).rstrip() + ("…" if keep < len(tokens) else "")
+        room -= keep
+    return _entry(shortened)
+
+
+def build_context(search_results, budget: int = CONTEXT_TOKEN_BUDGET) -> str:
+    """
+    CONTEXT block for the prompt: one entry per distinct song (same id, or
+    same title + artist) in ranking order, within `budget` tokens. The first
+    hit that doesn't fit has its verbose fields truncated; lower-ranked hits
+    after it are dropped. The top hit is always kept.
+    """
+    entries: List[str] = []
+    seen = set()
+    used = 0
     for doc in search_results:
-        # Qdrant returns ScoredPoint with .payload; allow dicts too (tests)
-        payload = doc.payload if hasattr(doc, "payload") else doc
-        context = context + entry_template.format(**payload) + "\n\n"
+        payload = _payload(doc)
+        keys = {("song", str(payload.get("title", "")).lower(), str(payload.get("artist", "")).lower())}
+        if payload.get("id") is not None:
+            keys.add(("id", payload["id"]))
+        if keys & seen:
+            continue
+        seen |= keys
 
-    prompt = prompt_template.format(question=query, context=context).strip()
-    return prompt
+        entry = _entry(payload)
+        if budget > 0:
+            tokens = count_tokens(entry)
+            if used + tokens > budget:
+                entry = _truncated_entry(payload, budget - used, force=not entries)
+                if entry is not None:
+                    entries.append(entry)
+                break
+            used += tokens
+        entries.append(entry)
+
+    return "".join(entries)
+
+
+def context_tokens(search_results, context: str) -> Dict[str, int]:
+    """Tokens of the packed CONTEXT vs. all hits rendered in full (the unpacked prompt)."""
+    return {
+        "context_tokens": count_tokens(context),
+        "context_tokens_original": count_tokens("".join(_entry(_payload(doc)) for doc in search_results)),
+    }
+
+
+def build_prompt(query, search_results):
+    return render_prompt(query, build_context(search_results))
+
+
+def render_prompt(query, context):
+    return prompt_template.format(question=query, context=context).strip()
+
+
+# --------- Models ---------
+def _uses_sparse() -> bool:
+    return RETRIEVAL_MODE == "hybrid" and RETRIEVER_BACKEND == "qdrant"
+
+
+def warmup_models():
+    """
+    Loads + warms every embedding model the configured RETRIEVAL_MODE needs
+    (and opens a local index and the template fast path's song catalog).
+    """
+    embedder.warmup()
+    if _uses_sparse():
+        sparse_embedder.warmup()
+    if RERANK:
+        reranker.warmup()
+    if local_index is not None:
+        local_index.snapshot()
+    if lexical_index is not None:
+        lexical_index.index()
+    if TEMPLATE_ANSWERS:
+        song_catalog.get()
+
+
+def models_ready() -> bool:
+    return embedder.ready and (not _uses_sparse() or sparse_embedder.ready) and (not RERANK or reranker.ready)
+
+
+# --------- Query filters ---------
+class FilterVocabulary:
+    """
+    Artist and genre values known to the collection (Qdrant facets on their
+    keyword indexes, or facet() of a LocalIndex / LexicalRetriever), longest
+    first. Re-read when the collection version changes.
+    """
+
+    FIELDS = ("artist", "genre")
+
+    def __init__(self, qd, version: CollectionVersion, collection: str = QDRANT_COLLECTION, local=None):
+        self.qd = qd
+        self.version = version
+        self.collection = collection
+        self.local = local
+        self._values: Dict[str, List[str]] = {}
+        self._loaded_for: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def get(self) -> Dict[str, List[str]]:
+        current = self.version.current()
+        if self._loaded_for != current:
+            with self._lock:
+                if self._loaded_for != current:
+                    self._values = self._load()
+                    self._loaded_for = current
+        return self._values
+
+    def _load(self) -> Dict[str, List[str]]:
+        values = {}
+        for field in self.FIELDS:
+            if self.local is not None:
+                values[field] = sorted(self.local.facet(field), key=len, reverse=True)
+                continue
+            try:
+                hits = self.qd.facet(collection_name=self.collection, key=field, limit=10_000).hits
+            except Exception as e:
+                print(f"[filters] Could not load {field} values: {e}")
+                hits = []
+            values[field] = sorted((str(h.value) for h in hits), key=len, reverse=True)
+        return values
+
+
+filter_vocabulary = FilterVocabulary(qd_client, collection_version, local=local_index or lexical_index)
+
+_KEY_RE = re.compile(
+    r"(?P<prefix>\b(?:in|key of)\s+)?\b(?P<note>[A-Ga-g])(?P<acc>[#♯b♭]?)"
+    r"(?:\s*(?P<mode>major|minor|dorian|mixolydian|lydian|phrygian|aeolian|locrian)\b|(?P<m>m)\b)",
+    re.IGNORECASE,
+)
+_TIME_SIGNATURE_RE = re.compile(r"\b(\d{1,2})\s*/\s*(\d{1,2})\b")
+_CADENCE_RE = re.compile(r"\b(authentic|plagal|half|deceptive|modal)\s+cadences?\b", re.IGNORECASE)
+_TEMPO_BETWEEN_RE = re.compile(r"\bbetween\s+(\d{2,3})\s*(?:bpm\s*)?and\s+(\d{2,3})\b", re.IGNORECASE)
+_TEMPO_BOUND_RE = re.compile(
+    r"\b(?P<op>faster than|slower than|above|over|below|under|more than|less than|at least|at most)\s+(?P<n>\d{2,3})\b",
+    re.IGNORECASE,
+)
+_TEMPO_WORD_RE = re.compile(r"\b(?:bpm|tempo|beats per minute)\b", re.IGNORECASE)
+_TEMPO_EXACT_RE = re.compile(r"\b(\d{2,3})\s*bpm\b", re.IGNORECASE)
+_TEMPO_OPS = {
+    "faster than": "gt", "above": "gt", "over": "gt", "more than": "gt", "at least": "gte",
+    "slower than": "lt", "below": "lt", "under": "lt", "less than": "lt", "at most": "lte",
+}
+
+
+def _key_values(match) -> Optional[List[str]]:
+    """Spellings the dataset uses for one key: 'A minor' / 'Am', 'C major' / 'C'."""
+    note, mode = match.group("note"), (match.group("mode") or "").lower()
+    if not note.isupper() and not match.group("prefix"):
+        return None  # lowercase "a minor ..." is usually just English
+    if match.group("m") and not note.isupper():
+        return None
+    note = note.upper() + match.group("acc").replace("♯", "#").replace("♭", "b")
+    if match.group("m") or mode in ("minor", "aeolian"):
+        return [f"{note} minor", f"{note}m"]
+    if mode == "major":
+        return [f"{note} major", note]
+    return [f"{note} {mode.capitalize()}"]
+
+
+def _find_phrases(text: str, vocabulary: Dict[str, List[str]]) -> Dict[str, List[str]]:
+    """
+    Whole-word, case-insensitive matches of vocabulary values, longest first
+    ("Traditional Irish" before "Traditional"); each matched span is used once,
+    and a value that is both a genre and an artist counts as a genre.
+    """
+    candidates = sorted(
+        ((value, field) for field in FilterVocabulary.FIELDS for value in vocabulary.get(field, [])),
+        key=lambda c: (-len(c[0]), c[1] != "genre"),
+    )
+    found: Dict[str, List[str]] = {}
+    text = text.lower()
+    for value, field in candidates:
+        pattern = r"(?<!\w)" + re.escape(value.lower()) + r"(?!\w)"
+        if re.search(pattern, text):
+            found.setdefault(field, []).append(value)
+            text = re.sub(pattern, " ", text)
+    return found
+
+
+def parse_filter(question: str) -> Optional[models.Filter]:
+    """
+    Rule-based (no LLM) extraction of structured constraints from the question,
+    e.g. "songs in 3/4 by The Beatles faster than 120 bpm". Returns a
+    models.Filter over the indexed payload fields, or None if nothing matched.
+    """
+    must: List[models.FieldCondition] = []
+
+    keys = [v for m in _KEY_RE.finditer(question) if (v := _key_values(m))]
+    if keys:
+        must.append(models.FieldCondition(key="key", match=models.MatchAny(any=[s for k in keys for s in k])))
+
+    signatures = sorted({f"{a}/{b}" for a, b in _TIME_SIGNATURE_RE.findall(question)})
+    if signatures:
+        must.append(models.FieldCondition(key="time_signature", match=models.MatchAny(any=signatures)))
+
+    between = _TEMPO_BETWEEN_RE.search(question)
+    if not _TEMPO_WORD_RE.search(question):
+        pass  # bare numbers ("more than 10 songs") are not tempos
+    elif between:
+        low, high = sorted(int(n) for n in between.groups())
+        must.append(models.FieldCondition(key="tempo_bpm", range=models.Range(gte=low, lte=high)))
+    else:
+        bounds = {_TEMPO_OPS[m.group("op").lower()]: int(m.group("n")) for m in _TEMPO_BOUND_RE.finditer(question)}
+        exact = _TEMPO_EXACT_RE.search(question)
+        if bounds:
+            must.append(models.FieldCondition(key="tempo_bpm", range=models.Range(**bounds)))
+        elif exact:
+            bpm = int(exact.group(1))
+            must.append(models.FieldCondition(key="tempo_bpm", range=models.Range(gte=bpm, lte=bpm)))
+
+    cadences = sorted({c.capitalize() for c in _CADENCE_RE.findall(question)})
+    if len(cadences) == 1:
+        must.append(models.FieldCondition(key="cadence", match=models.MatchText(text=cadences[0])))
+
+    for field, values in _find_phrases(question, filter_vocabulary.get()).items():
+        must.append(models.FieldCondition(key=field, match=models.MatchAny(any=values)))
+
+    return models.Filter(must=must) if must else None
+
+
+def _query_filter(question: str) -> Optional[models.Filter]:
+    """parse_filter() with QUERY_FILTERS=1, else None."""
+    return parse_filter(question) if QUERY_FILTERS else None
+
+
+def _filtered_limit(query_filter: Optional[models.Filter], top_k: int) -> int:
+    # one extra hit tells us whether the match set is complete
+    return max(top_k, FILTER_MAX_RESULTS + 1) if query_filter is not None else top_k
+
+
+def _trim_hits(hits, query_filter: Optional[models.Filter], top_k: int):
+    """Filtered searches keep every match when there are at most FILTER_MAX_RESULTS, else the top_k."""
+    if query_filter is not None and len(hits) <= FILTER_MAX_RESULTS:
+        return hits
+    return hits[:top_k]
 
 
 # --------- Retrieval ---------
-def vector_search(question: str, top_k: int = TOP_K):
+def search_params(hnsw_ef: Optional[int] = QDRANT_HNSW_EF, rescore: bool = QDRANT_QUANT_RESCORE,
+                  oversampling: float = QDRANT_QUANT_OVERSAMPLING, exact: bool = False) -> models.SearchParams:
+    """
+    Dense-search parameters. The quantization part is ignored by collections
+    built without QDRANT_QUANTIZATION, so it is always safe to send.
+    """
+    return models.SearchParams(
+        hnsw_ef=hnsw_ef,
+        exact=exact,
+        quantization=models.QuantizationSearchParams(rescore=rescore, oversampling=oversampling),
+    )
+
+
+SEARCH_PARAMS = search_params()
+
+
+def vector_search(question: str, top_k: int = TOP_K, vector=None, query_filter: Optional[models.Filter] = None):
     """
     Retrieve top-k hits from Qdrant. Returns a list of ScoredPoint (with .payload).
+    Pass `vector` when the question has already been embedded.
     """
+    if vector is None:
+        vector = embedder.embed(question)
     query_points = qd_client.query_points(
         collection_name=QDRANT_COLLECTION,
-        query=models.Document(
-            model=EMBEDDING_MODEL,
-            text=question
-        ),
-        limit=top_k,
+        query=vector,
+        using=DENSE_VECTOR,
+        query_filter=query_filter,
+        search_params=SEARCH_PARAMS,
+        limit=_filtered_limit(query_filter, top_k),
+        with_payload=True
+    )
+    return _trim_hits(query_points.points, query_filter, top_k)
+
+
+async def avector_search(question: str, top_k: int = TOP_K, vector=None, query_filter: Optional[models.Filter] = None):
+    """
+    Async twin of vector_search() using AsyncQdrantClient.
+    """
+    if vector is None:
+        vector = await embedder.aembed(question)
+    query_points = await aqd_client.query_points(
+        collection_name=QDRANT_COLLECTION,
+        query=vector,
+        using=DENSE_VECTOR,
+        query_filter=query_filter,
+        search_params=SEARCH_PARAMS,
+        limit=_filtered_limit(query_filter, top_k),
         with_payload=True
     )
-    return query_points.points
+    return _trim_hits(query_points.points, query_filter, top_k)
+
+
+def hybrid_query(vector, sparse_vector, top_k: int = TOP_K, fusion: str = HYBRID_FUSION,
+                 query_filter: Optional[models.Filter] = None) -> Dict[str, Any]:
+    """
+    query_points()/QueryRequest arguments for one-round-trip hybrid search:
+    dense and BM25 candidates are prefetched and fused server-side (RRF or DBSF).
+    """
+    limit = _filtered_limit(query_filter, top_k)
+    prefetch_limit = HYBRID_PREFETCH_FACTOR * limit
+    return {
+        "prefetch": [
+            models.Prefetch(query=sparse_vector, using=SPARSE_VECTOR, filter=query_filter, limit=prefetch_limit),
+            models.Prefetch(query=vector, using=DENSE_VECTOR, filter=query_filter, params=SEARCH_PARAMS,
+                            limit=prefetch_limit),
+        ],
+        "query": models.FusionQuery(fusion=models.Fusion.DBSF if fusion == "dbsf" else models.Fusion.RRF),
+        "limit": limit,
+        "with_payload": True,
+    }
+
+
+def hybrid_search(question: str, top_k: int = TOP_K, vector=None, fusion: str = HYBRID_FUSION,
+                  query_filter: Optional[models.Filter] = None):
+    """
+    Dense + BM25 retrieval fused by Qdrant. Exact lookups ("songs in C major",
+    "songs by The Beatles") are carried by the sparse side.
+    """
+    if vector is None:
+        vector = embedder.embed(question)
+    query_points = qd_client.query_points(
+        collection_name=QDRANT_COLLECTION,
+        **hybrid_query(vector, sparse_embedder.embed(question), top_k, fusion, query_filter),
+    )
+    return _trim_hits(query_points.points, query_filter, top_k)
+
+
+async def ahybrid_search(question: str, top_k: int = TOP_K, vector=None, fusion: str = HYBRID_FUSION,
+                         query_filter: Optional[models.Filter] = None):
+    """
+    Async twin of hybrid_search() using AsyncQdrantClient.
+    """
+    if vector is None:
+        vector = await embedder.aembed(question)
+    query_points = await aqd_client.query_points(
+        collection_name=QDRANT_COLLECTION,
+        **hybrid_query(vector, await sparse_embedder.aembed(question), top_k, fusion, query_filter),
+    )
+    return _trim_hits(query_points.points, query_filter, top_k)
+
+
+def local_search(question: str, top_k: int = TOP_K, vector=None, query_filter: Optional[models.Filter] = None):
+    """
+    vector_search() against the in-process LocalIndex (RETRIEVER_BACKEND=local):
+    exact cosine top-k over the memory-mapped embeddings, same return shape.
+    """
+    if vector is None:
+        vector = embedder.embed(question)
+    hits = local_index.search(vector, _filtered_limit(query_filter, top_k), query_filter)
+    return _trim_hits(hits, query_filter, top_k)
+
+
+async def alocal_search(question: str, top_k: int = TOP_K, vector=None, query_filter: Optional[models.Filter] = None):
+    """
+    Async twin of local_search(); the matrix product runs off the event loop.
+    """
+    if vector is None:
+        vector = await embedder.aembed(question)
+    return await asyncio.to_thread(local_search, question, top_k, vector, query_filter)
+
+
+def lexical_search(question: str, top_k: int = TOP_K, vector=None, query_filter: Optional[models.Filter] = None):
+    """
+    Boosted TF-IDF retrieval from the LexicalRetriever (RETRIEVER_BACKEND=lexical).
+    `vector` is accepted for signature parity and ignored.
+    """
+    hits = lexical_index.search(question, _filtered_limit(query_filter, top_k), query_filter)
+    return _trim_hits(hits, query_filter, top_k)
+
+
+async def alexical_search(question: str, top_k: int = TOP_K, vector=None, query_filter: Optional[models.Filter] = None):
+    """
+    Async twin of lexical_search(); the sparse matvec runs off the event loop.
+    """
+    return await asyncio.to_thread(lexical_search, question, top_k, vector, query_filter)
+
+
+def _search_fn(asynchronous: bool = False):
+    """The (a)sync search function for RETRIEVER_BACKEND and RETRIEVAL_MODE."""
+    if lexical_index is not None:
+        return alexical_search if asynchronous else lexical_search
+    if local_index is not None:
+        return alocal_search if asynchronous else local_search
+    if RETRIEVAL_MODE == "hybrid":
+        return ahybrid_search if asynchronous else hybrid_search
+    return avector_search if asynchronous else vector_search
+
+
+def _candidate_limit(top_k: int) -> int:
+    return max(top_k, RERANK_CANDIDATES) if RERANK else top_k
+
+
+def _rerank_order(hits, scores):
+    return [hits[i] for i in sorted(range(len(hits)), key=lambda i: scores[i], reverse=True)]
+
+
+def rerank_hits(question: str, hits, top_k: int = TOP_K, query_filter: Optional[models.Filter] = None,
+                budget_ms: Optional[float] = RERANK_BUDGET_MS):
+    """
+    Reorders `hits` by cross-encoder score and trims them like _trim_hits().
+    Past `budget_ms` (None = no budget, e.g. offline batches) or on a model
+    error the retrieval order is kept.
+    """
+    if len(hits) < 2:
+        return _trim_hits(hits, query_filter, top_k)
+    timeout = budget_ms / 1000 if budget_ms is not None else None
+    future = reranker.submit(question, [entry_template.format(**h.payload) for h in hits])
+    try:
+        scores = future.result(timeout=timeout)
+    except FutureTimeout:
+        future.cancel()  # still queued behind other passes: don't run it at all
+        RERANKS.labels("timeout").inc()
+        return _trim_hits(hits, query_filter, top_k)
+    except Exception as e:
+        RERANKS.labels("error").inc()
+        print(f"[rerank] Failed, keeping retrieval order: {e}")
+        return _trim_hits(hits, query_filter, top_k)
+    RERANKS.labels("ok").inc()
+    return _trim_hits(_rerank_order(hits, scores), query_filter, top_k)
+
+
+async def arerank_hits(question: str, hits, top_k: int = TOP_K, query_filter: Optional[models.Filter] = None,
+                       budget_ms: Optional[float] = RERANK_BUDGET_MS):
+    """
+    Async twin of rerank_hits(); the event loop only awaits the pool's future.
+    """
+    if len(hits) < 2:
+        return _trim_hits(hits, query_filter, top_k)
+    timeout = budget_ms / 1000 if budget_ms is not None else None
+    future = reranker.submit(question, [entry_template.format(**h.payload) for h in hits])
+    try:
+        scores = await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+    except asyncio.TimeoutError:
+        RERANKS.labels("timeout").inc()  # wait_for cancelled the pool future too
+        return _trim_hits(hits, query_filter, top_k)
+    except Exception as e:
+        RERANKS.labels("error").inc()
+        print(f"[rerank] Failed, keeping retrieval order: {e}")
+        return _trim_hits(hits, query_filter, top_k)
+    RERANKS.labels("ok").inc()
+    return _trim_hits(_rerank_order(hits, scores), query_filter, top_k)
+
+
+def search(question: str, top_k: int = TOP_K, vector=None):
+    """
+    local_search() / lexical_search() for the in-process backends, else
+    vector_search() or hybrid_search() per RETRIEVAL_MODE, restricted by
+    parse_filter() when QUERY_FILTERS is on. A filter that matches nothing
+    (a misparse) falls back to the unfiltered search. With RERANK=1,
+    RERANK_CANDIDATES hits are retrieved and reranked down to top_k.
+    """
+    if vector is None and lexical_index is None:  # the lexical backend needs no query vector
+        with stage("embed"):
+            vector = embedder.embed(question)
+    query_filter = _query_filter(question)
+    run = _search_fn()
+    limit = _candidate_limit(top_k)
+
+    with stage("search"):  # sparse embedding and rerank included
+        hits = run(question, limit, vector, query_filter=query_filter)
+        if not hits and query_filter is not None:
+            query_filter = None
+            hits = run(question, limit, vector)
+        if RERANK:
+            hits = rerank_hits(question, hits, top_k, query_filter)
+    return hits
+
+
+async def asearch(question: str, top_k: int = TOP_K, vector=None):
+    if vector is None and lexical_index is None:
+        with stage("embed"):
+            vector = await embedder.aembed(question)
+    query_filter = _query_filter(question)
+    run = _search_fn(asynchronous=True)
+    limit = _candidate_limit(top_k)
+
+    with stage("search"):
+        hits = await run(question, limit, vector, query_filter=query_filter)
+        if not hits and query_filter is not None:
+            query_filter = None
+            hits = await run(question, limit, vector)
+        if RERANK:
+            hits = await arerank_hits(question, hits, top_k, query_filter)
+    return hits
+
+
+def retrieve(question: str, top_k: int = TOP_K, vector=None):
+    """
+    search() + build_context(), served from the retrieval cache for
+    repeated questions. Returns (hits, context).
+    """
+    if RETRIEVAL_CACHE:
+        cached = retrieval_cache.get(question, top_k)
+        if cached is not None:
+            return cached
+
+    hits = search(question, top_k, vector)
+    with stage("prompt"):
+        context = build_context(hits)
+    if RETRIEVAL_CACHE and hits:
+        retrieval_cache.set(question, top_k, hits, context)
+    return hits, context
+
+
+async def aretrieve(question: str, top_k: int = TOP_K, vector=None):
+    """
+    Async twin of retrieve(); the shared (Redis) tier is read off the event loop.
+    """
+    if RETRIEVAL_CACHE:
+        if retrieval_cache.shared:
+            cached = await asyncio.to_thread(retrieval_cache.get, question, top_k)
+        else:
+            cached = retrieval_cache.get(question, top_k)
+        if cached is not None:
+            return cached
+
+    hits = await asearch(question, top_k, vector)
+    with stage("prompt"):
+        context = build_context(hits)
+    if RETRIEVAL_CACHE and hits:
+        if retrieval_cache.shared:
+            await asyncio.to_thread(retrieval_cache.set, question, top_k, hits, context)
+        else:
+            retrieval_cache.set(question, top_k, hits, context)
+    return hits, context
+
+
+# --------- Model routing ---------
+ROUTE_DEFAULT = "default"  # MODEL_ROUTING=0, or an explicit model
+ROUTE_FAST = "fast"
+ROUTE_STRONG = "strong"
+ROUTE_ESCALATED = "escalated"  # fast answer judged NON_RELEVANT, regenerated by the strong model
+ROUTE_TEMPLATE = "template"  # answered by the template fast path, no LLM call
+
+ROUTE_SECONDS = Histogram(
+    "rag_route_seconds", "RAG pipeline latency per route and answering model (seconds)", ["route", "model"],
+    buckets=(0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30),
+)
+ROUTE_COST = Counter("rag_route_cost_usd_total", "OpenAI cost (answer + judge) per route and answering model", ["route", "model"])
+ROUTE_REQUESTS = Counter("rag_route_requests_total", "Answered questions per route and answering model", ["route", "model"])
+ROUTER_METRICS = (ROUTE_SECONDS, ROUTE_COST, ROUTE_REQUESTS)
+
+_EXPLAIN_RE = re.compile(
+    r"\b(why|explain\w*|how (?:does|do|did|is|are|can|could|would|should)|compar\w*|contrast\w*|differen\w*"
+    r"|analy[sz]\w*|relationship|relate[sd]?|function\w*|effect\w*|impact\w*|suggest\w*|recommend\w*"
+    r"|similar\w*|describe|teach)\b",
+    re.IGNORECASE,
+)
+_LOOKUP_RE = re.compile(
+    r"\b(key|tempo|bpm|time signature|meter|chords?|chord progression|progression|roman numerals?|cadences?"
+    r"|genre|artist|who (?:wrote|performed|sings|recorded)|which songs?|what songs?|list)\b",
+    re.IGNORECASE,
+)
+
+
+def classify_question(question: str) -> str:
+    """
+    Rule-based router (no LLM call): ROUTE_FAST for short single-fact lookups,
+    ROUTE_STRONG for anything explanatory, comparative or open-ended.
+    """
+    if (
+        _LOOKUP_RE.search(question)
+        and not _EXPLAIN_RE.search(question)
+        and len(question.split()) <= ROUTER_MAX_LOOKUP_WORDS
+    ):
+        return ROUTE_FAST
+    return ROUTE_STRONG
+
+
+def route_model(question: str, model: Optional[str] = None) -> Tuple[str, str]:
+    """(route, model) for a question; an explicit model bypasses the router."""
+    if model is not None or not MODEL_ROUTING:
+        return ROUTE_DEFAULT, model or OPENAI_MODEL
+    route = classify_question(question)
+    return route, ROUTER_FAST_MODEL if route == ROUTE_FAST else ROUTER_STRONG_MODEL
+
+
+def should_escalate(route: str, model: str, relevance: Dict[str, Any]) -> bool:
+    """Cascade step: only inline-judged fast answers marked NON_RELEVANT are retried."""
+    return (
+        ROUTER_ESCALATE
+        and route == ROUTE_FAST
+        and model != ROUTER_STRONG_MODEL
+        and relevance.get("Relevance") == "NON_RELEVANT"
+    )
+
+
+def observe_route(answer_data: Dict[str, Any]):
+    labels = (answer_data.get("route", ROUTE_DEFAULT), answer_data["model_used"])
+    ROUTE_REQUESTS.labels(*labels).inc()
+    ROUTE_SECONDS.labels(*labels).observe(answer_data["response_time"])
+    ROUTE_COST.labels(*labels).inc(answer_data["openai_cost"])
+
+
+# --------- Template fast path ---------
+song_catalog = SongCatalog(qd_client, collection_version, QDRANT_COLLECTION, local=local_index or lexical_index)
+
+_NO_TOKENS = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+
+
+def template_answer(query: str):
+    """
+    (answer_data, hits) for a single-field lookup about one song
+    (TEMPLATE_ANSWERS=1), or None to run the full pipeline.
+    """
+    if not TEMPLATE_ANSWERS:
+        return None
+    t0 = time()
+    result = song_catalog.answer(query)
+    if result is None:
+        return None
+    answer, hit = result
+    relevance = {"Relevance": "SKIPPED", "Explanation": "Template answer from the song's payload (no LLM call)"}
+    answer_data = _pack_answer_data(answer, "template", time() - t0, _NO_TOKENS, relevance, _NO_TOKENS,
+                                    route=ROUTE_TEMPLATE)
+    observe_route(answer_data)
+    return answer_data, [hit]
+
+
+async def atemplate_answer(query: str):
+    """
+    Async twin of template_answer(); the first lookup after a re-ingest loads
+    the song catalog, so it runs off the event loop.
+    """
+    if not TEMPLATE_ANSWERS:
+        return None
+    return await asyncio.to_thread(template_answer, query)
+
+
+def cache_scope(query: str) -> str:
+    """
+    Semantic cache partition of a question: the payload fields it mentions and
+    the songs it names, so "What key is X in?" never gets the cached answer to
+    "What cadence does X use?" however close their embeddings are.
+    """
+    titles = sorted(t.lower() for t in song_catalog.named_titles(query))
+    return f"{','.join(mentioned_fields(query))}|{'|'.join(titles)}"
 
 
 # --------- LLM wrapper ---------
+# every OpenAI call goes through llm_caller (resilience.py): per-attempt
+# timeouts within the request budget, retries on 429 / 5xx, optional
+# hedging and the circuit breaker
 def llm(prompt: str, model: str = OPENAI_MODEL):
     """
     Returns (answer_text, token_stats) where token_stats has:
       prompt_tokens, completion_tokens, total_tokens
     """
-    response = client.chat.completions.create(
+    response = llm_caller.call(lambda timeout: client.chat.completions.create(
         model=model,
-        messages=[{"role": "user", "content": prompt}]
-    )
+        messages=[{"role": "user", "content": prompt}],
+        timeout=timeout,
+    ))
 
     answer = response.choices[0].message.content.strip()
+    return answer, _token_stats(response.usage)
+
+
+async def allm(prompt: str, model: str = OPENAI_MODEL):
+    """
+    Async twin of llm() using AsyncOpenAI.
+    """
+    response = await llm_caller.acall(lambda timeout: aclient.chat.completions.create(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        timeout=timeout,
+    ))
+
+    answer = response.choices[0].message.content.strip()
+    return answer, _token_stats(response.usage)
+
+
+def llm_stream(prompt: str, model: str = OPENAI_MODEL):
+    """
+    Streaming llm(): yields ("token", text) for each content delta, then one
+    ("usage", token_stats) once the completion is finished. Retries cover
+    the request up to its first chunk; a failure after that propagates, and
+    streams are never hedged.
+    """
+    def attempt(timeout):
+        chunks = iter(client.chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            stream=True,
+            stream_options={"include_usage": True},
+            timeout=timeout,
+        ))
+        return next(chunks, None), chunks
+
+    first, chunks = llm_caller.call(attempt, hedge=False)
+
+    usage = None
+    for chunk in itertools.chain([first] if first is not None else [], chunks):
+        if chunk.usage is not None:
+            usage = chunk.usage
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield "token", chunk.choices[0].delta.content
+    yield "usage", _token_stats(usage)
+
+
+async def allm_stream(prompt: str, model: str = OPENAI_MODEL):
+    """
+    Async twin of llm_stream() using AsyncOpenAI.
+    """
+    async def attempt(timeout):
+        stream = await aclient.chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            stream=True,
+            stream_options={"include_usage": True},
+            timeout=timeout,
+        )
+        chunks = stream.__aiter__()
+        try:
+            return await chunks.__anext__(), chunks
+        except StopAsyncIteration:
+            return None, chunks
+
+    first, chunks = await llm_caller.acall(attempt, hedge=False)
+
+    usage = None
+    if first is not None:
+        chunks = _prepend(first, chunks)
+    async for chunk in chunks:
+        if chunk.usage is not None:
+            usage = chunk.usage
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield "token", chunk.choices[0].delta.content
+    yield "usage", _token_stats(usage)
 
-    token_stats = {
-        "prompt_tokens": getattr(response.usage, "prompt_tokens", 0) or 0,
-        "completion_tokens": getattr(response.usage, "completion_tokens", 0) or 0,
-        "total_tokens": getattr(response.usage, "total_tokens", 0)
-            or ((getattr(response.usage, "prompt_tokens", 0) or 0)
-                + (getattr(response.usage, "completion_tokens", 0) or 0))
+
+async def _prepend(first, chunks):
+    yield first
+    async for chunk in chunks:
+        yield chunk
+
+
+def _token_stats(usage) -> Dict[str, int]:
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": getattr(usage, "total_tokens", 0) or (prompt_tokens + completion_tokens),
     }
-    return answer, token_stats
 
 
 # --------- Relevance evaluator ---------
@@ -121,72 +977,369 @@ with double quotes, no comments, and no trailing commas. For example:
 }}
 """.strip()
 
-def evaluate_relevance(question: str, answer: str):
+prompt_template_evaluation_batch = """
+You are an expert evaluator for a Retrieval-Augmented Generation (RAG) system.
+Your task is to analyze the relevance of each generated answer to its question.
+Based on the relevance of each generated answer, you will classify it
+as "NON_RELEVANT", "PARTLY_RELEVANT", or "RELEVANT".
+
+Here is the data for evaluation:
+
+{items}
+
+Please analyze each item independently and provide your evaluation in parsable JSON without
+using code blocks. Return ONLY a valid JSON array with one object per item, in item order,
+with double quotes, no comments, and no trailing commas. For example:
+
+[
+  {{
+    "Item": 1,
+    "Relevance": "NON_RELEVANT" | "PARTLY_RELEVANT" | "RELEVANT",
+    "Explanation": "[Provide a brief explanation for your evaluation]"
+  }}
+]
+""".strip()
+
+evaluation_item_template = """
+Item {n}:
+Question: {question}
+Generated Answer: {answer}
+""".strip()
+
+def evaluate_relevance(question: str, answer: str, model: str = OPENAI_MODEL):
     prompt = prompt_template_evaluation.format(question=question, answer=answer)
-    evaluation, tokens = llm(prompt, model=OPENAI_MODEL)
+    evaluation, tokens = llm(prompt, model=model)
+    return _parse_evaluation(evaluation), tokens
+
+
+async def aevaluate_relevance(question: str, answer: str, model: str = OPENAI_MODEL):
+    prompt = prompt_template_evaluation.format(question=question, answer=answer)
+    evaluation, tokens = await allm(prompt, model=model)
+    return _parse_evaluation(evaluation), tokens
+
+
+async def aevaluate_relevance_batch(pairs: List[Tuple[str, str]], model: str = OPENAI_MODEL):
+    """
+    Judges several (question, answer) pairs with one LLM call (offline
+    evaluation). Returns one (relevance, token_stats) per pair; the call's
+    tokens are split evenly between them. Items missing from the reply are
+    UNKNOWN, so the caller can re-judge them one by one.
+    """
+    items = "\n\n".join(
+        evaluation_item_template.format(n=n, question=question, answer=answer)
+        for n, (question, answer) in enumerate(pairs, 1)
+    )
+    evaluation, tokens = await allm(prompt_template_evaluation_batch.format(items=items), model=model)
+    try:
+        verdicts = {int(v["Item"]): v for v in json.loads(evaluation) if isinstance(v, dict) and "Item" in v}
+    except (json.JSONDecodeError, TypeError, ValueError):
+        verdicts = {}
+    shares = [
+        {field: tokens[field] // len(pairs) + (i < tokens[field] % len(pairs)) for field in tokens}
+        for i in range(len(pairs))
+    ]
+    unknown = {"Relevance": "UNKNOWN", "Explanation": "Failed to parse evaluation"}
+    return [(verdicts.get(n, unknown), shares[n - 1]) for n in range(1, len(pairs) + 1)]
+
+
+def deferred_relevance():
+    """
+    Decides whether this answer is judged inline. Returns None to judge now, or
+    a (relevance, token_stats) placeholder: PENDING for the background judge
+    (RELEVANCE_MODE=background) or SKIPPED when not sampled (JUDGE_SAMPLE_RATE).
+    """
+    no_tokens = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    if random.random() >= JUDGE_SAMPLE_RATE:
+        return {"Relevance": "SKIPPED", "Explanation": "Not sampled for evaluation"}, no_tokens
+    if RELEVANCE_MODE == "background":
+        return {"Relevance": "PENDING", "Explanation": ""}, no_tokens
+    return None
+
 
+def _parse_evaluation(evaluation: str) -> Dict[str, Any]:
     try:
-        json_eval = json.loads(evaluation)
-        return json_eval, tokens
+        return json.loads(evaluation)
     except json.JSONDecodeError:
-        result = {"Relevance": "UNKNOWN", "Explanation": "Failed to parse evaluation"}
-        return result, tokens
+        return {"Relevance": "UNKNOWN", "Explanation": "Failed to parse evaluation"}
 
 
 # --------- Cost calculation ---------
+def model_price(model: str) -> Optional[Tuple[float, float]]:
+    """
+    (prompt, completion) USD per 1K tokens from MODEL_PRICES. Dated snapshots
+    ("gpt-4o-2024-08-06") use the price of the longest matching model name.
+    """
+    if model in MODEL_PRICES:
+        return MODEL_PRICES[model]
+    matches = [name for name in MODEL_PRICES if model.startswith(name + "-")]
+    return MODEL_PRICES[max(matches, key=len)] if matches else None
+
+
 def calculate_openai_cost(model: str, tokens: Dict[str, int]) -> float:
     """
     Estimate OpenAI API cost (USD) based on model + token usage.
     tokens must include 'prompt_tokens' and 'completion_tokens'.
     """
     openai_cost = 0.0
+    if not tokens.get("prompt_tokens") and not tokens.get("completion_tokens"):
+        return openai_cost  # no LLM call (template / deferred judge)
 
-    if model == "gpt-4o-mini":
+    price = model_price(model)
+    if price is not None:
         openai_cost = (
-            tokens.get("prompt_tokens", 0) * 0.00015
-            + tokens.get("completion_tokens", 0) * 0.0006
+            tokens.get("prompt_tokens", 0) * price[0]
+            + tokens.get("completion_tokens", 0) * price[1]
         ) / 1000
     else:
-        print("Model not recognized. OpenAI cost calculation failed.")
+        print(f"Model '{model}' not in MODEL_PRICES. OpenAI cost calculation failed.")
 
     return openai_cost
 
 
 # --------- Full RAG pipeline ---------
-def rag(query: str, model: str = OPENAI_MODEL):
+# rag(), arag(), rag_stream(), arag_stream() and batch_rag._answer() run the
+# same steps, shared through the helpers below (sync / async twins).
+def _shortcut(query: str):
+    """
+    (query vector, (answer_data, hits) or None): the template fast path, then
+    the semantic cache. With SEMANTIC_CACHE=1 the question is embedded once up
+    front, as retrieval needs the vector too.
+    """
+    templated = template_answer(query)
+    if templated is not None or not SEMANTIC_CACHE:
+        return None, templated
+    with stage("embed"):
+        vector = embedder.embed(query)
+    with stage("search"):
+        return vector, semantic_cache.lookup(vector, cache_scope(query))
+
+
+async def _ashortcut(query: str):
+    templated = await atemplate_answer(query)
+    if templated is not None or not SEMANTIC_CACHE:
+        return None, templated
+    with stage("embed"):
+        vector = await embedder.aembed(query)
+    with stage("search"):
+        return vector, await asyncio.to_thread(semantic_cache.lookup, vector, cache_scope(query))
+
+
+def _replay(answer_data: Dict[str, Any], hits):
+    """Stream events for an answer that needs no LLM call (template or semantic cache hit)."""
+    return [("sources", hits), ("token", answer_data["answer"]), ("done", answer_data)]
+
+
+def _start(query: str, model: Optional[str]) -> Tuple[float, str, str]:
+    """(t0, route, model); one RAG_REQUEST_BUDGET_SECONDS for all LLM calls of this question."""
+    t0 = time()
+    set_request_deadline()
+    return (t0, *route_model(query, model))
+
+
+def _judge(query: str, answer: str):
+    """Step 4: (relevance, token_stats), judged inline or deferred (see deferred_relevance)."""
+    deferred = deferred_relevance()
+    if deferred is not None:
+        return deferred
+    with stage("judge"):
+        return evaluate_relevance(query, answer)
+
+
+async def _ajudge(query: str, answer: str):
+    deferred = deferred_relevance()
+    if deferred is not None:
+        return deferred
+    with stage("judge"):
+        return await aevaluate_relevance(query, answer)
+
+
+def _answer(query: str, prompt: str, route: str, model: str, t0: float,
+            context_stats: Dict[str, int]) -> Dict[str, Any]:
+    """
+    Steps 3–5: answer, judge and pack; a fast answer judged NON_RELEVANT is
+    regenerated (and re-judged) by the strong model.
+    """
+    with stage("answer"):
+        answer, token_stats = llm(prompt, model=model)
+    relevance, rel_token_stats = _judge(query, answer)
+    answer_data = _pack_answer_data(answer, model, time() - t0, token_stats, relevance, rel_token_stats,
+                                    context_stats, route)
+
+    if should_escalate(route, model, relevance):
+        with stage("answer"):
+            answer, token_stats = llm(prompt, model=ROUTER_STRONG_MODEL)
+        with stage("judge"):
+            relevance, rel_token_stats = evaluate_relevance(query, answer)
+        answer_data = _pack_answer_data(answer, ROUTER_STRONG_MODEL, time() - t0, token_stats, relevance,
+                                        rel_token_stats, context_stats, ROUTE_ESCALATED, spent=answer_data)
+    return answer_data
+
+
+async def _aanswer(query: str, prompt: str, route: str, model: str, t0: float,
+                   context_stats: Dict[str, int]) -> Dict[str, Any]:
+    with stage("answer"):
+        answer, token_stats = await allm(prompt, model=model)
+    relevance, rel_token_stats = await _ajudge(query, answer)
+    answer_data = _pack_answer_data(answer, model, time() - t0, token_stats, relevance, rel_token_stats,
+                                    context_stats, route)
+
+    if should_escalate(route, model, relevance):
+        with stage("answer"):
+            answer, token_stats = await allm(prompt, model=ROUTER_STRONG_MODEL)
+        with stage("judge"):
+            relevance, rel_token_stats = await aevaluate_relevance(query, answer)
+        answer_data = _pack_answer_data(answer, ROUTER_STRONG_MODEL, time() - t0, token_stats, relevance,
+                                        rel_token_stats, context_stats, ROUTE_ESCALATED, spent=answer_data)
+    return answer_data
+
+
+def _finish(query: str, vector, answer_data: Dict[str, Any], hits):
+    """Route metrics, and the answer into the semantic cache with SEMANTIC_CACHE=1."""
+    observe_route(answer_data)
+    if SEMANTIC_CACHE:
+        semantic_cache.store(query, vector, answer_data, hits, cache_scope(query))
+
+
+async def _afinish(query: str, vector, answer_data: Dict[str, Any], hits):
+    observe_route(answer_data)
+    if SEMANTIC_CACHE:
+        await asyncio.to_thread(semantic_cache.store, query, vector, answer_data, hits, cache_scope(query))
+
+
+def rag(query: str, model: Optional[str] = None):
     """
     Runs the full RAG flow:
-      1) retrieve from Qdrant
+      1) retrieve from Qdrant or the local index (or the retrieval cache), reranked with RERANK=1
       2) build grounded prompt (exact template)
-      3) call LLM to answer
-      4) call LLM to evaluate relevance
+      3) call LLM to answer (model picked by route_model() with MODEL_ROUTING=1)
+      4) call LLM to evaluate relevance (or defer it, see deferred_relevance)
+         and, for a NON_RELEVANT fast-route answer, redo 3–4 on the strong model
       5) compute total OpenAI cost
 
+    Single-field lookups ("What is the key of 'Let It Be'?") are answered from
+    a template first (TEMPLATE_ANSWERS=1, see template_answer). With
+    SEMANTIC_CACHE=1, a close enough earlier question short-circuits
+    all of the above (see cache.SemanticCache).
+
     Returns:
       answer_data (dict) — ready to persist to DB
       hits (list) — retrieval results to display as sources
     """
-    t0 = time()
+    start_stages()
+    vector, ready = _shortcut(query)
+    if ready is not None:
+        return ready
+
+    t0, route, model = _start(query, model)
+    hits, context = retrieve(query, TOP_K, vector)
+    with stage("prompt"):
+        prompt = render_prompt(query, context)
+    answer_data = _answer(query, prompt, route, model, t0, context_tokens(hits, context))
+    _finish(query, vector, answer_data, hits)
+    return answer_data, hits
 
-    # 1–2) retrieval + prompt
-    hits = vector_search(query, TOP_K)
-    prompt = build_prompt(query, hits)
 
-    # 3) answer
-    answer, token_stats = llm(prompt, model=model)
+async def arag(query: str, model: Optional[str] = None):
+    """
+    Async twin of rag(): same steps and return shape, but Qdrant and OpenAI
+    calls are awaited so one event loop can serve many in-flight questions.
+    """
+    start_stages()
+    vector, ready = await _ashortcut(query)
+    if ready is not None:
+        return ready
+
+    t0, route, model = _start(query, model)
+    hits, context = await aretrieve(query, TOP_K, vector)
+    with stage("prompt"):
+        prompt = render_prompt(query, context)
+    answer_data = await _aanswer(query, prompt, route, model, t0, context_tokens(hits, context))
+    await _afinish(query, vector, answer_data, hits)
+    return answer_data, hits
+
+
+def rag_stream(query: str, model: Optional[str] = None):
+    """
+    Streaming rag(). Yields events in order:
+      ("sources", hits)       — retrieval results, before any LLM call
+      ("token", text)         — answer deltas as the LLM produces them
+      ("done", answer_data)   — same dict as rag(), once relevance is settled
+    A template answer or semantic cache hit is sent as a single token.
+    Questions are routed like rag(), but never escalated: by the time the
+    judge has seen the answer, it has already been streamed.
+    """
+    start_stages()
+    vector, ready = _shortcut(query)
+    if ready is not None:
+        yield from _replay(*ready)
+        return
+
+    t0, route, model = _start(query, model)
+    hits, context = retrieve(query, TOP_K, vector)
+    yield "sources", hits
+    with stage("prompt"):
+        prompt = render_prompt(query, context)
+
+    parts = []
+    with stage("answer"):  # includes the time the consumer takes per token
+        for kind, data in llm_stream(prompt, model=model):
+            if kind == "token":
+                parts.append(data)
+                yield "token", data
+            else:
+                token_stats = data
+    answer = "".join(parts).strip()
 
-    # 4) evaluate relevance
-    relevance, rel_token_stats = evaluate_relevance(query, answer)
+    relevance, rel_token_stats = _judge(query, answer)
+    answer_data = _pack_answer_data(answer, model, time() - t0, token_stats, relevance, rel_token_stats,
+                                    context_tokens(hits, context), route)
+    _finish(query, vector, answer_data, hits)
+    yield "done", answer_data
 
-    t1 = time()
-    took = t1 - t0
 
-    # 5) costs
+async def arag_stream(query: str, model: Optional[str] = None):
+    """
+    Async twin of rag_stream(); backs the /rag/stream SSE endpoint.
+    """
+    start_stages()
+    vector, ready = await _ashortcut(query)
+    if ready is not None:
+        for event in _replay(*ready):
+            yield event
+        return
+
+    t0, route, model = _start(query, model)
+    hits, context = await aretrieve(query, TOP_K, vector)
+    yield "sources", hits
+    with stage("prompt"):
+        prompt = render_prompt(query, context)
+
+    parts = []
+    with stage("answer"):
+        async for kind, data in allm_stream(prompt, model=model):
+            if kind == "token":
+                parts.append(data)
+                yield "token", data
+            else:
+                token_stats = data
+    answer = "".join(parts).strip()
+
+    relevance, rel_token_stats = await _ajudge(query, answer)
+    answer_data = _pack_answer_data(answer, model, time() - t0, token_stats, relevance, rel_token_stats,
+                                    context_tokens(hits, context), route)
+    await _afinish(query, vector, answer_data, hits)
+    yield "done", answer_data
+
+
+def _pack_answer_data(answer, model, took, token_stats, relevance, rel_token_stats,
+                      context_stats: Optional[Dict[str, int]] = None, route: str = ROUTE_DEFAULT,
+                      spent: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    # 5) costs (the judge runs on OPENAI_MODEL, whichever model answered)
     openai_cost_rag = calculate_openai_cost(model, token_stats)
-    openai_cost_eval = calculate_openai_cost(model, rel_token_stats)
+    openai_cost_eval = calculate_openai_cost(OPENAI_MODEL, rel_token_stats)
     openai_cost = openai_cost_rag + openai_cost_eval
 
-    # 6) pack answer_data 
+    # 6) pack answer_data
     answer_data = {
         "answer": answer,
         "model_used": model,
@@ -200,6 +1353,14 @@ def rag(query: str, model: str = OPENAI_MODEL):
         "eval_completion_tokens": rel_token_stats["completion_tokens"],
         "eval_total_tokens": rel_token_stats["total_tokens"],
         "openai_cost": openai_cost,
+        "context_tokens": (context_stats or {}).get("context_tokens", 0),
+        "context_tokens_original": (context_stats or {}).get("context_tokens_original", 0),
+        "route": route,
+        **stage_ms(),  # per-stage timings of this question (metrics.stage)
     }
-
-    return answer_data, hits
+    # an escalated answer also pays for the discarded fast attempt (`spent`)
+    if spent is not None:
+        for field in ("prompt_tokens", "completion_tokens", "total_tokens",
+                      "eval_prompt_tokens", "eval_completion_tokens", "eval_total_tokens", "openai_cost"):
+            answer_data[field] += spent[field]
+    return answer_data
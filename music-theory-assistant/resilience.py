@@ -0,0 +1,360 @@
+# resilience.py — Deadlines, retries, hedging and a circuit breaker for OpenAI calls
+#
+# rag.llm() / allm() (and the streaming variants, up to the first chunk) go
+# through one process-wide ResilientCaller:
+#   - deadline: every attempt gets timeout = min(LLM_ATTEMPT_TIMEOUT_SECONDS,
+#     time left in the request budget). rag() and friends start a budget of
+#     RAG_REQUEST_BUDGET_SECONDS per question (set_request_deadline), shared
+#     by the answer and the judge call;
+#   - retries: 429 / 5xx / timeouts / connection errors are retried up to
+#     LLM_MAX_RETRIES times with exponential backoff and full jitter, or after
+#     the Retry-After the API sent, never past the deadline;
+#   - hedging (LLM_HEDGE=1): when an attempt is still running after the p95
+#     of recent successful calls, a second identical request is sent and the
+#     first response wins (the other is cancelled / discarded);
+#   - circuit breaker: when at least BREAKER_FAILURE_RATE of the calls in the
+#     last BREAKER_WINDOW_SECONDS failed (and there were BREAKER_MIN_CALLS),
+#     calls fail fast with CircuitOpenError for BREAKER_COOLDOWN_SECONDS, then
+#     one probe decides between closing and re-opening.
+# The OpenAI clients are created with max_retries=0 so retries happen here only.
+import os
+import time
+import random
+import asyncio
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Awaitable, Callable, Deque, Optional, Tuple, TypeVar
+
+import numpy as np
+import openai
+from prometheus_client import Counter, Gauge, Histogram
+
+T = TypeVar("T")
+
+# ---- Config ----
+RAG_REQUEST_BUDGET_SECONDS = float(os.getenv("RAG_REQUEST_BUDGET_SECONDS", "60"))  # all LLM calls of one question
+LLM_ATTEMPT_TIMEOUT_SECONDS = float(os.getenv("LLM_ATTEMPT_TIMEOUT_SECONDS", "30"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_RETRY_BASE_SECONDS = float(os.getenv("LLM_RETRY_BASE_SECONDS", "0.5"))
+LLM_RETRY_MAX_SECONDS = float(os.getenv("LLM_RETRY_MAX_SECONDS", "8"))
+LLM_HEDGE = os.getenv("LLM_HEDGE", "0") == "1"
+LLM_HEDGE_QUANTILE = float(os.getenv("LLM_HEDGE_QUANTILE", "0.95"))
+LLM_HEDGE_DEFAULT_MS = float(os.getenv("LLM_HEDGE_DEFAULT_MS", "3000"))  # until LLM_HEDGE_MIN_SAMPLES latencies are known
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_HEDGE_WORKERS = int(os.getenv("LLM_HEDGE_WORKERS", "32"))  # threads for sync hedged calls
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "10"))
+BREAKER_WINDOW_SECONDS = float(os.getenv("BREAKER_WINDOW_SECONDS", "30"))
+BREAKER_COOLDOWN_SECONDS = float(os.getenv("BREAKER_COOLDOWN_SECONDS", "15"))
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,  # includes APITimeoutError
+    openai.InternalServerError,
+)
+
+# ---- Metrics ----
+LLM_RETRIES = Counter("llm_retries_total", "Retried OpenAI attempts by reason", ["reason"])
+LLM_HEDGES = Counter("llm_hedges_total", "Hedged OpenAI requests: fired, and won (answered first)", ["result"])
+LLM_ATTEMPT_SECONDS = Histogram(
+    "llm_attempt_seconds", "Successful OpenAI attempt latency (seconds)",
+    buckets=(0.25, 0.5, 1, 1.5, 2, 3, 5, 8, 13, 20, 30),
+)
+BREAKER_STATE = Gauge("llm_circuit_breaker_state", "OpenAI circuit breaker: 0 closed, 1 open, 2 half-open")
+BREAKER_REJECTIONS = Counter("llm_circuit_breaker_rejections_total", "OpenAI calls failed fast by the open breaker")
+for _reason in ("rate_limit", "server_error", "timeout", "connection"):
+    LLM_RETRIES.labels(_reason)
+for _result in ("fired", "won"):
+    LLM_HEDGES.labels(_result)
+
+RESILIENCE_METRICS = (LLM_RETRIES, LLM_HEDGES, LLM_ATTEMPT_SECONDS, BREAKER_STATE, BREAKER_REJECTIONS)
+
+
+class LLMUnavailableError(RuntimeError):
+    """No answer within the request budget, or the circuit breaker is open."""
+
+
+class CircuitOpenError(LLMUnavailableError):
+    pass
+
+
+# --------- Request budget ---------
+_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("llm_request_deadline", default=None)
+
+
+def set_request_deadline(budget: float = RAG_REQUEST_BUDGET_SECONDS):
+    """
+    Starts the LLM budget of one question in the current context (thread or
+    asyncio task). Later calls in the same context share what is left of it.
+    """
+    _deadline.set(time.monotonic() + budget)
+
+
+def _remaining(call_deadline: float) -> float:
+    request_deadline = _deadline.get()
+    deadline = call_deadline if request_deadline is None else min(call_deadline, request_deadline)
+    return deadline - time.monotonic()
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Seconds from the Retry-After(-Ms) header of an OpenAI error response, if any."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+def _reason(error: Exception) -> str:
+    if isinstance(error, openai.RateLimitError):
+        return "rate_limit"
+    if isinstance(error, openai.APITimeoutError):
+        return "timeout"
+    if isinstance(error, openai.APIConnectionError):
+        return "connection"
+    return "server_error"
+
+
+# --------- Circuit breaker ---------
+class CircuitBreaker:
+    """
+    Failure-rate breaker over a sliding time window. allow() is checked
+    before each attempt, record() reports its outcome; client errors (4xx
+    other than 429) are not failures of the upstream and are not recorded,
+    so attempts ending that way (or cancelled) call release() instead, which
+    hands the half-open probe to the next call.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 0, 1, 2
+
+    def __init__(self, failure_rate: float = BREAKER_FAILURE_RATE, min_calls: int = BREAKER_MIN_CALLS,
+                 window: float = BREAKER_WINDOW_SECONDS, cooldown: float = BREAKER_COOLDOWN_SECONDS):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self._calls: Deque[Tuple[float, bool]] = deque()
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _set(self, state: int):
+        self.state = state
+        BREAKER_STATE.set(state)
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+                self._set(self.HALF_OPEN)
+                self._probing = False
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True  # exactly one probe while half-open
+                return True
+            return self.state == self.CLOSED
+
+    def record(self, ok: bool):
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.HALF_OPEN:
+                if ok:
+                    self._calls.clear()
+                    self._set(self.CLOSED)
+                else:
+                    self._opened_at = now
+                    self._set(self.OPEN)
+                self._probing = False
+                return
+            self._calls.append((now, ok))
+            while self._calls and self._calls[0][0] < now - self.window:
+                self._calls.popleft()
+            failures = sum(not success for _, success in self._calls)
+            if (self.state == self.CLOSED and len(self._calls) >= self.min_calls
+                    and failures / len(self._calls) >= self.failure_rate):
+                self._opened_at = now
+                self._set(self.OPEN)
+
+    def release(self):
+        """Ends an admitted attempt without a verdict on the upstream."""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+
+
+# --------- Caller ---------
+class ResilientCaller:
+    """
+    Runs `attempt(timeout)` (one OpenAI request with that per-request timeout)
+    under the deadline / retry / hedge / breaker policy above. call() is for
+    sync code, acall() for async code; both share the breaker and the
+    latency window that sets the hedge delay.
+    """
+
+    def __init__(self, breaker: Optional[CircuitBreaker] = None, max_retries: int = LLM_MAX_RETRIES,
+                 attempt_timeout: float = LLM_ATTEMPT_TIMEOUT_SECONDS, budget: float = RAG_REQUEST_BUDGET_SECONDS,
+                 retry_base: float = LLM_RETRY_BASE_SECONDS, retry_max: float = LLM_RETRY_MAX_SECONDS,
+                 hedge: bool = LLM_HEDGE, hedge_quantile: float = LLM_HEDGE_QUANTILE,
+                 hedge_default_ms: float = LLM_HEDGE_DEFAULT_MS):
+        self.breaker = breaker or CircuitBreaker()
+        self.max_retries = max_retries
+        self.attempt_timeout = attempt_timeout
+        self.budget = budget
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_default = hedge_default_ms / 1000
+        self._latencies: Deque[float] = deque(maxlen=500)
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._pool_lock = threading.Lock()
+
+    # -- policy helpers --
+    def hedge_delay(self) -> float:
+        """Seconds to wait before hedging: recent p`hedge_quantile` of successful attempts."""
+        if len(self._latencies) < LLM_HEDGE_MIN_SAMPLES:
+            return self.hedge_default
+        return float(np.quantile(np.fromiter(self._latencies, dtype=float), self.hedge_quantile))
+
+    def _timeout(self, call_deadline: float) -> float:
+        remaining = _remaining(call_deadline)
+        if remaining <= 0:
+            raise LLMUnavailableError("LLM request budget exhausted")
+        return min(self.attempt_timeout, remaining)
+
+    def _admit(self):
+        if not self.breaker.allow():
+            BREAKER_REJECTIONS.inc()
+            raise CircuitOpenError("OpenAI circuit breaker is open")
+
+    def _backoff(self, attempt: int, error: Exception, call_deadline: float) -> float:
+        """Delay before the next attempt; re-raises `error` when no retry fits the budget."""
+        if attempt >= self.max_retries:
+            raise error
+        delay = retry_after(error) if isinstance(error, openai.RateLimitError) else None
+        if delay is None:
+            delay = random.uniform(0, min(self.retry_max, self.retry_base * 2 ** attempt))  # full jitter
+        if delay >= _remaining(call_deadline):
+            raise error
+        LLM_RETRIES.labels(_reason(error)).inc()
+        return delay
+
+    def _succeeded(self, seconds: float):
+        self._latencies.append(seconds)
+        LLM_ATTEMPT_SECONDS.observe(seconds)
+        self.breaker.record(True)
+
+    # -- sync --
+    def call(self, attempt: Callable[[float], T], hedge: Optional[bool] = None) -> T:
+        call_deadline = time.monotonic() + self.budget
+        hedge = self.hedge if hedge is None else hedge
+        for n in range(self.max_retries + 1):
+            timeout = self._timeout(call_deadline)  # before admitting: a spent budget never takes the probe
+            self._admit()
+            t0 = time.monotonic()
+            try:
+                result = self._hedged(attempt, timeout) if hedge else attempt(timeout)
+            except RETRYABLE_ERRORS as e:
+                self.breaker.record(False)
+                time.sleep(self._backoff(n, e, call_deadline))
+                continue
+            except BaseException:
+                self.breaker.release()  # client error / interrupted: says nothing about the upstream
+                raise
+            self._succeeded(time.monotonic() - t0)
+            return result
+        raise AssertionError("unreachable")
+
+    def _executor(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=LLM_HEDGE_WORKERS, thread_name_prefix="llm-hedge")
+        return self._pool
+
+    def _hedged(self, attempt: Callable[[float], T], timeout: float) -> T:
+        pool = self._executor()
+        ctx = contextvars.copy_context()
+        delay = min(self.hedge_delay(), timeout)
+        primary = pool.submit(ctx.copy().run, attempt, timeout)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+        LLM_HEDGES.labels("fired").inc()
+        backup = pool.submit(ctx.copy().run, attempt, max(timeout - delay, 0.1))
+        pending = {primary, backup}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is backup:
+                        LLM_HEDGES.labels("won").inc()
+                    return future.result()  # the slower request finishes in the background, unused
+                error = future.exception()
+        raise error
+
+    # -- async --
+    async def acall(self, attempt: Callable[[float], Awaitable[T]], hedge: Optional[bool] = None) -> T:
+        """Async twin of call()."""
+        call_deadline = time.monotonic() + self.budget
+        hedge = self.hedge if hedge is None else hedge
+        for n in range(self.max_retries + 1):
+            timeout = self._timeout(call_deadline)
+            self._admit()
+            t0 = time.monotonic()
+            try:
+                result = await (self._ahedged(attempt, timeout) if hedge else attempt(timeout))
+            except RETRYABLE_ERRORS as e:
+                self.breaker.record(False)
+                await asyncio.sleep(self._backoff(n, e, call_deadline))
+                continue
+            except BaseException:  # includes CancelledError
+                self.breaker.release()
+                raise
+            self._succeeded(time.monotonic() - t0)
+            return result
+        raise AssertionError("unreachable")
+
+    async def _ahedged(self, attempt: Callable[[float], Awaitable[T]], timeout: float) -> T:
+        delay = min(self.hedge_delay(), timeout)
+        primary = asyncio.ensure_future(attempt(timeout))
+        done, _ = await asyncio.wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+        LLM_HEDGES.labels("fired").inc()
+        backup = asyncio.ensure_future(attempt(max(timeout - delay, 0.1)))
+        pending = {primary, backup}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is backup:
+                            LLM_HEDGES.labels("won").inc()
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()  # closes the losing HTTP request
+
+
+_caller: Optional[ResilientCaller] = None
+_caller_lock = threading.Lock()
+
+
+def get_llm_caller() -> ResilientCaller:
+    """Returns the process-wide ResilientCaller (one breaker per process)."""
+    global _caller
+    if _caller is None:
+        with _caller_lock:
+            if _caller is None:
+                _caller = ResilientCaller()
+    return _caller
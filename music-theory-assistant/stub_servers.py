@@ -0,0 +1,390 @@
+# stub_servers.py — Local stand-ins for OpenAI and Qdrant (benchmarks / CI)
+#
+# Usage (standalone):
+#   python stub_servers.py openai --port 8081 --latency-ms 300
+#   python stub_servers.py qdrant --port 6335 --latency-ms 5
+#   python stub_servers.py openai --error-rate 0.1 --rate-limit-rate 0.05 --slow-rate 0.02 --slow-ms 5000
+#   python stub_servers.py postgres --port 5433 --latency-ms 2
+#
+# Point the app at them with OPENAI_BASE_URL=http://localhost:8081/v1,
+# QDRANT_URL=http://localhost:6335 and POSTGRES_HOST=localhost POSTGRES_PORT=5433.
+import os
+import re
+import json
+import time
+import uuid
+import random
+import asyncio
+import socket
+import struct
+import argparse
+import threading
+import subprocess
+import sys
+from importlib.metadata import version
+
+import pandas as pd
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+CSV_PATH = os.getenv("CSV_PATH", "data/music-theory-dataset-100.csv")
+
+
+# --------- OpenAI (chat completions) ---------
+def create_openai_stub(latency_ms: float = 300.0, completion_tokens: int = 60, error_rate: float = 0.0,
+                       rate_limit_rate: float = 0.0, slow_rate: float = 0.0, slow_ms: float = 5000.0,
+                       retry_after_ms: float = 200.0) -> FastAPI:
+    """
+    Minimal OpenAI-compatible /v1/chat/completions.
+    Sleeps latency_ms, then answers with completion_tokens words.
+    Fault injection (per request, independently drawn): error_rate answers
+    500, rate_limit_rate answers 429 with a retry-after-ms header, slow_rate
+    sleeps slow_ms instead of latency_ms (tail latency for hedging). Judge prompts
+    (rag.prompt_template_evaluation) get a parsable RELEVANT verdict, batched
+    judge prompts (rag.prompt_template_evaluation_batch) one per item. With
+    stream=true the words come back as SSE chunks (plus a usage chunk when
+    stream_options.include_usage is set).
+    """
+    app = FastAPI(title="OpenAI stub")
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        prompt = "\n".join(str(m.get("content", "")) for m in body.get("messages", []))
+
+        draw = random.random()
+        if draw < rate_limit_rate:
+            return JSONResponse(
+                {"error": {"message": "Stub rate limit", "type": "rate_limit_error", "code": "rate_limit_exceeded"}},
+                status_code=429, headers={"retry-after-ms": str(int(retry_after_ms))},
+            )
+        if draw < rate_limit_rate + error_rate:
+            await asyncio.sleep(latency_ms / 1000)
+            return JSONResponse({"error": {"message": "Stub server error", "type": "server_error"}}, status_code=500)
+        slow = random.random() < slow_rate
+        await asyncio.sleep((slow_ms if slow else latency_ms) / 1000)
+
+        items = re.findall(r"^Item (\d+):", prompt, re.MULTILINE)
+        if "expert evaluator" in prompt and items:
+            content = json.dumps([
+                {"Item": int(n), "Relevance": "RELEVANT", "Explanation": "Stub evaluation."} for n in items
+            ])
+        elif "expert evaluator" in prompt:
+            content = json.dumps({"Relevance": "RELEVANT", "Explanation": "Stub evaluation."})
+        else:
+            content = " ".join(["stub"] * completion_tokens)
+
+        prompt_tokens = max(1, len(prompt) // 4)
+        n_completion = len(content.split())
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": n_completion,
+            "total_tokens": prompt_tokens + n_completion,
+        }
+        if body.get("stream"):
+            include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+            return StreamingResponse(
+                _stream_chunks(content, body.get("model", "stub"), usage if include_usage else None),
+                media_type="text/event-stream",
+            )
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "stub"),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": usage,
+        }
+
+    return app
+
+
+async def _stream_chunks(content: str, model: str, usage):
+    chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+
+    def chunk(delta, finish_reason=None, chunk_usage=None):
+        choices = [] if delta is None else [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        return "data: " + json.dumps({
+            "id": chunk_id, "object": "chat.completion.chunk", "created": created,
+            "model": model, "choices": choices, "usage": chunk_usage,
+        }) + "\n\n"
+
+    yield chunk({"role": "assistant", "content": ""})
+    for i, word in enumerate(content.split(" ")):
+        yield chunk({"content": word if i == 0 else " " + word})
+    yield chunk({}, finish_reason="stop")
+    if usage is not None:
+        yield chunk(None, chunk_usage=usage)
+    yield "data: [DONE]\n\n"
+
+
+# --------- Qdrant (query points) ---------
+def create_qdrant_stub(latency_ms: float = 5.0, csv_path: str = CSV_PATH) -> FastAPI:
+    """
+    Minimal Qdrant REST surface for rag.vector_search() and batch_rag (query
+    and query/batch): returns the first `limit` songs from the dataset CSV as
+    hits, after latency_ms.
+    """
+    app = FastAPI(title="Qdrant stub")
+    docs = pd.read_csv(csv_path, encoding="utf-8-sig").to_dict(orient="records")
+
+    @app.get("/")
+    async def root():
+        # mirror the installed client so its compatibility check stays quiet
+        return {"title": "qdrant - vector search engine (stub)", "version": version("qdrant-client")}
+
+    @app.get("/readyz")
+    async def readyz():
+        return "all shards are ready"
+
+    @app.post("/collections/{collection_name}/points/query")
+    async def query_points(collection_name: str, request: Request):
+        t0 = time.perf_counter()
+        body = await request.json()
+        limit = int(body.get("limit", 10))
+
+        await asyncio.sleep(latency_ms / 1000)
+
+        return {"result": {"points": _points(limit)}, "status": "ok", "time": time.perf_counter() - t0}
+
+    @app.post("/collections/{collection_name}/points/query/batch")
+    async def query_batch_points(collection_name: str, request: Request):
+        t0 = time.perf_counter()
+        body = await request.json()
+
+        await asyncio.sleep(latency_ms / 1000)
+
+        result = [{"points": _points(int(search.get("limit", 10)))} for search in body.get("searches", [])]
+        return {"result": result, "status": "ok", "time": time.perf_counter() - t0}
+
+    def _points(limit: int):
+        return [
+            {"id": int(d["id"]), "version": 0, "score": 1.0 - i * 0.01, "payload": d}
+            for i, d in enumerate(docs[:limit])
+        ]
+
+    return app
+
+
+# --------- Postgres (wire protocol) ---------
+# parameter type OIDs by column name, for INSERTs with $n placeholders (asyncpg
+# asks the server for them); everything else is text
+_PG_INT4, _PG_FLOAT8, _PG_TEXT, _PG_TIMESTAMPTZ = 23, 701, 25, 1184
+_INSERT_RE = re.compile(r"INSERT\s+INTO\s+\w+\s*\(([^)]*)\)", re.IGNORECASE)
+
+
+def _pg_column_type(column: str) -> int:
+    if column == "timestamp":
+        return _PG_TIMESTAMPTZ
+    if column in ("response_time", "openai_cost") or column.endswith("_ms"):
+        return _PG_FLOAT8
+    if column == "feedback" or column.endswith("_tokens") or column.endswith("_tokens_original"):
+        return _PG_INT4
+    return _PG_TEXT
+
+
+def _pg_param_types(query: str) -> list:
+    n = max((int(i) for i in re.findall(r"\$(\d+)", query)), default=0)
+    match = _INSERT_RE.search(query)
+    columns = [c.strip() for c in match.group(1).split(",")] if match else []
+    return [_pg_column_type(columns[i]) if i < len(columns) else _PG_TEXT for i in range(n)]
+
+
+def _pg_message(kind: bytes, payload: bytes = b"") -> bytes:
+    return kind + struct.pack("!I", len(payload) + 4) + payload
+
+
+def _pg_tag(query: str) -> str:
+    words = query.split()
+    verb = words[0].upper() if words else ""
+    return {"INSERT": "INSERT 0 1", "UPDATE": "UPDATE 1", "DELETE": "DELETE 0", "SELECT": "SELECT 0"}.get(verb, verb)
+
+
+class PostgresStub:
+    """
+    Postgres stand-in speaking just enough of the wire protocol for db.py:
+    trust auth, simple queries (psycopg2, asyncpg's pool reset, SELECT 1
+    pre-pings) and the extended protocol asyncpg uses for $n queries.
+    Statements are not executed: every INSERT succeeds after latency_ms, and
+    queries return no rows (except the simple-protocol SELECT 1).
+    """
+
+    def __init__(self, latency_ms: float = 2.0):
+        self.latency_ms = latency_ms
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            await self._startup(reader, writer)
+            await self._serve(reader, writer)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _startup(self, reader, writer):
+        while True:
+            length, code = struct.unpack("!II", await reader.readexactly(8))
+            await reader.readexactly(length - 8)
+            if code in (80877103, 80877104):  # SSLRequest / GSSENCRequest: not supported, go on in plain text
+                writer.write(b"N")
+                continue
+            break
+        out = _pg_message(b"R", struct.pack("!I", 0))  # AuthenticationOk
+        for name, value in (("server_version", "16.0"), ("server_encoding", "UTF8"), ("client_encoding", "UTF8"),
+                            ("DateStyle", "ISO, MDY"), ("TimeZone", "UTC"), ("integer_datetimes", "on"),
+                            ("standard_conforming_strings", "on")):
+            out += _pg_message(b"S", name.encode() + b"\0" + value.encode() + b"\0")
+        out += _pg_message(b"K", struct.pack("!II", os.getpid(), 0))
+        writer.write(out + _pg_message(b"Z", b"I"))
+        await writer.drain()
+
+    async def _serve(self, reader, writer):
+        statements, portals, status = {}, {}, b"I"
+        while True:
+            kind = await reader.readexactly(1)
+            (length,) = struct.unpack("!I", await reader.readexactly(4))
+            body = await reader.readexactly(length - 4)
+            if kind == b"X":  # Terminate
+                return
+            if kind == b"Q":
+                query = body[:-1].decode()
+                out, status = await self._simple(query, status)
+                writer.write(out + _pg_message(b"Z", status))
+            elif kind == b"P":  # Parse
+                name, rest = body.split(b"\0", 1)
+                statements[name] = rest.split(b"\0", 1)[0].decode()
+                writer.write(_pg_message(b"1"))
+            elif kind == b"B":  # Bind
+                portal, rest = body.split(b"\0", 1)
+                portals[portal] = statements.get(rest.split(b"\0", 1)[0], "")
+                writer.write(_pg_message(b"2"))
+            elif kind == b"D":  # Describe
+                name = body[1:-1]
+                if body[:1] == b"S":
+                    types = _pg_param_types(statements.get(name, ""))
+                    writer.write(_pg_message(b"t", struct.pack(f"!H{len(types)}I", len(types), *types)))
+                writer.write(_pg_message(b"n"))  # NoData: no statement here returns rows
+            elif kind == b"E":  # Execute
+                query = portals.get(body.split(b"\0", 1)[0], "")
+                await self._run(query)
+                writer.write(_pg_message(b"C", _pg_tag(query).encode() + b"\0"))
+            elif kind == b"C":  # Close
+                writer.write(_pg_message(b"3"))
+            elif kind == b"S":  # Sync
+                writer.write(_pg_message(b"Z", status))
+            await writer.drain()
+
+    async def _simple(self, query: str, status: bytes):
+        stripped = query.strip().rstrip(";")
+        if stripped.upper() == "SELECT 1":
+            field = b"?column?\0" + struct.pack("!IhIhih", 0, 0, _PG_INT4, 4, -1, 0)
+            return (_pg_message(b"T", struct.pack("!H", 1) + field)
+                    + _pg_message(b"D", struct.pack("!HI", 1, 1) + b"1")
+                    + _pg_message(b"C", b"SELECT 1\0")), status
+        if not stripped:
+            return _pg_message(b"I"), status
+        # one multi-row INSERT (execute_values) may contain ';' inside values
+        queries = [stripped] if stripped.upper().startswith("INSERT") else [q for q in stripped.split(";") if q.strip()]
+        out = b""
+        for q in queries:
+            verb = q.split()[0].upper()
+            if verb == "BEGIN":
+                status = b"T"
+            elif verb in ("COMMIT", "ROLLBACK", "END"):
+                status = b"I"
+            await self._run(q)
+            out += _pg_message(b"C", _pg_tag(q).encode() + b"\0")
+        return out, status
+
+    async def _run(self, query: str):
+        if _INSERT_RE.search(query):
+            await asyncio.sleep(self.latency_ms / 1000)
+
+
+async def serve_postgres_stub(host: str, port: int, latency_ms: float = 2.0):
+    stub = PostgresStub(latency_ms)
+    server = await asyncio.start_server(stub.handle, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+# --------- Runner ---------
+def serve_in_thread(app: FastAPI, port: int, host: str = "127.0.0.1") -> uvicorn.Server:
+    """
+    Starts `app` with uvicorn in a daemon thread and waits until it accepts
+    requests. Stop it with `server.should_exit = True`.
+    """
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def serve_in_process(kind: str, port: int, *extra_args: str) -> subprocess.Popen:
+    """
+    Runs this script as a separate process (so the stub does not share the
+    caller's GIL) and waits until its port accepts connections.
+    Stop it with `proc.terminate()`.
+    """
+    proc = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), kind, "--host", "127.0.0.1", "--port", str(port), *extra_args]
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return proc
+        except OSError:
+            if proc.poll() is not None:
+                raise RuntimeError(f"{kind} stub exited with code {proc.returncode}")
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError(f"{kind} stub did not start on port {port}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local OpenAI, Qdrant or Postgres stub server.")
+    parser.add_argument("kind", choices=["openai", "qdrant", "postgres"])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--latency-ms", type=float, default=None)
+    parser.add_argument("--completion-tokens", type=int, default=60)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="openai: share of requests answered 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="openai: share answered 429")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="openai: share delayed by --slow-ms")
+    parser.add_argument("--slow-ms", type=float, default=5000.0)
+    args = parser.parse_args()
+
+    if args.kind == "openai":
+        app = create_openai_stub(
+            latency_ms=300.0 if args.latency_ms is None else args.latency_ms,
+            completion_tokens=args.completion_tokens,
+            error_rate=args.error_rate,
+            rate_limit_rate=args.rate_limit_rate,
+            slow_rate=args.slow_rate,
+            slow_ms=args.slow_ms,
+        )
+        port = args.port or 8081
+    elif args.kind == "qdrant":
+        app = create_qdrant_stub(latency_ms=5.0 if args.latency_ms is None else args.latency_ms)
+        port = args.port or 6335
+    else:
+        latency_ms = 2.0 if args.latency_ms is None else args.latency_ms
+        asyncio.run(serve_postgres_stub(args.host, args.port or 5433, latency_ms))
+        return
+
+    uvicorn.run(app, host=args.host, port=port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
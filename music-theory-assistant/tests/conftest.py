@@ -0,0 +1,15 @@
+# tests/conftest.py — run with `pytest` from music-theory-assistant/
+#
+# The modules import each other by name (the Docker image runs them from
+# /app), so the test session puts this directory on sys.path. Everything runs
+# offline: the stub embedding model, no timezone check against Postgres and a
+# dummy OpenAI key (no test talks to the real API).
+import os
+import sys
+
+os.environ.setdefault("EMBED_MODEL", "stub")
+os.environ.setdefault("SPARSE_MODEL", "stub")
+os.environ.setdefault("RUN_TIMEZONE_CHECK", "0")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+from qdrant_client import models
+
+import batch_rag
+import db
+import rag
+
+
+def _answer_data(question):
+    return {"answer": f"answer to {question}", "model_used": "stub", "response_time": 0.1, "total_tokens": 0}
+
+
+@pytest.fixture
+def answered(monkeypatch):
+    async def arag_batch(questions, **kwargs):
+        for q in questions:
+            if "fail" in q:
+                yield None, [], "RuntimeError: boom"
+            else:
+                yield _answer_data(q), [], None
+
+    monkeypatch.setattr(batch_rag, "arag_batch", arag_batch)
+    monkeypatch.setattr(batch_rag, "BATCH_PERSIST_SIZE", 2)
+
+
+def _run(rows, **kwargs):
+    async def collect():
+        return [record async for record in batch_rag.run_batch(rows, **kwargs)]
+    return asyncio.run(collect())
+
+
+def test_on_saved_counts_rows_after_each_bulk_insert(answered, monkeypatch):
+    saved = []
+
+    async def asave_conversations(rows):
+        saved.append([question for _, question, _ in rows])
+
+    monkeypatch.setattr(db, "asave_conversations", asave_conversations)
+    counted = []
+    rows = [{"question": q} for q in ("a", "b", "fail", "c")]
+    records = _run(rows, persist=True, on_saved=counted.append)
+
+    assert saved == [["a", "b"], ["c"]]
+    assert counted == [2, 1]
+    assert "error" in records[2] and "conversation_id" not in records[2]
+
+
+def test_failed_bulk_insert_is_not_counted(answered, monkeypatch):
+    async def asave_conversations(rows):
+        raise ConnectionError("postgres down")
+
+    monkeypatch.setattr(db, "asave_conversations", asave_conversations)
+    counted = []
+    with pytest.raises(ConnectionError):
+        _run([{"question": "a"}, {"question": "b"}], persist=True, on_saved=counted.append)
+    assert counted == []
+
+
+def test_answer_failure_is_not_retried_on_top_of_the_llm_caller(monkeypatch):
+    calls = []
+
+    async def allm(prompt, model=None):
+        calls.append(prompt)
+        raise RuntimeError("upstream still failing after the caller's own retries")
+
+    monkeypatch.setattr(rag, "allm", allm)
+    with pytest.raises(RuntimeError):
+        asyncio.run(batch_rag._answer("Which songs use a plagal cadence?", [], None))
+    assert len(calls) == 1
+
+
+def test_template_answers_skip_retrieval_and_keep_their_source(monkeypatch):
+    song = models.ScoredPoint(id=42, version=0, score=1.0, payload={"title": "Let It Be"})
+    retrieved = models.ScoredPoint(id=7, version=0, score=0.5, payload={"title": "Hey Jude"})
+    searched = []
+
+    async def atemplate_answer(question):
+        if "key" in question:
+            return {"answer": "'Let It Be' by The Beatles is in C major.", "route": "template"}, [song]
+        return None
+
+    async def abatch_search(questions, top_k):
+        searched.extend(questions)
+        return [[retrieved] for _ in questions]
+
+    async def _answer(question, hits, model):
+        return _answer_data(question), hits
+
+    monkeypatch.setattr(batch_rag, "atemplate_answer", atemplate_answer)
+    monkeypatch.setattr(batch_rag, "abatch_search", abatch_search)
+    monkeypatch.setattr(batch_rag, "_answer", _answer)
+    rows = [{"question": "Why does Hey Jude modulate?"}, {"question": "What key is Let It Be in?"}]
+    records = _run(rows)
+
+    assert searched == ["Why does Hey Jude modulate?"]
+    assert [r["source_ids"] for r in records] == [[7], [42]]
+    assert records[1]["route"] == "template"
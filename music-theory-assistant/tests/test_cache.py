@@ -0,0 +1,110 @@
+import pytest
+from qdrant_client import QdrantClient, models
+
+from cache import CollectionVersion, SemanticCache
+from embedder import HashingEmbedding
+
+EMBED = HashingEmbedding(dim=64)
+ANSWER = {"answer": "It is in C major.", "model_used": "gpt-4o-mini", "response_time": 1.2, "relevance": "RELEVANT",
+          "prompt_tokens": 100, "completion_tokens": 10, "total_tokens": 110, "openai_cost": 0.001}
+HIT = models.ScoredPoint(id=7, version=0, score=0.9, payload={"title": "Let It Be"})
+
+
+def _vector(text):
+    return next(EMBED.embed(text)).tolist()
+
+
+@pytest.fixture
+def qd():
+    return QdrantClient(":memory:")
+
+
+@pytest.fixture
+def cache(qd):
+    return SemanticCache(qd, CollectionVersion(qd), collection="answer-cache", threshold=0.98, dim=64,
+                         max_entries=2, evict_every=3)
+
+
+def test_hit_is_restamped_as_free(cache):
+    cache.store("What key is Let It Be in?", _vector("What key is Let It Be in?"), ANSWER, [HIT], scope="key|let it be")
+    answer_data, hits = cache.lookup(_vector("what key is let it be in"), scope="key|let it be")
+    assert answer_data["answer"] == ANSWER["answer"]
+    assert answer_data["model_used"] == "cache" and answer_data["openai_cost"] == 0.0
+    assert answer_data["total_tokens"] == 0
+    assert [h.id for h in hits] == [7]
+
+
+def test_other_scope_misses(cache):
+    question = "What key is Let It Be in?"
+    cache.store(question, _vector(question), ANSWER, [HIT], scope="key|let it be")
+    assert cache.lookup(_vector(question), scope="cadence|let it be") is None
+
+
+def test_below_threshold_misses(cache):
+    cache.store("What key is Let It Be in?", _vector("What key is Let It Be in?"), ANSWER, [HIT])
+    assert cache.lookup(_vector("Which songs use a plagal cadence?")) is None
+
+
+def test_malformed_entry_is_a_miss_not_an_error(cache, qd):
+    question = "What key is Let It Be in?"
+    cache._ensure_collection()
+    qd.upsert("answer-cache", points=[models.PointStruct(id=1, vector=_vector(question), payload={
+        "question": question, "created_at": 4e9, "last_hit": 4e9, "version": "0", "scope": "",
+    })])  # no answer_data / sources
+    assert cache.lookup(_vector(question)) is None
+
+
+def test_failed_hit_stamp_still_returns_the_hit(cache, qd, monkeypatch):
+    question = "What key is Let It Be in?"
+    cache.store(question, _vector(question), ANSWER, [HIT])
+
+    def timeout(*args, **kwargs):
+        raise TimeoutError("qdrant timed out")
+
+    monkeypatch.setattr(qd, "set_payload", timeout)
+    assert cache.lookup(_vector(question))[0]["answer"] == ANSWER["answer"]
+
+
+def test_lookup_error_is_a_miss(cache, qd, monkeypatch):
+    def down(*args, **kwargs):
+        raise ConnectionError("qdrant down")
+
+    monkeypatch.setattr(qd, "query_points", down)
+    assert cache.lookup(_vector("anything")) is None
+
+
+def test_capacity_is_checked_every_n_stores(cache, qd, monkeypatch):
+    counts = []
+    count = qd.count
+    monkeypatch.setattr(qd, "count", lambda *a, **kw: counts.append(1) or count(*a, **kw))
+    for n in range(2):
+        cache.store(f"question {n}", _vector(f"question {n}"), ANSWER, [HIT])
+    assert counts == []
+    cache.store("question 2", _vector("question 2"), ANSWER, [HIT])  # third store: evict
+    assert counts
+    assert qd.count("answer-cache", exact=True).count == 2
+
+
+def test_non_relevant_answers_are_not_stored(cache, qd):
+    cache.store("q", _vector("q"), {**ANSWER, "relevance": "NON_RELEVANT"}, [HIT])
+    assert not qd.collection_exists("answer-cache") or qd.count("answer-cache").count == 0
+
+
+@pytest.mark.parametrize("relevance", ["PENDING", "SKIPPED", "UNKNOWN"])
+def test_answers_without_a_final_verdict_are_not_stored(cache, qd, relevance):
+    cache.store("q", _vector("q"), {**ANSWER, "relevance": relevance}, [HIT])
+    assert not qd.collection_exists("answer-cache") or qd.count("answer-cache").count == 0
+
+
+def test_hits_carry_the_final_verdict(cache):
+    cache.store("q", _vector("q"), {**ANSWER, "relevance": "PARTLY_RELEVANT"}, [HIT])
+    answer_data, _ = cache.lookup(_vector("q"))
+    assert answer_data["relevance"] == "PARTLY_RELEVANT"  # never PENDING: the background judge skips the row
+
+
+def test_pending_entries_stored_earlier_are_not_served(cache, monkeypatch):
+    import cache as cache_module
+    monkeypatch.setattr(cache_module, "CACHEABLE_RELEVANCE", ("RELEVANT", "PARTLY_RELEVANT", "PENDING"))
+    cache.store("q", _vector("q"), {**ANSWER, "relevance": "PENDING"}, [HIT])
+    monkeypatch.undo()
+    assert cache.lookup(_vector("q")) is None
@@ -0,0 +1,46 @@
+import asyncio
+import threading
+
+import pytest
+
+from embedder import Embedder
+
+
+@pytest.fixture
+def embedder():
+    e = Embedder(model_name="stub", batch_wait_ms=20)
+    e.warmup()
+    return e
+
+
+def test_embed_returns_vector(embedder):
+    assert len(embedder.embed("perfect cadence")) == embedder._model.dim
+
+
+def test_cancelled_aembed_does_not_kill_worker(embedder):
+    async def scenario():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(embedder.aembed("cancelled"), 0.001)  # cancels the queued future
+        await asyncio.sleep(0.05)  # let the worker pick up the batch with the cancelled future
+        return await asyncio.wait_for(embedder.aembed("next"), 2)
+
+    assert len(asyncio.run(scenario())) == embedder._model.dim
+    assert len(embedder.embed("sync after cancel")) == embedder._model.dim
+
+
+def test_model_error_fails_batch_not_worker(embedder):
+    model = embedder._model
+    calls = threading.Event()
+
+    class Broken:
+        def embed(self, texts, batch_size=64):
+            calls.set()
+            raise RuntimeError("onnx failure")
+
+    embedder._model = Broken()
+    with pytest.raises(RuntimeError, match="onnx failure"):
+        embedder.embed("fails")
+    assert calls.is_set()
+
+    embedder._model = model
+    assert len(embedder.embed("recovers")) == model.dim
@@ -0,0 +1,49 @@
+import socket
+import asyncio
+
+import openai
+import pytest
+
+import eval_rag
+from stub_servers import create_openai_stub, serve_in_thread
+
+
+@pytest.fixture(scope="module")
+def rate_limited_url():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = serve_in_thread(create_openai_stub(latency_ms=0, rate_limit_rate=1.0, retry_after_ms=50), port)
+    yield f"http://127.0.0.1:{port}/v1"
+    server.should_exit = True
+
+
+def test_call_is_the_only_retry_layer(rate_limited_url, monkeypatch):
+    monkeypatch.setattr(eval_rag, "EVAL_MAX_RETRIES", 2)
+    caller = eval_rag.single_attempt_caller()
+    attempts = []
+
+    async def scenario():
+        client = openai.AsyncOpenAI(base_url=rate_limited_url, api_key="test", max_retries=0)
+
+        async def attempt(timeout):
+            attempts.append(timeout)
+            return await client.chat.completions.create(
+                model="stub", messages=[{"role": "user", "content": "ping"}], timeout=timeout,
+            )
+
+        limiter = eval_rag.RateLimiter()
+        with pytest.raises(openai.RateLimitError):
+            await eval_rag.call(limiter, asyncio.Semaphore(4), caller.acall, attempt)
+        return limiter
+
+    limiter = asyncio.run(scenario())
+    assert len(attempts) == 3  # EVAL_MAX_RETRIES + 1, not multiplied by LLM_MAX_RETRIES
+    assert limiter._resume_at > 0  # the raw 429 reached call() and paused the workers
+
+
+def test_single_attempt_caller_never_opens():
+    caller = eval_rag.single_attempt_caller()
+    for _ in range(50):
+        caller.breaker.record(False)
+    assert caller.breaker.allow()
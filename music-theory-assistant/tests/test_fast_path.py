@@ -0,0 +1,78 @@
+import pytest
+
+from fast_path import SongCatalog
+
+SONGS = [
+    {"id": 1, "title": "Let It Be", "artist": "The Beatles", "key": "C major", "tempo_bpm": 72.0},
+    {"id": 2, "title": "Let It", "artist": "Somebody", "key": "D major"},
+    {"id": 3, "title": "Black", "artist": "Pearl Jam", "key": "E major"},
+    {"id": 4, "title": "Hurt", "artist": "Nine Inch Nails", "key": "A minor"},
+    {"id": 5, "title": "Hurt", "artist": "Johnny Cash", "key": "A minor"},
+    {"id": 6, "title": "Don’t Stop Believin’", "artist": "Journey", "key": "E major"},
+]
+
+
+class FakeVersion:
+    def __init__(self):
+        self.value = "v1"
+
+    def current(self):
+        return self.value
+
+
+class FakeLocal:
+    def __init__(self, payloads):
+        self.loads = 0
+        self._payloads = payloads
+
+    def payloads(self):
+        self.loads += 1
+        return self._payloads
+
+
+@pytest.fixture
+def catalog():
+    return SongCatalog(qd=None, version=FakeVersion(), collection="songs", local=FakeLocal(SONGS))
+
+
+def test_multi_word_title_matches_in_any_case(catalog):
+    assert catalog.resolve("what key is let it be in?")["id"] == 1
+
+
+def test_longest_title_wins(catalog):
+    assert catalog.named_titles("What is the key of Let It Be?") == ["Let It Be"]
+
+
+def test_one_word_title_needs_its_capitalisation_unless_quoted(catalog):
+    assert catalog.resolve("What is the key of Black?")["id"] == 3
+    assert catalog.resolve("what key is a black key?") is None
+    assert catalog.resolve("what is the key of 'black'?")["id"] == 3
+
+
+def test_duplicate_title_is_disambiguated_by_artist(catalog):
+    assert catalog.resolve("What key is Hurt in?") is None
+    assert catalog.resolve("What key is Hurt by Johnny Cash in?")["id"] == 5
+
+
+def test_two_titles_are_ambiguous(catalog):
+    assert sorted(catalog.named_titles("Is Let It Be in the same key as Black?")) == ["Black", "Let It Be"]
+    assert catalog.resolve("Is Let It Be in the same key as Black?") is None
+
+
+def test_punctuation_in_titles(catalog):
+    assert catalog.resolve("What's the key of Don't Stop Believin'?")["id"] == 6
+
+
+def test_answer_uses_the_template(catalog):
+    answer, hit = catalog.answer("What is the tempo of Let It Be?")
+    assert answer == "'Let It Be' by The Beatles has a tempo of 72 BPM."
+    assert hit.id == 1
+
+
+def test_index_is_built_once_per_version(catalog):
+    catalog.resolve("What key is Let It Be in?")
+    catalog.resolve("What key is Black in?")
+    assert catalog.local.loads == 1
+    catalog.version.value = "v2"
+    catalog.resolve("What key is Black in?")
+    assert catalog.local.loads == 2
@@ -0,0 +1,118 @@
+import time
+from contextlib import contextmanager
+
+import pytest
+
+import db
+
+VERDICT = {"relevance": "RELEVANT", "relevance_explanation": "ok", "eval_prompt_tokens": 10,
+           "eval_completion_tokens": 2, "eval_total_tokens": 12, "eval_cost": 0.001, "judge_ms": 5.0}
+
+
+class FakeConversations:
+    """Stands in for db_connection() over the judge queue statements; tracks open transactions."""
+
+    def __init__(self, *questions, relevance="PENDING", claimed_at=None):
+        self.rows = {
+            q: {"id": q, "question": q, "answer": f"answer to {q}", "relevance": relevance, "judge_attempts": 0,
+                "judge_claimed_at": claimed_at, "timestamp": n, "openai_cost": 0.0}
+            for n, q in enumerate(questions)
+        }
+        self.in_transaction = False
+        self.connections = 0
+        self._claimed = None
+
+    @contextmanager
+    def connection(self):
+        self.connections += 1
+        try:
+            yield self
+        finally:
+            self.connections -= 1
+            self.in_transaction = False  # the pool rolls back unfinished transactions
+
+    @contextmanager
+    def cursor(self, cursor_factory=None):
+        yield self
+
+    def commit(self):
+        self.in_transaction = False
+
+    def fetchone(self):
+        return self._claimed
+
+    def execute(self, sql, params):
+        self.in_transaction = True
+        if "RETURNING" in sql:
+            stale = time.time() - params[0]
+            queue = [r for r in self.rows.values() if r["relevance"] == "PENDING"
+                     or (r["relevance"] == "JUDGING" and r["judge_claimed_at"] < stale)]
+            queue.sort(key=lambda r: (r["judge_attempts"], r["timestamp"]))
+            self._claimed = None
+            if queue:
+                row = queue[0]
+                row.update(relevance="JUDGING", judge_claimed_at=time.time(), judge_attempts=row["judge_attempts"] + 1)
+                self._claimed = {k: row[k] for k in ("id", "question", "answer", "judge_attempts")}
+            return
+        row = self.rows[params[-1]]
+        if row["relevance"] != "JUDGING":
+            return
+        if "'UNKNOWN'" in sql:
+            row.update(relevance="UNKNOWN", relevance_explanation=params[0], judge_claimed_at=None)
+        elif "'PENDING'" in sql:
+            row.update(relevance="PENDING", judge_claimed_at=None)
+        else:
+            row.update(relevance=params[0], openai_cost=row["openai_cost"] + params[5], judge_claimed_at=None)
+
+
+def _drain(fake, judge, max_attempts=3, polls=20):
+    for _ in range(polls):
+        try:
+            if not db.judge_next_pending(judge, max_attempts=max_attempts):
+                return
+        except RuntimeError:
+            pass
+
+
+def test_failing_row_does_not_block_newer_rows(monkeypatch):
+    fake = FakeConversations("poison", "fine", "also fine")
+    monkeypatch.setattr(db, "db_connection", fake.connection)
+    calls = []
+
+    def judge(question, answer):
+        assert not fake.in_transaction and fake.connections == 0  # nothing held during the LLM call
+        calls.append(question)
+        if question == "poison":
+            raise RuntimeError("400 context_length_exceeded")
+        return VERDICT
+
+    _drain(fake, judge)
+
+    assert calls[:3] == ["poison", "fine", "also fine"]  # a failed row goes behind the untried ones
+    assert calls.count("poison") == 3
+    assert fake.rows["fine"]["relevance"] == fake.rows["also fine"]["relevance"] == "RELEVANT"
+    assert fake.rows["poison"]["relevance"] == "UNKNOWN"
+    assert "Judge failed 3 times: RuntimeError" in fake.rows["poison"]["relevance_explanation"]
+
+
+def test_failed_judge_call_is_re_raised_and_requeued(monkeypatch):
+    fake = FakeConversations("q")
+    monkeypatch.setattr(db, "db_connection", fake.connection)
+
+    def judge(question, answer):
+        raise RuntimeError("circuit open")
+
+    with pytest.raises(RuntimeError):
+        db.judge_next_pending(judge, max_attempts=3)
+    assert fake.rows["q"]["relevance"] == "PENDING" and fake.rows["q"]["judge_attempts"] == 1
+
+
+def test_stale_claims_are_reclaimed(monkeypatch):
+    fake = FakeConversations("crashed", relevance="JUDGING", claimed_at=time.time() - 600)
+    fake.rows.update(FakeConversations("in progress", relevance="JUDGING", claimed_at=time.time()).rows)
+    monkeypatch.setattr(db, "db_connection", fake.connection)
+
+    assert db.judge_next_pending(lambda q, a: VERDICT, claim_timeout=300)
+    assert fake.rows["crashed"]["relevance"] == "RELEVANT"
+    assert not db.judge_next_pending(lambda q, a: VERDICT, claim_timeout=300)
+    assert fake.rows["in progress"]["relevance"] == "JUDGING"
@@ -0,0 +1,44 @@
+import os
+
+import numpy as np
+import pytest
+
+import local_index
+from local_index import MANIFEST, LocalIndex, LocalIndexWriter
+
+DOCS = [{"id": 1, "title": "Let It Be", "key": "C major"}, {"id": 2, "title": "Black", "key": "E major"}]
+VECTORS = np.eye(2, 4, dtype=np.float32)
+
+
+def _write(path):
+    writer = LocalIndexWriter(len(DOCS), 4, str(path))
+    writer.add(DOCS, VECTORS)
+    return writer
+
+
+def test_commit_publishes_and_abort_after_commit_is_a_no_op(tmp_path):
+    writer = _write(tmp_path)
+    version = writer.commit()
+    writer.abort()
+    index = LocalIndex(str(tmp_path), check_seconds=0)
+    assert index.current() == version
+    assert [p["title"] for p in index.payloads()] == ["Let It Be", "Black"]
+
+
+def test_failed_commit_removes_its_files_and_publishes_nothing(tmp_path, monkeypatch):
+    writer = _write(tmp_path)
+
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(local_index.np, "save", fail)
+    with pytest.raises(OSError, match="disk full"):
+        writer.commit()
+    assert not os.path.exists(tmp_path / MANIFEST)
+    assert os.listdir(tmp_path) == []
+
+
+def test_abort_before_commit_removes_the_vectors(tmp_path):
+    writer = _write(tmp_path)
+    writer.abort()
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,286 @@
+import asyncio
+
+import pytest
+from qdrant_client import models
+
+import rag
+
+FAST_QUESTION = "What key is Let It Be in?"
+STRONG_QUESTION = "Why does the bridge of Let It Be feel unresolved?"
+SONG = {
+    "title": "Let It Be", "artist": "The Beatles", "genre": "rock", "key": "C major", "tempo_bpm": 72,
+    "time_signature": "4/4", "chord_progression": "C G Am F", "roman_numerals": "I V vi IV",
+    "cadence": "plagal", "theory_notes": "The verse repeats the I V vi IV loop.",
+}
+HITS = [models.ScoredPoint(id=1, version=0, score=0.9, payload=SONG)]
+TOKENS = {"prompt_tokens": 100, "completion_tokens": 10, "total_tokens": 110}
+
+
+def _relevance(question, answer):
+    verdict = "NON_RELEVANT" if rag.ROUTER_FAST_MODEL in answer else "RELEVANT"
+    return {"Relevance": verdict, "Explanation": ""}, TOKENS
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    """rag with routing on and every backend faked: the fast model's answers are judged NON_RELEVANT."""
+    monkeypatch.setattr(rag, "TEMPLATE_ANSWERS", False)
+    monkeypatch.setattr(rag, "SEMANTIC_CACHE", False)
+    monkeypatch.setattr(rag, "MODEL_ROUTING", True)
+    monkeypatch.setattr(rag, "ROUTER_ESCALATE", True)
+    monkeypatch.setattr(rag, "JUDGE_SAMPLE_RATE", 1.0)
+    monkeypatch.setattr(rag, "RELEVANCE_MODE", "inline")
+    monkeypatch.setattr(rag, "ROUTER_FAST_MODEL", "gpt-4o-mini")
+    monkeypatch.setattr(rag, "ROUTER_STRONG_MODEL", "gpt-4o")
+
+    async def aretrieve(question, top_k, vector=None):
+        return HITS, "context"
+
+    async def allm(prompt, model=rag.OPENAI_MODEL):
+        return f"answer from {model}", TOKENS
+
+    async def aevaluate_relevance(question, answer, model=rag.OPENAI_MODEL):
+        return _relevance(question, answer)
+
+    def llm_stream(prompt, model=rag.OPENAI_MODEL):
+        yield "token", "answer "
+        yield "token", f"from {model}"
+        yield "usage", TOKENS
+
+    async def allm_stream(prompt, model=rag.OPENAI_MODEL):
+        for event in llm_stream(prompt, model):
+            yield event
+
+    monkeypatch.setattr(rag, "retrieve", lambda question, top_k, vector=None: (HITS, "context"))
+    monkeypatch.setattr(rag, "aretrieve", aretrieve)
+    monkeypatch.setattr(rag, "llm", lambda prompt, model=rag.OPENAI_MODEL: (f"answer from {model}", TOKENS))
+    monkeypatch.setattr(rag, "allm", allm)
+    monkeypatch.setattr(rag, "llm_stream", llm_stream)
+    monkeypatch.setattr(rag, "allm_stream", allm_stream)
+    monkeypatch.setattr(rag, "evaluate_relevance", _relevance)
+    monkeypatch.setattr(rag, "aevaluate_relevance", aevaluate_relevance)
+
+
+def _rag(asynchronous, question):
+    return asyncio.run(rag.arag(question)) if asynchronous else rag.rag(question)
+
+
+def _rag_stream(asynchronous, question):
+    if not asynchronous:
+        return list(rag.rag_stream(question))
+
+    async def collect():
+        return [event async for event in rag.arag_stream(question)]
+    return asyncio.run(collect())
+
+
+@pytest.mark.parametrize("asynchronous", [False, True])
+def test_fast_answer_judged_non_relevant_is_escalated(pipeline, asynchronous):
+    answer_data, hits = _rag(asynchronous, FAST_QUESTION)
+    assert answer_data["answer"] == "answer from gpt-4o"
+    assert answer_data["route"] == rag.ROUTE_ESCALATED
+    assert answer_data["relevance"] == "RELEVANT"
+    assert answer_data["total_tokens"] == 2 * TOKENS["total_tokens"]  # the discarded fast attempt is paid too
+    assert hits == HITS
+
+
+@pytest.mark.parametrize("asynchronous", [False, True])
+def test_strong_route_is_answered_once(pipeline, asynchronous):
+    answer_data, _ = _rag(asynchronous, STRONG_QUESTION)
+    assert (answer_data["route"], answer_data["model_used"]) == (rag.ROUTE_STRONG, "gpt-4o")
+    assert answer_data["total_tokens"] == TOKENS["total_tokens"]
+
+
+@pytest.mark.parametrize("asynchronous", [False, True])
+def test_stream_is_never_escalated(pipeline, asynchronous):
+    events = _rag_stream(asynchronous, FAST_QUESTION)
+    assert [kind for kind, _ in events] == ["sources", "token", "token", "done"]
+    answer_data = events[-1][1]
+    assert answer_data["answer"] == "answer from gpt-4o-mini"
+    assert (answer_data["route"], answer_data["relevance"]) == (rag.ROUTE_FAST, "NON_RELEVANT")
+
+
+class FakeSemanticCache:
+    def __init__(self, cached=None):
+        self.cached = cached
+        self.lookups = []
+        self.stored = []
+
+    def lookup(self, vector, scope=""):
+        self.lookups.append(scope)
+        return self.cached
+
+    def store(self, question, vector, answer_data, hits, scope=""):
+        self.stored.append((question, scope))
+
+
+@pytest.mark.parametrize("asynchronous", [False, True])
+def test_semantic_cache_hit_is_replayed_as_one_token(pipeline, monkeypatch, asynchronous):
+    cached = {"answer": "cached answer", "model_used": "cache"}
+    semantic_cache = FakeSemanticCache((cached, HITS))
+    monkeypatch.setattr(rag, "SEMANTIC_CACHE", True)
+    monkeypatch.setattr(rag, "semantic_cache", semantic_cache)
+    monkeypatch.setattr(rag, "cache_scope", lambda query: "key|let it be")
+
+    assert _rag_stream(asynchronous, FAST_QUESTION) == [("sources", HITS), ("token", "cached answer"), ("done", cached)]
+    assert _rag(asynchronous, FAST_QUESTION) == (cached, HITS)
+    assert semantic_cache.lookups == ["key|let it be"] * 2
+
+
+@pytest.mark.parametrize("asynchronous", [False, True])
+def test_semantic_cache_miss_stores_the_answer(pipeline, monkeypatch, asynchronous):
+    semantic_cache = FakeSemanticCache()
+    monkeypatch.setattr(rag, "SEMANTIC_CACHE", True)
+    monkeypatch.setattr(rag, "semantic_cache", semantic_cache)
+    monkeypatch.setattr(rag, "cache_scope", lambda query: "key|let it be")
+
+    _rag(asynchronous, STRONG_QUESTION)
+    assert semantic_cache.stored == [(STRONG_QUESTION, "key|let it be")]
+
+
+@pytest.mark.parametrize("asynchronous", [False, True])
+def test_template_answer_skips_the_pipeline(pipeline, monkeypatch, asynchronous):
+    templated = ({"answer": "'Let It Be' by The Beatles is in C major.", "route": rag.ROUTE_TEMPLATE}, HITS)
+    monkeypatch.setattr(rag, "TEMPLATE_ANSWERS", True)
+    monkeypatch.setattr(rag.song_catalog, "answer", lambda query: None)
+    monkeypatch.setattr(rag, "template_answer", lambda query: templated)
+
+    assert _rag(asynchronous, FAST_QUESTION) == templated
+    assert [kind for kind, _ in _rag_stream(asynchronous, FAST_QUESTION)] == ["sources", "token", "done"]
+
+
+# --------- Query filters ---------
+@pytest.fixture
+def vocabulary(monkeypatch):
+    values = {"artist": ["The Beatles", "Queen"], "genre": ["Traditional Irish", "Traditional"]}
+    monkeypatch.setattr(rag.filter_vocabulary, "get", lambda: values)
+
+
+def _conditions(query_filter):
+    return {condition.key: condition for condition in query_filter.must}
+
+
+def test_parse_filter_combines_constraints(vocabulary):
+    conditions = _conditions(rag.parse_filter("Songs in 3/4 by The Beatles faster than 120 bpm"))
+    assert conditions["time_signature"].match.any == ["3/4"]
+    assert conditions["artist"].match.any == ["The Beatles"]
+    assert conditions["tempo_bpm"].range == models.Range(gt=120)
+    assert set(conditions) == {"time_signature", "artist", "tempo_bpm"}
+
+
+@pytest.mark.parametrize("question, spellings", [
+    ("Which songs are in A minor?", ["A minor", "Am"]),
+    ("Songs in the key of f# major", ["F# major", "F#"]),
+    ("Anything in Bb?", None),
+    ("Is a minor chord sad?", None),  # lowercase "a minor" without "in" / "key of" is English
+])
+def test_parse_filter_keys(vocabulary, question, spellings):
+    query_filter = rag.parse_filter(question)
+    if spellings is None:
+        assert query_filter is None or "key" not in _conditions(query_filter)
+    else:
+        assert _conditions(query_filter)["key"].match.any == spellings
+
+
+@pytest.mark.parametrize("question, expected", [
+    ("Songs between 110 and 90 bpm", models.Range(gte=90, lte=110)),
+    ("Which song has a tempo of 72 bpm?", models.Range(gte=72, lte=72)),
+    ("Songs with a tempo of at least 100 and at most 130", models.Range(gte=100, lte=130)),
+])
+def test_parse_filter_tempo(vocabulary, question, expected):
+    assert _conditions(rag.parse_filter(question))["tempo_bpm"].range == expected
+
+
+def test_parse_filter_ignores_bare_numbers_and_plain_questions(vocabulary):
+    assert rag.parse_filter("Name more than 10 songs with a bridge") is None
+    assert rag.parse_filter("What is a cadence?") is None
+
+
+def test_parse_filter_cadence_only_when_unambiguous(vocabulary):
+    assert _conditions(rag.parse_filter("Songs with a plagal cadence"))["cadence"].match.text == "Plagal"
+    assert rag.parse_filter("Plagal cadence or authentic cadence?") is None
+
+
+def test_parse_filter_longest_phrase_wins(vocabulary):
+    conditions = _conditions(rag.parse_filter("Traditional Irish songs like Queen's"))
+    assert conditions["genre"].match.any == ["Traditional Irish"]
+    assert conditions["artist"].match.any == ["Queen"]
+
+
+# --------- Context packing ---------
+@pytest.fixture
+def char_tokens(monkeypatch):
+    """Deterministic ~4 characters per token, whether or not the tiktoken encoding can be downloaded."""
+    monkeypatch.setattr(rag, "_tokenizer", rag._CharTokenizer())
+
+
+def _song(i, **fields):
+    return {**SONG, "id": i, "title": f"Song {i}", **fields}
+
+
+def test_build_context_skips_duplicate_songs(char_tokens):
+    songs = [_song(1), _song(1), _song(2, title="Song 1"), _song(3)]
+    context = rag.build_context(songs, budget=0)
+    assert context == rag._entry(songs[0]) + rag._entry(songs[3])
+
+
+def test_build_context_truncates_the_first_overflow_and_drops_the_rest(char_tokens):
+    songs = [_song(i, theory_notes="x " * 200) for i in range(1, 5)]
+    full = rag.count_tokens(rag._entry(songs[0]))
+    budget = full + full // 2
+    context = rag.build_context(songs, budget=budget)
+
+    assert context.startswith(rag._entry(songs[0]))
+    assert "title: Song 2" in context and "title: Song 3" not in context
+    assert context.rstrip().endswith("…")
+    assert rag.count_tokens(context) <= budget
+
+
+def test_build_context_always_keeps_the_top_hit(char_tokens):
+    context = rag.build_context([_song(1), _song(2)], budget=5)
+    assert "title: Song 1" in context and "title: Song 2" not in context
+
+
+def test_context_tokens_compares_packed_and_full(char_tokens):
+    songs = [_song(i, theory_notes="x " * 200) for i in range(1, 4)]
+    context = rag.build_context(songs, budget=300)
+    stats = rag.context_tokens(songs, context)
+    assert stats["context_tokens"] <= 300 < stats["context_tokens_original"]
+
+
+# --------- Model routing ---------
+@pytest.fixture
+def routing(monkeypatch):
+    monkeypatch.setattr(rag, "MODEL_ROUTING", True)
+    monkeypatch.setattr(rag, "ROUTER_ESCALATE", True)
+    monkeypatch.setattr(rag, "ROUTER_FAST_MODEL", "gpt-4o-mini")
+    monkeypatch.setattr(rag, "ROUTER_STRONG_MODEL", "gpt-4o")
+    monkeypatch.setattr(rag, "ROUTER_MAX_LOOKUP_WORDS", 20)
+
+
+def test_route_model(routing, monkeypatch):
+    assert rag.route_model(FAST_QUESTION) == (rag.ROUTE_FAST, "gpt-4o-mini")
+    assert rag.route_model(STRONG_QUESTION) == (rag.ROUTE_STRONG, "gpt-4o")
+    assert rag.route_model("What key " + "and what else " * 10 + "is Let It Be in?") == (rag.ROUTE_STRONG, "gpt-4o")
+    assert rag.route_model(FAST_QUESTION, model="gpt-4.1") == (rag.ROUTE_DEFAULT, "gpt-4.1")
+
+    monkeypatch.setattr(rag, "MODEL_ROUTING", False)
+    assert rag.route_model(STRONG_QUESTION) == (rag.ROUTE_DEFAULT, rag.OPENAI_MODEL)
+
+
+@pytest.mark.parametrize("route, model, verdict, escalate", [
+    (rag.ROUTE_FAST, "gpt-4o-mini", "NON_RELEVANT", True),
+    (rag.ROUTE_FAST, "gpt-4o-mini", "RELEVANT", False),
+    (rag.ROUTE_FAST, "gpt-4o-mini", "PENDING", False),  # background judge: too late to escalate
+    (rag.ROUTE_FAST, "gpt-4o-mini", "SKIPPED", False),
+    (rag.ROUTE_FAST, "gpt-4o", "NON_RELEVANT", False),  # already the strong model
+    (rag.ROUTE_STRONG, "gpt-4o", "NON_RELEVANT", False),
+    (rag.ROUTE_DEFAULT, "gpt-4o-mini", "NON_RELEVANT", False),
+])
+def test_should_escalate(routing, route, model, verdict, escalate):
+    assert rag.should_escalate(route, model, {"Relevance": verdict}) is escalate
+
+
+def test_escalation_can_be_switched_off(routing, monkeypatch):
+    monkeypatch.setattr(rag, "ROUTER_ESCALATE", False)
+    assert not rag.should_escalate(rag.ROUTE_FAST, "gpt-4o-mini", {"Relevance": "NON_RELEVANT"})
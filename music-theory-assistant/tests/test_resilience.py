@@ -0,0 +1,178 @@
+import time
+import socket
+import asyncio
+import contextvars
+
+import openai
+import pytest
+
+from resilience import (
+    CircuitBreaker, CircuitOpenError, LLMUnavailableError, ResilientCaller, set_request_deadline,
+)
+from stub_servers import create_openai_stub, serve_in_thread
+
+COOLDOWN = 0.2
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _serve(**faults):
+    port = _free_port()
+    server = serve_in_thread(create_openai_stub(latency_ms=0, completion_tokens=3, **faults), port)
+    return server, f"http://127.0.0.1:{port}/v1"
+
+
+@pytest.fixture(scope="module")
+def stubs():
+    healthy, healthy_url = _serve()
+    failing, failing_url = _serve(error_rate=1.0)  # every request answers 500
+    yield {"healthy": healthy_url, "failing": failing_url, "missing": healthy_url.replace("/v1", "/nope/v1")}
+    healthy.should_exit = failing.should_exit = True
+
+
+def _attempt(base_url):
+    client = openai.OpenAI(base_url=base_url, api_key="test", max_retries=0)
+    return lambda timeout: client.chat.completions.create(
+        model="stub", messages=[{"role": "user", "content": "ping"}], timeout=timeout
+    )
+
+
+def _async_attempt(base_url):
+    client = openai.AsyncOpenAI(base_url=base_url, api_key="test", max_retries=0)
+    return lambda timeout: client.chat.completions.create(
+        model="stub", messages=[{"role": "user", "content": "ping"}], timeout=timeout
+    )
+
+
+def _open_caller(stubs) -> ResilientCaller:
+    """A caller whose breaker was opened by real 500s from the failing stub."""
+    caller = ResilientCaller(CircuitBreaker(failure_rate=0.5, min_calls=4, cooldown=COOLDOWN),
+                             max_retries=0, hedge=False)
+    for _ in range(4):
+        with pytest.raises(openai.InternalServerError):
+            caller.call(_attempt(stubs["failing"]))
+    assert caller.breaker.state == CircuitBreaker.OPEN
+    return caller
+
+
+# --------- CircuitBreaker ---------
+def test_breaker_stays_closed_below_min_calls():
+    breaker = CircuitBreaker(failure_rate=0.5, min_calls=4)
+    for _ in range(3):
+        breaker.record(False)
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.allow()
+
+
+def test_breaker_opens_at_failure_rate():
+    breaker = CircuitBreaker(failure_rate=0.5, min_calls=4)
+    for ok in (True, False, True, False):
+        breaker.record(ok)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+
+def test_breaker_window_forgets_old_failures():
+    breaker = CircuitBreaker(failure_rate=0.5, min_calls=2, window=0.05)
+    breaker.record(False)
+    time.sleep(0.1)
+    breaker.record(True)
+    breaker.record(True)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_admits_a_single_probe():
+    breaker = CircuitBreaker(failure_rate=0.5, min_calls=1, cooldown=0.01)
+    breaker.record(False)
+    time.sleep(0.02)
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()  # probe in flight
+    breaker.release()
+    assert breaker.allow()  # released probe goes to the next call
+
+
+# --------- ResilientCaller against the fault-injecting stub ---------
+def test_open_breaker_fails_fast(stubs):
+    caller = _open_caller(stubs)
+    t0 = time.monotonic()
+    with pytest.raises(CircuitOpenError):
+        caller.call(_attempt(stubs["healthy"]))
+    assert time.monotonic() - t0 < 0.05
+
+
+def test_retries_then_gives_up(stubs):
+    caller = ResilientCaller(CircuitBreaker(failure_rate=1.1), max_retries=2, retry_base=0.01, hedge=False)
+    calls = []
+    attempt = _attempt(stubs["failing"])
+
+    def counted(timeout):
+        calls.append(timeout)
+        return attempt(timeout)
+
+    with pytest.raises(openai.InternalServerError):
+        caller.call(counted)
+    assert len(calls) == 3
+
+
+def test_half_open_probe_success_closes(stubs):
+    caller = _open_caller(stubs)
+    time.sleep(COOLDOWN)
+    assert caller.call(_attempt(stubs["healthy"])).choices[0].message.content == "stub stub stub"
+    assert caller.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_probe_failure_reopens(stubs):
+    caller = _open_caller(stubs)
+    time.sleep(COOLDOWN)
+    with pytest.raises(openai.InternalServerError):
+        caller.call(_attempt(stubs["failing"]))
+    assert caller.breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        caller.call(_attempt(stubs["healthy"]))
+
+
+def test_non_retryable_probe_error_releases_probe(stubs):
+    caller = _open_caller(stubs)
+    time.sleep(COOLDOWN)
+    with pytest.raises(openai.NotFoundError):  # a 4xx: no verdict on the upstream
+        caller.call(_attempt(stubs["missing"]))
+    assert caller.breaker.state == CircuitBreaker.HALF_OPEN
+    caller.call(_attempt(stubs["healthy"]))  # the next call probes instead of failing fast
+    assert caller.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_spent_budget_does_not_take_the_probe(stubs):
+    caller = _open_caller(stubs)
+    time.sleep(COOLDOWN)
+
+    def spent():
+        set_request_deadline(0)
+        with pytest.raises(LLMUnavailableError) as exc:
+            caller.call(_attempt(stubs["healthy"]))
+        assert not isinstance(exc.value, CircuitOpenError)
+
+    contextvars.copy_context().run(spent)  # the budget stays local to this call
+    caller.call(_attempt(stubs["healthy"]))
+    assert caller.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_cancelled_async_probe_releases_probe(stubs):
+    caller = _open_caller(stubs)
+    time.sleep(COOLDOWN)
+    slow, slow_url = _serve(slow_rate=1.0, slow_ms=2000)
+
+    async def scenario():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(caller.acall(_async_attempt(slow_url)), 0.1)
+        assert caller.breaker.state == CircuitBreaker.HALF_OPEN
+        await caller.acall(_async_attempt(stubs["healthy"]))
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        slow.should_exit = True
+    assert caller.breaker.state == CircuitBreaker.CLOSED
@@ -0,0 +1,119 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import psycopg2
+import pytest
+from prometheus_client import REGISTRY
+
+import db
+
+NOW = datetime(2024, 1, 1, tzinfo=timezone.utc)
+ANSWER = {"answer": "V-I", "model_used": "gpt-4o-mini", "response_time": 0.5}
+
+
+class FakePostgres:
+    """Stands in for db_connection() + execute_values: commits on commit(), enforces the feedback FK."""
+
+    def __init__(self, transient_failures: int = 0):
+        self.transient_failures = transient_failures
+        self.conversations, self.feedback, self.writes = [], [], 0
+        self._pending = None
+
+    @contextmanager
+    def connection(self):
+        self._pending = ([], [])
+        yield self
+        self._pending = None
+
+    @contextmanager
+    def cursor(self):
+        yield self
+
+    def commit(self):
+        self.conversations += self._pending[0]
+        self.feedback += self._pending[1]
+        self.writes += 1
+
+    def execute_values(self, cur, sql, rows, page_size=None):
+        if self.transient_failures:
+            self.transient_failures -= 1
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        for row in rows:
+            if any(isinstance(v, str) and "\x00" in v for v in row):
+                raise ValueError("A string literal cannot contain NUL (0x00) characters.")
+        if "INTO feedback" in sql:
+            known = {row[0] for row in self.conversations + self._pending[0]}
+            if any(row[0] not in known for row in rows):
+                raise psycopg2.IntegrityError("insert or update on table \"feedback\" violates foreign key")
+            self._pending[1].extend(rows)
+        else:
+            self._pending[0].extend(rows)
+
+
+@pytest.fixture
+def postgres(monkeypatch):
+    fake = FakePostgres()
+    monkeypatch.setattr(db, "db_connection", fake.connection)
+    monkeypatch.setattr(db, "execute_values", fake.execute_values)
+    return fake
+
+
+@pytest.fixture
+def buffer():
+    b = db.WriteBehindBuffer(max_queue=100, batch_size=100, flush_seconds=60, put_timeout=0.1, max_attempts=2)
+    yield b
+    b.close()
+
+
+def _conversation(conversation_id, question="Which cadence?"):
+    return "conversation", db._conversation_values(conversation_id, question, ANSWER, NOW)
+
+
+def _feedback(conversation_id):
+    return "feedback", (conversation_id, 1, NOW)
+
+
+def _dropped(kind):
+    return REGISTRY.get_sample_value("write_behind_rows_dropped_total", {"kind": kind}) or 0.0
+
+
+def test_close_flushes_in_one_batch_conversations_first(postgres, buffer):
+    buffer.put(*_feedback("a"))  # queued before its conversation, still written after it
+    buffer.put(*_conversation("a"))
+    buffer.put(*_conversation("b"))
+    buffer.close()
+    assert postgres.writes == 1
+    assert [row[0] for row in postgres.conversations] == ["a", "b"]
+    assert postgres.feedback == [("a", 1, NOW)]
+
+
+def test_nul_byte_row_is_dropped_not_retried(postgres, buffer):
+    before = _dropped("conversation")
+    batch = [_conversation("a"), _conversation("bad", "cadence\x00?"), _conversation("c"), _feedback("a")]
+    buffer._flush(batch)
+    assert [row[0] for row in postgres.conversations] == ["a", "c"]
+    assert postgres.feedback == [("a", 1, NOW)]
+    assert _dropped("conversation") == before + 1
+
+
+def test_feedback_for_unknown_conversation_is_dropped(postgres, buffer):
+    before = _dropped("feedback")
+    buffer._flush([_conversation("a"), _feedback("missing"), _feedback("a")])
+    assert [row[0] for row in postgres.conversations] == ["a"]
+    assert postgres.feedback == [("a", 1, NOW)]
+    assert _dropped("feedback") == before + 1
+
+
+def test_transient_error_is_retried(postgres, buffer):
+    postgres.transient_failures = 1
+    buffer._flush([_conversation("a")])
+    assert [row[0] for row in postgres.conversations] == ["a"]
+
+
+def test_transient_errors_give_up_after_max_attempts(postgres, buffer):
+    before = _dropped("conversation")
+    postgres.transient_failures = 5
+    buffer._flush([_conversation("a"), _conversation("b")])
+    assert postgres.conversations == []
+    assert _dropped("conversation") == before + 2
+